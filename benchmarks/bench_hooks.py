@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Measure the cost of command hooks.
+
+Compares get() and set() on a client without hooks, with an empty
+CommandHooks, and with no-op before/after callbacks, all against an
+in-memory socket.
+
+With --baseline, get() and set() without hooks are also timed on
+another copy of memcache.py, such as the one from before hooks were
+added, to show what disabled hooks cost:
+
+    git show d2bed9b~1:memcache.py > /tmp/memcache_base.py
+    python benchmarks/bench_hooks.py --baseline /tmp/memcache_base.py
+"""
+
+from __future__ import print_function
+
+import argparse
+import importlib.util
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import memcache  # noqa: E402
+from fakes import replaying  # noqa: E402
+
+
+def noop(event):
+    pass
+
+
+def make_clients():
+    empty = memcache.CommandHooks()
+    noops = memcache.CommandHooks()
+    noops.add(before=noop, after=noop)
+    return [
+        ('no hooks', memcache.Client(['bench:11211'])),
+        ('hooks, no callbacks', memcache.Client(['bench:11211'], hooks=empty)),
+        ('no-op before/after', memcache.Client(['bench:11211'], hooks=noops)),
+    ]
+
+
+def load_module(path):
+    spec = importlib.util.spec_from_file_location('memcache_baseline', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def best_of(funcs, number, repeat=5):
+    """Return the best time per call of each of `funcs`, timed in
+    interleaved rounds so that they all see the same machine noise."""
+    best = [float('inf')] * len(funcs)
+    for i in range(repeat):
+        for j, func in enumerate(funcs):
+            best[j] = min(best[j], timeit.timeit(func, number=number))
+    return [t / number for t in best]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.split('\n')[2:]))
+    parser.add_argument('-n', '--iterations', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timing runs per client, the best one counts')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='memcache.py to compare the client without '
+                        'hooks with')
+    args = parser.parse_args(argv)
+
+    base_module = load_module(args.baseline) if args.baseline else None
+    cases = [
+        ('get', b'VALUE key 0 5\r\nvalue\r\nEND\r\n',
+         lambda mc: lambda: mc.get('key')),
+        ('set', b'STORED\r\n', lambda mc: lambda: mc.set('key', b'value')),
+    ]
+    for command, reply, make_call in cases:
+        with replaying(reply):
+            clients = make_clients()
+            if base_module is not None:
+                clients.insert(0, ('baseline, no hooks',
+                                   base_module.Client(['bench:11211'])))
+            timings = best_of([make_call(mc) for name, mc in clients],
+                              args.iterations, args.repeat)
+            baseline = timings[0]
+            for (name, mc), per_op in zip(clients, timings):
+                print('%-4s %-20s %8.0f ns/op  %+6.1f%%' % (
+                    command, name, per_op * 1e9,
+                    (per_op / baseline - 1) * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""CPU microbenchmarks of the protocol encode/decode hot paths.
+
+Drives the client's encoding, key mapping and response parsing code
+against in-memory sockets fed with recorded responses, over a matrix
+of value sizes and key counts, and reports operations per second and
+the peak memory allocated per operation.
+
+    python benchmarks/bench_protocol.py                  # run everything
+    python benchmarks/bench_protocol.py -k recv_value    # only some cases
+    python benchmarks/bench_protocol.py --save base.json
+    python benchmarks/bench_protocol.py --compare base.json
+
+With --compare, the exit status is 1 if any case got slower than the
+baseline by more than --threshold percent.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import memcache  # noqa: E402
+from fakes import ReplaySocket, replaying  # noqa: E402
+
+VALUE_SIZES = (10, 1000, 100000)
+KEY_COUNTS = (1, 10, 100)
+
+CASES = []
+
+
+def case(func):
+    """Register a function yielding (name, callable) benchmark cases."""
+    CASES.append(func)
+    return func
+
+
+def make_client():
+    mc = memcache.Client(['bench:11211'])
+    host = mc.servers[0]
+    host.connect()
+    return mc, host
+
+
+@case
+def encode_cmd(mc, host):
+    for size in VALUE_SIZES:
+        value = b'x' * size
+        headers = '0 0 %d' % size
+        yield ('encode_cmd[%d]' % size,
+               lambda: mc._encode_cmd('set', b'key', headers, False,
+                                      b'\r\n', value, b'\r\n'))
+
+
+@case
+def val_to_store_info(mc, host):
+    for size in VALUE_SIZES:
+        for kind, value in (('bytes', b'x' * size), ('str', u'x' * size),
+                            ('pickle', list(range(size // 4)))):
+            yield ('val_to_store_info[%s,%d]' % (kind, size),
+                   lambda value=value: mc._val_to_store_info(value, 0))
+
+
+@case
+def recv_value(mc, host):
+    for size in VALUE_SIZES:
+        for kind, value in (('bytes', b'x' * size), ('str', u'x' * size),
+                            ('pickle', list(range(size // 4)))):
+            flags, rlen, data = mc._val_to_store_info(value, 0)
+            response = data + b'\r\n'
+
+            def run(response=response, flags=flags, rlen=rlen):
+                host.socket.feed(response)
+                return mc._recv_value(host, flags, rlen)
+            yield 'recv_value[%s,%d]' % (kind, size), run
+
+
+@case
+def expectvalue(mc, host):
+    response = b'VALUE some_key 0 1000\r\n'
+
+    def run():
+        host.socket.feed(response)
+        return mc._expectvalue(host)
+    yield 'expectvalue', run
+
+
+@case
+def map_and_prefix_keys(mc, host):
+    for count in KEY_COUNTS:
+        keys = ['key%d' % i for i in range(count)]
+        yield ('map_and_prefix_keys[%d]' % count,
+               lambda keys=keys: mc._map_and_prefix_keys(keys, 'prefix_'))
+
+
+@case
+def check_key(mc, host):
+    for length in (10, 250):
+        key = b'k' * length
+        yield 'check_key[%d]' % length, lambda key=key: mc.check_key(key)
+
+
+@case
+def readline(mc, host):
+    for count in KEY_COUNTS:
+        response = b'STORED\r\n' * count
+
+        def run(response=response, count=count):
+            host.socket.feed(response)
+            for i in range(count):
+                host.readline()
+        yield 'readline[%d]' % count, run
+
+
+@case
+def recv(mc, host):
+    for size in VALUE_SIZES:
+        response = b'x' * size
+
+        def run(response=response, size=size):
+            host.socket.feed(response)
+            return host.recv(size)
+        yield 'recv[%d]' % size, run
+
+
+@case
+def compressed_batches(mc, host):
+    values = dict(('key%d' % i, os.urandom(64 * 1024).hex())
+                  for i in range(16))
+    response = []
+    for key, value in values.items():
+        flags, rlen, data = mc._val_to_store_info(value, 1)
+        response.append(b'VALUE %s %d %d\r\n%s\r\n'
+                        % (key.encode('ascii'), flags, rlen, data))
+    response = b''.join(response) + b'END\r\n'
+    for mode in ('serial', 'pool'):
+        pool = memcache.CompressionPool() if mode == 'pool' else None
+        client = memcache.Client(['bench:11211'], compression_pool=pool)
+        client.servers[0].connect()
+
+        def set_multi(client=client):
+            client.set_multi(values, min_compress_len=1, noreply=True)
+
+        def get_multi(client=client):
+            client.servers[0].socket.feed(response)
+            return client.get_multi(values)
+        yield 'set_multi_compressed[%s]' % mode, set_multi
+        yield 'get_multi_compressed[%s]' % mode, get_multi
+
+
+def measure(func, min_time, repeat):
+    """Return (ops/sec, peak bytes allocated per op) for `func`."""
+    number = 1
+    while timeit.timeit(func, number=number) < min_time:
+        number *= 2
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        func()
+        peak = tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return number / best, peak
+
+
+def run(pattern=None, min_time=0.05, repeat=5):
+    results = {}
+    with replaying(b''):
+        mc, host = make_client()
+        assert isinstance(host.socket, ReplaySocket)
+        for make_cases in CASES:
+            for name, func in make_cases(mc, host):
+                if pattern and pattern not in name:
+                    continue
+                ops, peak = measure(func, min_time, repeat)
+                results[name] = {'ops_per_sec': ops, 'peak_bytes': peak}
+                yield name, results[name]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n'.join(__doc__.split('\n')[2:]))
+    parser.add_argument('-k', dest='pattern',
+                        help='only run cases whose name contains PATTERN')
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='minimum seconds per timing run')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timing runs per case, the best one counts')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with a baseline saved with --save')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='slowdown in percent counted as a regression')
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print('%-32s %14s %12s %10s'
+          % ('case', 'ops/sec', 'peak bytes', 'change'))
+    for name, result in run(args.pattern, args.min_time, args.repeat):
+        results[name] = result
+        change = ''
+        if name in baseline:
+            ratio = result['ops_per_sec'] / baseline[name]['ops_per_sec']
+            change = '%+.1f%%' % ((ratio - 1) * 100)
+            if (1 - ratio) * 100 > args.threshold:
+                regressions.append(name)
+                change += ' !'
+        print('%-32s %14.0f %12d %10s' % (
+            name, result['ops_per_sec'], result['peak_bytes'], change))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if regressions:
+        print('\n%d regression(s) over %.0f%%: %s' % (
+            len(regressions), args.threshold, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,45 @@
+"""In-memory sockets to benchmark the client without a server."""
+
+from contextlib import contextmanager
+import socket
+
+
+class ReplaySocket(object):
+    """Socket answering every sendall() with the same canned reply."""
+
+    reply = b''
+
+    def __init__(self, *args):
+        self._buf = b''
+
+    def settimeout(self, timeout):
+        pass
+
+    def connect(self, address):
+        pass
+
+    def sendall(self, data):
+        self._buf += self.reply
+
+    def feed(self, data):
+        """Queue `data` to be returned by recv()."""
+        self._buf += data
+
+    def recv(self, size):
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+@contextmanager
+def replaying(reply):
+    """Make new sockets ReplaySockets answering with `reply`."""
+    orig_socket, orig_reply = socket.socket, ReplaySocket.reply
+    socket.socket = ReplaySocket
+    ReplaySocket.reply = reply
+    try:
+        yield
+    finally:
+        socket.socket, ReplaySocket.reply = orig_socket, orig_reply
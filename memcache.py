@@ -47,16 +47,38 @@ More detailed documentation is available in the L{Client} class.
 
 
 import binascii
+import errno
+from collections import deque, namedtuple
+from collections.abc import MutableMapping
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import timedelta
 from io import BytesIO
+from itertools import islice
+from array import array
+from bisect import bisect_left
+import json
+import math
+import mmap
+import os
+import random
 import re
+import select
 import socket
+import struct
 import sys
 import threading
 import time
+import weakref
 import zlib
 
 import pickle
+import queue
+from urllib.parse import quote_from_bytes, unquote_to_bytes
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def cmemcache_hash(key):
@@ -99,7 +121,1734 @@ class _ConnectionDeadError(Exception):
 
 
 _DEAD_RETRY = 30  # number of seconds before retrying a dead server.
+_DEAD_RETRY_MAX = 300  # cap for the exponential dead server backoff.
+_DEAD_RETRY_JITTER = 0.1  # +/- fraction of randomness added to backoffs.
 _SOCKET_TIMEOUT = 3  # number of seconds before sockets timeout.
+_DNS_TTL = 60  # number of seconds resolved server addresses are cached.
+_HAPPY_EYEBALLS_DELAY = 0.25  # seconds before trying the next address.
+_NAMESPACE_TTL = 1  # seconds namespace versions are cached locally.
+_NAMESPACE_VERSION_PREFIX = b'__ns:'  # reserved for namespace versions.
+_IOV_MAX = 512  # most buffers passed to a single sendmsg() call.
+
+# Results of reading a single "get" response from one server.
+_MISS = object()
+_FAILED = object()
+
+
+class _CircuitBreaker:
+    """Per-server circuit breaker.
+
+    The breaker starts C{closed}.  It trips C{open} once
+    C{failure_threshold} failures happen in a row, or once the error
+    rate over the last C{error_rate_window} seconds reaches
+    C{error_rate_threshold}.  While open no requests are allowed;
+    after the backoff expires the breaker is C{half-open} and lets a
+    single connection attempt through.  If that succeeds the breaker
+    closes, otherwise it opens again with a doubled backoff.  Only a
+    completed request resets the count of failures in a row and the
+    backoff, so a server accepting connections but failing every
+    request still trips the breaker.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, dead_retry=_DEAD_RETRY, dead_retry_max=_DEAD_RETRY_MAX,
+                 jitter=_DEAD_RETRY_JITTER, failure_threshold=1,
+                 error_rate_threshold=None, error_rate_min_requests=20,
+                 error_rate_window=10):
+        self.dead_retry = dead_retry
+        self.dead_retry_max = max(dead_retry_max, dead_retry)
+        self.jitter = jitter
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.error_rate_min_requests = error_rate_min_requests
+        self.error_rate_window = error_rate_window
+        self.reset()
+
+    def reset(self):
+        self.state = self.CLOSED
+        self.open_until = 0
+        self.trips = 0
+        self.consecutive_failures = 0
+        self._window_start = 0
+        self._window_requests = 0
+        self._window_failures = 0
+
+    def allow(self):
+        """Return True if a request may be sent to the server."""
+        if self.state == self.CLOSED:
+            if self.error_rate_threshold is not None:
+                self._count(time.time(), False)
+            return True
+        now = time.time()
+        if self.open_until > now:
+            return False
+        # Let a single probe through, or another one if the last probe
+        # didn't report back within dead_retry.
+        self.state = self.HALF_OPEN
+        self.open_until = now + self.dead_retry
+        return True
+
+    def record_connect(self):
+        """Record a successful connection.
+
+        @return: True if this closed a previously open breaker.
+        """
+        if self.state == self.CLOSED:
+            return False
+        self.state = self.CLOSED
+        self.open_until = 0
+        return True
+
+    def record_success(self):
+        """Record a completed request.
+
+        @return: True if this closed a previously open breaker.
+        """
+        self.consecutive_failures = 0
+        self.trips = 0
+        return self.record_connect()
+
+    def record_failure(self):
+        """Record a failure.
+
+        @return: True if this tripped the breaker open.
+        """
+        now = time.time()
+        self.consecutive_failures += 1
+        if self.state == self.OPEN:
+            return False
+        threshold_reached = self.consecutive_failures >= self.failure_threshold
+        if self.state == self.HALF_OPEN or threshold_reached or self._error_rate_exceeded(now):
+            self._trip(now)
+            return True
+        return False
+
+    def _count(self, now, failed):
+        if now - self._window_start > self.error_rate_window:
+            self._window_start = now
+            self._window_requests = 0
+            self._window_failures = 0
+        if failed:
+            self._window_failures += 1
+        else:
+            self._window_requests += 1
+
+    def _error_rate_exceeded(self, now):
+        if self.error_rate_threshold is None:
+            return False
+        self._count(now, True)
+        # Failed requests were already counted as requests by allow(),
+        # unless the window rolled over in between.
+        requests = max(self._window_requests, self._window_failures)
+        if requests < self.error_rate_min_requests:
+            return False
+        return self._window_failures >= self.error_rate_threshold * requests
+
+    def _trip(self, now):
+        delay = min(self.dead_retry * (2 ** self.trips), self.dead_retry_max)
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        self.trips += 1
+        self.state = self.OPEN
+        self.open_until = now + delay
+        self._window_start = 0
+
+
+def _select_readable(hosts, timeout):
+    """Wait up to C{timeout} seconds for the hosts to have data to read.
+
+    @return: The list of hosts that are readable.
+    """
+    try:
+        readable = select.select([h.socket for h in hosts], [], [], timeout)[0]
+    except (OSError, TypeError, ValueError):
+        # Not something select() can wait on, just read from it.
+        return hosts
+    return [h for h in hosts if h.socket in readable]
+
+
+class _DNSCache:
+    """Cache of getaddrinfo() results, shared by all the clients.
+
+    Every reconnect used to resolve the server name again, so a network
+    blip reconnecting many clients turned into a burst of DNS lookups.
+    If a lookup fails, the expired addresses are used if there are any.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port, family, ttl):
+        """Return the getaddrinfo() results for C{host}, cached C{ttl} seconds."""
+        key = (host, port, family)
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        try:
+            addresses = socket.getaddrinfo(host, port, family,
+                                           socket.SOCK_STREAM)
+        except OSError:
+            if entry is None:
+                raise
+            return entry[1]
+        if ttl:
+            with self._lock:
+                self._entries[key] = (now + ttl, addresses)
+        return addresses
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+
+_dns_cache = _DNSCache()
+
+# Bumped in the child process after every fork: the connections opened
+# before it are shared with the parent and must not be used any more.
+_fork_generation = 0
+# Objects whose _after_fork() method is called in the child process.
+_fork_listeners = weakref.WeakSet([_dns_cache])
+
+
+def _after_fork_in_child():
+    global _fork_generation
+    _fork_generation += 1
+    for listener in list(_fork_listeners):
+        try:
+            listener._after_fork()
+        except Exception as e:
+            sys.stderr.write("MemCached: after fork: %s\n" % e)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _connect_staggered(addresses, timeout, delay=_HAPPY_EYEBALLS_DELAY):
+    """Connect to the first of C{addresses} (getaddrinfo() results) to answer.
+
+    Like the "Happy Eyeballs" algorithm, the next address is tried
+    if the previous ones didn't connect within C{delay} seconds, or
+    as soon as they fail, while the earlier attempts keep going.
+
+    @return: A connected socket in blocking mode.
+    @raise OSError: if no address could be connected to in C{timeout}
+    seconds.
+    """
+    if len(addresses) == 1:
+        family, type_, proto, _, sockaddr = addresses[0]
+        s = socket.socket(family, type_, proto)
+        if hasattr(s, 'settimeout'):
+            s.settimeout(timeout)
+        try:
+            s.connect(sockaddr)
+        except Exception:
+            s.close()
+            raise
+        return s
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    remaining = list(addresses)
+    pending = {}
+    error = None
+    next_attempt = time.monotonic()
+    try:
+        while remaining or pending:
+            now = time.monotonic()
+            if remaining and (not pending or now >= next_attempt):
+                family, type_, proto, _, sockaddr = remaining.pop(0)
+                s = socket.socket(family, type_, proto)
+                s.setblocking(False)
+                err = s.connect_ex(sockaddr)
+                if err == 0:
+                    s.setblocking(True)
+                    return s
+                if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK,
+                               errno.EAGAIN):
+                    error = OSError(err, os.strerror(err))
+                    s.close()
+                    continue
+                pending[s] = sockaddr
+                next_attempt = now + delay
+            wait = next_attempt - now if remaining else None
+            if deadline is not None:
+                left = deadline - now
+                if left <= 0:
+                    raise socket.timeout('timed out')
+                wait = left if wait is None else min(wait, left)
+            writable = select.select([], list(pending), [], wait)[1]
+            for s in writable:
+                err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                del pending[s]
+                if err == 0:
+                    s.setblocking(True)
+                    return s
+                error = OSError(err, os.strerror(err))
+                s.close()
+                next_attempt = time.monotonic()
+        raise error or OSError('no address to connect to')
+    finally:
+        for s in pending:
+            s.close()
+
+
+class HealthChecker:
+    """Probe dead and idle servers from a background thread.
+
+    Dead servers are probed with a C{version} command every
+    C{interval} seconds.  As soon as one answers, a fresh connection
+    is handed to it and it is marked alive.  While the checker runs,
+    requests don't try to reconnect to dead servers themselves, so no
+    request ever waits on a server that is still down.  Servers that
+    have been idle for C{idle_interval} seconds are probed as well,
+    and marked dead if they no longer answer.
+
+    Since L{Client} keeps separate connections for each thread, the
+    hosts of every thread get registered here; they are probed once
+    per address.  The results are handed over to the thread owning
+    each host, which applies them on its next request.
+
+    @param on_transition: optional callable, called as
+    C{on_transition(host, alive)} whenever the checker marks a host
+    alive or dead.
+    """
+
+    def __init__(self, interval=1.0, idle_interval=30.0, timeout=None,
+                 on_transition=None):
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.timeout = timeout
+        self.on_transition = on_transition
+        self._hosts = weakref.WeakSet()
+        self._last_use = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        _fork_listeners.add(self)
+
+    def _after_fork(self):
+        # The thread doesn't survive the fork, run a new one.
+        self._lock = threading.Lock()
+        if self._thread is not None and not self._stop.is_set():
+            self._thread = None
+            self.start()
+
+    def register(self, hosts):
+        """Add the _Host instances in C{hosts} and start checking."""
+        with self._lock:
+            for host in hosts:
+                host._health_checker = self
+                self._hosts.add(host)
+        self.start()
+
+    def running(self):
+        """Return True if the background thread is checking hosts."""
+        return self._thread is not None and not self._stop.is_set()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='memcache-health-checker')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background thread and wait for it to exit."""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                sys.stderr.write("MemCached: health check failed: %s\n" % e)
+
+    def check(self):
+        """Probe all the dead and idle hosts once."""
+        with self._lock:
+            hosts = list(self._hosts)
+        by_address = {}
+        for host in hosts:
+            by_address.setdefault((host.family, host.address), []).append(host)
+
+        now = time.time()
+        for hosts in by_address.values():
+            dead = [h for h in hosts
+                    if h._breaker.state != _CircuitBreaker.CLOSED]
+            idle = [h for h in hosts
+                    if h._breaker.state == _CircuitBreaker.CLOSED and self._is_idle(h, now)]
+            if not dead and not idle:
+                continue
+
+            probe = self._probe(hosts[0])
+            if probe is None:
+                for host in idle:
+                    host._post_health_update(False)
+                    self._notify(host, False)
+                continue
+
+            for host in idle:
+                self._last_use[host] = (host.uses, now)
+            for host in dead:
+                if host.flush_on_next_connect:
+                    # Let the owning thread reconnect, and flush.
+                    host._post_health_update(True)
+                elif probe is not None:
+                    host._post_health_update(True, probe)
+                    probe = None
+                else:
+                    try:
+                        host._post_health_update(
+                            True, host._connect_socket(self.timeout))
+                    except OSError:
+                        host._post_health_update(True)
+                self._notify(host, True)
+            if probe is not None:
+                probe.close()
+
+    def _is_idle(self, host, now):
+        last = self._last_use.get(host)
+        if last is None or last[0] != host.uses:
+            self._last_use[host] = (host.uses, now)
+            return False
+        return now - last[1] >= self.idle_interval
+
+    def _probe(self, host):
+        """Return a connected socket if the host answers "version"."""
+        try:
+            s = host._connect_socket(self.timeout)
+        except OSError:
+            return None
+        try:
+            s.sendall(b'version\r\n')
+            line = b''
+            while not line.endswith(b'\r\n'):
+                data = s.recv(4096)
+                if not data:
+                    break
+                line += data
+            if line.startswith(b'VERSION '):
+                return s
+        except OSError:
+            pass
+        s.close()
+        return None
+
+    def _notify(self, host, alive):
+        if self.on_transition is not None:
+            self.on_transition(host, alive)
+
+
+class HotKeyDetector:
+    """Detect frequently read keys and keep short-lived local copies.
+
+    One in C{sample_every} key lookups is counted in a count-min
+    sketch, whose counters are halved every C{decay_interval}
+    seconds.  Keys whose estimated number of reads reaches
+    C{threshold} are "hot": once read from memcached, their values
+    are kept in process memory and served from there for up to
+    C{local_ttl} seconds.  Writes through the client invalidate the
+    local copy, writes from other clients are seen after at most
+    C{local_ttl} seconds.
+
+    Values served from the local copy are shared between callers, so
+    they shouldn't be modified in place.
+    """
+
+    def __init__(self, threshold=1000, sample_every=10, local_ttl=1.0,
+                 width=4096, depth=4, decay_interval=10.0, max_hot_keys=100):
+        self.threshold = threshold
+        self.sample_every = sample_every
+        self.local_ttl = local_ttl
+        self.width = width
+        self.depth = depth
+        self.decay_interval = decay_interval
+        self.max_hot_keys = max_hot_keys
+        self._rows = [array('L', bytes(array('L').itemsize * width))
+                      for i in range(depth)]
+        self._hot = {}
+        self._local = {}
+        self._tick = 0
+        self._next_decay = time.time() + decay_interval
+        self._lock = threading.Lock()
+
+    def record(self, key):
+        """Count a read of C{key}, which must be bytes."""
+        self._tick += 1
+        if self._tick % self.sample_every:
+            return
+        with self._lock:
+            now = time.time()
+            if now >= self._next_decay:
+                self._decay(now)
+            estimate = None
+            for seed, row in enumerate(self._rows):
+                i = binascii.crc32(key, seed) % self.width
+                row[i] += self.sample_every
+                if estimate is None or row[i] < estimate:
+                    estimate = row[i]
+            if estimate >= self.threshold:
+                self._hot[key] = estimate
+                if len(self._hot) > self.max_hot_keys:
+                    coldest = min(self._hot, key=self._hot.get)
+                    del self._hot[coldest]
+                    self._local.pop(coldest, None)
+
+    def _decay(self, now):
+        self._next_decay = now + self.decay_interval
+        for row in self._rows:
+            for i, count in enumerate(row):
+                if count:
+                    row[i] = count >> 1
+        for key in list(self._hot):
+            self._hot[key] >>= 1
+            if self._hot[key] < self.threshold:
+                del self._hot[key]
+                self._local.pop(key, None)
+
+    def is_hot(self, key):
+        return key in self._hot
+
+    def get_local(self, key):
+        """Return a tuple of (found, value) from the local copies."""
+        entry = self._local.get(key)
+        if entry is None or entry[0] < time.time():
+            return False, None
+        return True, entry[1]
+
+    def store_local(self, key, value):
+        self._local[key] = (time.time() + self.local_ttl, value)
+
+    def invalidate(self, key):
+        self._local.pop(key, None)
+
+    def hot_keys(self):
+        """Return a list of (key, estimated reads) tuples, hottest first."""
+        with self._lock:
+            return sorted(self._hot.items(), key=lambda item: -item[1])
+
+
+class NegativeCache:
+    """Remember keys recently found missing, to answer them locally.
+
+    Pass an instance as the C{negative_cache} argument of a L{Client}:
+    keys that L{Client.get} and L{Client.get_multi} didn't find are
+    recorded, and are then answered as misses without asking memcached
+    for up to C{ttl} seconds.  Writes through the client remove the key
+    right away; writes from other clients are only seen once the
+    recorded miss expires.
+
+    The keys are not stored: they are recorded in C{generations}
+    counting Bloom filters, each sized for C{capacity} keys with a
+    false positive rate of C{error_rate}.  A new generation is started
+    every C{ttl / generations} seconds and the oldest one dropped.  So
+    memory use is fixed, and about C{generations * error_rate} of the
+    keys that were never recorded are nevertheless answered as misses,
+    until the next write of the key or for at most C{ttl} seconds.
+    """
+
+    def __init__(self, ttl=10.0, capacity=10000, error_rate=0.001,
+                 generations=4):
+        self.ttl = ttl
+        self.generations = generations
+        self.size = max(1, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.nhashes = max(1, round(self.size / capacity * math.log(2)))
+        self._filters = deque(array('B', bytes(self.size))
+                              for i in range(generations))
+        self._interval = ttl / generations
+        self._next_rotation = time.monotonic() + self._interval
+        self._lock = threading.Lock()
+
+    def _indexes(self, key):
+        h1 = binascii.crc32(key)
+        h2 = binascii.crc32(key, h1) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.nhashes)]
+
+    def _rotate(self, now):
+        with self._lock:
+            if now < self._next_rotation:
+                return
+            # Catch up with the generations missed while idle.
+            n = int((now - self._next_rotation) / self._interval) + 1
+            for i in range(min(n, self.generations)):
+                self._filters.popleft()
+                self._filters.append(array('B', bytes(self.size)))
+            self._next_rotation += n * self._interval
+
+    def __contains__(self, key):
+        """Whether C{key}, which must be bytes, was recently missing."""
+        now = time.monotonic()
+        if now >= self._next_rotation:
+            self._rotate(now)
+        indexes = self._indexes(key)
+        for counters in self._filters:
+            if all(counters[i] for i in indexes):
+                return True
+        return False
+
+    def add(self, key):
+        """Record that C{key} is missing."""
+        now = time.monotonic()
+        if now >= self._next_rotation:
+            self._rotate(now)
+        indexes = self._indexes(key)
+        with self._lock:
+            counters = self._filters[-1]
+            if all(counters[i] for i in indexes):
+                # Counted twice, a single invalidate() wouldn't remove it.
+                return
+            for i in indexes:
+                if counters[i] < 255:
+                    counters[i] += 1
+
+    def invalidate(self, key):
+        """Forget that C{key} was missing.
+
+        The counters of a key are shared with other keys.  When C{key}
+        itself was never recorded but is a false positive, decrementing
+        its counters can make recorded keys look absent again, i.e.
+        false negatives: those are then fetched from memcached, at the
+        cost of a request but never of a wrong result.
+        """
+        indexes = self._indexes(key)
+        with self._lock:
+            for counters in self._filters:
+                if all(counters[i] for i in indexes):
+                    for i in indexes:
+                        # Saturated counters can't tell how many keys
+                        # they stand for, so they stay.
+                        if counters[i] < 255:
+                            counters[i] -= 1
+
+    def clear(self):
+        with self._lock:
+            for counters in self._filters:
+                counters[:] = array('B', bytes(self.size))
+
+
+class _WorkerClient:
+    """The L{Client} a background thread uses on behalf of other threads.
+
+    Client is a C{threading.local}, so a background thread touching
+    the client of its callers gets a state of its own, built by
+    running C{__init__} again with the constructor's arguments: it
+    would miss the servers and settings changed since, and register
+    with the health checker once more.  Instead the callers hand over
+    their own state, C{client.__dict__}, with each operation, and the
+    worker copies its settings into a client of its own, created
+    without C{__init__}, reconnecting only when the servers changed.
+    """
+
+    # The connections and caches of one thread, left out of the settings.
+    _THREAD_STATE = frozenset(('servers', 'buckets', '_topology', '_deadline',
+                               '_failover_buckets', '_failover_version',
+                               'cas_ids', 'stats', '_namespace_versions'))
+
+    def __init__(self, cls):
+        self._cls = cls
+        self._client = None
+
+    @classmethod
+    def group(cls, pairs):
+        """Group the (state, item) C{pairs} by the settings of the state.
+
+        @return: a list of (settings, items) tuples.
+        """
+        groups = []
+        by_state = {}
+        for state, item in pairs:
+            items = by_state.get(id(state))
+            if items is None:
+                # Copying the items of a dict doesn't release the GIL,
+                # so this is safe while the owner thread changes it.
+                settings = tuple(i for i in list(state.items())
+                                 if i[0] not in cls._THREAD_STATE)
+                for other, items in groups:
+                    if other == settings:
+                        break
+                else:
+                    items = []
+                    groups.append((settings, items))
+                by_state[id(state)] = items
+            items.append(item)
+        return groups
+
+    def use(self, settings):
+        """Return the worker's client, configured with C{settings}."""
+        client = self._client
+        if client is None:
+            client = self._client = self._cls.__new__(self._cls)
+            client._deadline = [None]
+        specs = client.__dict__.get('_server_specs')
+        client.__dict__.update(settings)
+        # The worker sends its operations itself.
+        client.write_behind = client.auto_batch = None
+        if client._server_specs != specs or specs is None:
+            client.set_servers(client._server_specs)
+            client.reset_cas()
+            client.stats = {}
+            client._namespace_versions = {}
+        return client
+
+
+class WriteBehindQueue:
+    """Queue of best-effort writes sent by a background thread.
+
+    Pass an instance as the C{write_behind} argument of a L{Client},
+    then use L{Client.set_async} and L{Client.delete_async}: they only
+    add the operation to a bounded queue and return.  A background
+    thread collects up to C{batch_size} queued operations, waiting at
+    most C{flush_interval} seconds after the first one, and sends them
+    with L{Client.set_multi} and L{Client.delete_multi} with noreply,
+    so they are pipelined per server.  Within a batch, only the last
+    operation on a key is sent.  They go to the servers, and use the
+    settings, of the thread which queued them.
+
+    When the queue is full, new operations are dropped if C{overflow}
+    is C{"drop"}, or the caller waits for room if it is C{"block"}.
+    L{stats} returns the number of operations queued, written and
+    dropped, and those which failed.
+    """
+
+    def __init__(self, maxsize=10000, flush_interval=0.05, batch_size=100,
+                 overflow='drop'):
+        if overflow not in ('drop', 'block'):
+            raise ValueError('overflow must be "drop" or "block"')
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self._queue = queue.Queue(maxsize)
+        self._client = None
+        self._worker = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(('queued', 'written', 'dropped',
+                                        'failed'), 0)
+        _fork_listeners.add(self)
+
+    def _after_fork(self):
+        # The operations queued before the fork are written by the
+        # parent; the thread is started again on the next put().
+        self._queue = queue.Queue(self._queue.maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        if self._worker is not None:
+            self._worker = _WorkerClient(self._worker._cls)
+
+    def _attach(self, client):
+        with self._lock:
+            if self._client is None:
+                self._client = client
+                self._worker = _WorkerClient(type(client))
+            elif self._client is not client:
+                raise ValueError('WriteBehindQueue used by another client')
+
+    def _count(self, name, n, metrics):
+        with self._lock:
+            self._counters[name] += n
+        if metrics is not None:
+            metrics.incr('write_behind', name, n)
+
+    def put(self, op):
+        """Queue C{op}, return False if it was dropped."""
+        if self._thread is None:
+            self._start()
+        # The state of the calling thread, see _WorkerClient.
+        state = self._client.__dict__
+        try:
+            self._queue.put((state, op), block=self.overflow == 'block')
+        except queue.Full:
+            self._count('dropped', 1, state['metrics'])
+            return False
+        self._count('queued', 1, state['metrics'])
+        return True
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='memcache-write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def flush(self, timeout=None):
+        """Wait until all the queued operations have been sent.
+
+        @return: False if that took more than C{timeout} seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                if deadline is None:
+                    self._queue.all_tasks_done.wait()
+                else:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        return False
+                    self._queue.all_tasks_done.wait(left)
+        return True
+
+    def stats(self):
+        """Return the counters, plus the number of C{pending} operations."""
+        with self._lock:
+            stats = dict(self._counters)
+        stats['pending'] = self._queue.qsize()
+        return stats
+
+    def _run(self):
+        get = self._queue.get
+        while True:
+            batch = [get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                try:
+                    batch.append(get(timeout=left))
+                except queue.Empty:
+                    break
+            try:
+                for settings, ops in _WorkerClient.group(batch):
+                    try:
+                        self._write(self._worker.use(settings), ops)
+                    except Exception as e:
+                        self._count('failed', len(ops),
+                                    dict(settings)['metrics'])
+                        sys.stderr.write(
+                            "MemCached: write-behind failed: %s\n" % e)
+            finally:
+                for op in batch:
+                    self._queue.task_done()
+
+    def _write(self, client, batch):
+        # Only the last operation on each key counts.
+        last = {}
+        for op in batch:
+            last[op[1]] = op
+        sets = {}
+        deletes = []
+        for op in last.values():
+            if op[0] == 'set':
+                cmd, key, val, exptime, min_compress_len = op
+                sets.setdefault((exptime, min_compress_len), {})[key] = val
+            else:
+                deletes.append(op[1])
+        failed = 0
+        for (exptime, min_compress_len), mapping in sets.items():
+            try:
+                failed += len(client.set_multi(
+                    mapping, exptime, min_compress_len=min_compress_len,
+                    noreply=True))
+            except Exception:
+                # A bad key fails the whole set_multi, retry one by one.
+                for key, val in mapping.items():
+                    try:
+                        client.set(key, val, exptime, min_compress_len,
+                                   noreply=True)
+                    except Exception:
+                        failed += 1
+        if deletes:
+            try:
+                client.delete_multi(deletes, noreply=True)
+            except Exception:
+                for key in deletes:
+                    try:
+                        client.delete(key, noreply=True)
+                    except Exception:
+                        failed += 1
+        self._count('written', len(batch) - failed, client.metrics)
+        if failed:
+            self._count('failed', failed, client.metrics)
+
+
+class AutoBatcher:
+    """Collects concurrent single key gets into multi-gets.
+
+    Pass an instance as the C{auto_batch} argument of a L{Client}:
+    L{Client.get} then adds its key to a pending batch and waits.  A
+    background thread waits C{window} seconds after the first pending
+    key, or until C{max_batch} keys are pending, and fetches them all
+    with one L{Client.get_multi}, i.e. one request per server, using
+    the servers and settings of the calling threads, then hands every
+    caller its own result.  Code which calls C{get} from
+    many threads, or from asyncio tasks through L{Client.aget}, so
+    gets the round trip savings of C{get_multi} without being
+    rewritten.  L{stats} returns the number of C{keys} fetched and of
+    C{batches} they took.
+
+    A single thread doing gets one after the other only pays the
+    extra C{window} per call, use L{Client.batch} there instead.
+    """
+
+    def __init__(self, window=0.001, max_batch=100):
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._first = None
+        self._cond = threading.Condition()
+        self._client = None
+        self._worker = None
+        self._thread = None
+        self._counters = {'keys': 0, 'batches': 0}
+        _fork_listeners.add(self)
+
+    def _after_fork(self):
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = None
+        if self._worker is not None:
+            self._worker = _WorkerClient(self._worker._cls)
+
+    def _attach(self, client):
+        with self._cond:
+            if self._client is None:
+                self._client = client
+                self._worker = _WorkerClient(type(client))
+            elif self._client is not client:
+                raise ValueError('AutoBatcher used by another client')
+
+    def submit(self, key, default=None):
+        """Add C{key} to the pending batch.
+
+        @return: a C{concurrent.futures.Future} set to the value, or
+        to C{default} if the key was not found.
+        """
+        if self._thread is None:
+            self._start()
+        future = Future()
+        # The state of the calling thread, see _WorkerClient.
+        state = self._client.__dict__
+        with self._cond:
+            if not self._pending:
+                self._first = time.monotonic()
+            self._pending.append((state, (key, default, future)))
+            if len(self._pending) in (1, self.max_batch):
+                self._cond.notify()
+        return future
+
+    def stats(self):
+        """Return the number of keys and batches fetched so far."""
+        with self._cond:
+            return dict(self._counters)
+
+    def _start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='memcache-auto-batch')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        cond = self._cond
+        while True:
+            with cond:
+                while not self._pending:
+                    cond.wait()
+                deadline = self._first + self.window
+                while len(self._pending) < self.max_batch:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    cond.wait(left)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+                if self._pending:
+                    self._first = time.monotonic()
+                self._counters['keys'] += len(batch)
+                self._counters['batches'] += 1
+            for settings, requests in _WorkerClient.group(batch):
+                try:
+                    client = self._worker.use(settings)
+                except Exception as e:
+                    for key, default, future in requests:
+                        future.set_exception(e)
+                    continue
+                _resolve_gets(client, requests)
+
+
+class _GetBatch:
+    """Explicit batch of gets, see L{Client.batch}."""
+
+    def __init__(self, client):
+        self._client = client
+        self._requests = []
+
+    def get(self, key, default=None):
+        """Add C{key} to the batch.
+
+        @return: a C{concurrent.futures.Future} set to the value, or
+        to C{default} if the key was not found, when the batch is
+        executed.
+        """
+        future = Future()
+        self._requests.append((key, default, future))
+        return future
+
+    def execute(self):
+        """Fetch all the keys added since the last call."""
+        requests, self._requests = self._requests, []
+        if requests:
+            _resolve_gets(self._client, requests)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        else:
+            for key, default, future in self._requests:
+                future.cancel()
+            self._requests = []
+
+
+def _resolve_gets(client, requests):
+    """Fetch the (key, default, future) C{requests} with one get_multi."""
+    try:
+        # Skips the key_encoder call of get_multi(), so that the keys are
+        # encoded once, as by get().
+        values = client._get_multi_replicas(
+            list(dict.fromkeys(r[0] for r in requests)), '', {})
+    except Exception:
+        # A bad key fails the whole get_multi, fetch the keys one by
+        # one so that only its own caller gets the exception.
+        for key, default, future in requests:
+            try:
+                future.set_result(client._get('get', client.key_encoder(key),
+                                              default))
+            except Exception as e:
+                future.set_exception(e)
+        return
+    for key, default, future in requests:
+        future.set_result(values.get(key, default))
+
+
+class CompressionPool:
+    """Thread pool compressing and decompressing the large values of
+    batch operations.
+
+    Pass an instance as the C{compression_pool} argument of a
+    L{Client}.  L{Client.set_multi} then compresses the values of more
+    than C{threshold} bytes in the pool, and sends the commands of each
+    server as soon as its values are ready, while the values of the
+    next servers are still being compressed.  L{Client.get_multi}
+    hands the compressed values of more than C{threshold} bytes to the
+    pool as they are read, and waits for them once all the servers
+    have answered.  zlib releases the GIL, so on multi-core machines
+    large compressed batches are (de)compressed in parallel.
+
+    The pool threads are started on first use, up to C{max_workers},
+    by default the number of CPUs.  The same pool can be shared
+    between clients.
+    """
+
+    def __init__(self, max_workers=None, threshold=32 * 1024):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.threshold = threshold
+        self._executor = None
+        self._lock = threading.Lock()
+        _fork_listeners.add(self)
+
+    def _after_fork(self):
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        """Run C{fn(*args)} in the pool, return a C{Future}."""
+        executor = self._executor
+        if executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        self.max_workers,
+                        thread_name_prefix='memcache-compression')
+                executor = self._executor
+        return executor.submit(fn, *args)
+
+    def shutdown(self, wait=True):
+        """Stop the pool threads; they are started again if needed."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait)
+
+
+def _compress_store_info(compressor, max_value_length, flags, val, lv,
+                         min_compress_len):
+    """Second half of L{Client._val_to_store_info}, which may run in
+    the C{compression_pool}.
+
+    This is a plain function, as the (thread-local) Client must not be
+    used from the pool threads.
+    """
+    # We should try to compress if min_compress_len > 0
+    # and this string is longer than our min threshold.
+    if min_compress_len and lv > min_compress_len:
+        if isinstance(val, list):
+            comp_val = compressor(b''.join(val))
+        else:
+            comp_val = compressor(val)
+        # Only retain the result if the compression result is smaller
+        # than the original.
+        if len(comp_val) < lv:
+            flags |= Client._FLAG_COMPRESSED
+            val = comp_val
+            lv = len(val)
+
+    #  silently do not store if value length exceeds maximum
+    if max_value_length != 0 and lv > max_value_length:
+        return 0
+
+    return (flags, lv, val)
+
+
+class CommandEvent:
+    """Description of a single client command, as seen by observers.
+
+    @ivar command: name of the command, e.g. C{"get"} or C{"set_multi"}.
+    @ivar key: the key for single key commands, otherwise None.
+    @ivar nkeys: number of keys in the command.
+    @ivar hosts: list of the _Host instances the command was sent to.
+    @ivar value_size: size in bytes of the stored value, if any.
+    @ivar duration: elapsed seconds, once the command is finished.
+    @ivar bytes_sent: bytes sent to the servers for this command.
+    @ivar bytes_received: bytes received from the servers.
+    @ivar outcome: C{"ok"}, C{"error"} or C{"timeout"}.
+    @ivar hits: number of keys found, for retrieval commands.
+    @ivar misses: number of keys not found, for retrieval commands.
+    """
+    __slots__ = ('command', 'key', 'nkeys', 'hosts', 'value_size', 'start',
+                 'duration', 'bytes_sent', 'bytes_received', 'outcome',
+                 'hits', 'misses', 'host_durations', 'host_bytes',
+                 '_counters')
+
+    def __init__(self, command, hosts, nkeys=1, key=None, value_size=None):
+        self.command = command
+        self.key = key
+        self.nkeys = nkeys
+        self.hosts = []
+        self.value_size = value_size
+        self.duration = None
+        self.bytes_sent = self.bytes_received = 0
+        self.outcome = None
+        self.hits = self.misses = 0
+        self.host_durations = {}
+        self.host_bytes = {}
+        self._counters = []
+        for host in hosts:
+            self.add_host(host)
+        self.start = time.perf_counter()
+
+    @property
+    def host(self):
+        """The target _Host, if the command went to a single server."""
+        if len(self.hosts) == 1:
+            return self.hosts[0]
+        return None
+
+    def add_host(self, host):
+        if host not in self.hosts:
+            self.hosts.append(host)
+            self._counters.append((host.bytes_sent, host.bytes_received,
+                                   host.errors, host.timeouts))
+
+    def host_done(self, host):
+        """Record that the command is finished on C{host}."""
+        self.host_durations[host] = time.perf_counter() - self.start
+
+    def finish(self, hits=0, misses=0):
+        self.duration = time.perf_counter() - self.start
+        self.hits = hits
+        self.misses = misses
+        errors = timeouts = 0
+        for host, counters in zip(self.hosts, self._counters):
+            sent = host.bytes_sent - counters[0]
+            received = host.bytes_received - counters[1]
+            self.host_bytes[host] = (sent, received)
+            self.bytes_sent += sent
+            self.bytes_received += received
+            errors += host.errors - counters[2]
+            timeouts += host.timeouts - counters[3]
+            if host not in self.host_durations:
+                self.host_durations[host] = self.duration
+        if timeouts:
+            self.outcome = 'timeout'
+        elif errors:
+            self.outcome = 'error'
+        else:
+            self.outcome = 'ok'
+
+
+class CommandHooks:
+    """Callbacks run before and after every client command.
+
+    Pass an instance as the C{hooks} argument of a L{Client}, then
+    register callbacks with L{add}.  Each callback is called with a
+    L{CommandEvent}; C{before} callbacks when the command is about to
+    be sent, C{after} callbacks once it is finished, when the
+    duration, bytes and outcome are known.  This is meant for
+    distributed tracing spans and the like.  Exceptions raised by
+    callbacks are written to stderr and otherwise ignored.
+
+    Clients created without C{hooks} don't pay anything for this.
+    """
+
+    def __init__(self):
+        self._before = ()
+        self._after = ()
+        self._lock = threading.Lock()
+
+    def add(self, before=None, after=None):
+        """Register the C{before} and/or C{after} callbacks."""
+        with self._lock:
+            if before is not None:
+                self._before += (before,)
+            if after is not None:
+                self._after += (after,)
+
+    def remove(self, before=None, after=None):
+        """Unregister callbacks previously registered with L{add}."""
+        with self._lock:
+            if before is not None:
+                self._before = tuple(f for f in self._before if f != before)
+            if after is not None:
+                self._after = tuple(f for f in self._after if f != after)
+
+    def command_started(self, event):
+        for hook in self._before:
+            self._call(hook, event)
+
+    def command_finished(self, event):
+        for hook in self._after:
+            self._call(hook, event)
+
+    def _call(self, hook, event):
+        try:
+            hook(event)
+        except Exception as e:
+            sys.stderr.write("MemCached: %s hook failed: %s\n"
+                             % (event.command, e))
+
+
+_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Histogram:
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(_LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(_LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+
+    def snapshot(self):
+        buckets = []
+        total = 0
+        for bound, count in zip(_LATENCY_BUCKETS + (float('inf'),),
+                                self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {'count': total, 'sum': self.sum, 'buckets': buckets}
+
+
+class _MetricsShard:
+    """The metrics recorded by one thread, since the reset number
+    C{generation} of its L{ClientMetrics}."""
+
+    def __init__(self, generation=0):
+        self.generation = generation
+        self.clear()
+
+    def clear(self):
+        self.commands = {}
+        self.servers = {}
+        self.counters = {}
+
+    def incr(self, name, label, n=1):
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = {}
+        counter[label] = counter.get(label, 0) + n
+
+
+class ClientMetrics:
+    """Aggregate metrics of one or more L{Client}s.
+
+    Pass an instance as the C{metrics} argument of a L{Client}.  It
+    records latency histograms per command and per server, bytes
+    sent and received, hits and misses, timeouts, servers marked dead
+    and reconnects.  Every thread records into its own shard without
+    locking; L{snapshot} and L{prometheus_text} merge the shards of
+    all threads.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None or shard.generation != self._generation:
+            # First use by this thread, or first since a reset.
+            with self._lock:
+                shard = self._local.shard = _MetricsShard(self._generation)
+                self._shards.append(shard)
+        return shard
+
+    def command_started(self, event):
+        pass
+
+    def command_finished(self, event):
+        shard = self._shard()
+        histogram = shard.commands.get(event.command)
+        if histogram is None:
+            histogram = shard.commands[event.command] = _Histogram()
+        histogram.observe(event.duration)
+        for host, duration in event.host_durations.items():
+            histogram = shard.servers.get(host.name)
+            if histogram is None:
+                histogram = shard.servers[host.name] = _Histogram()
+            histogram.observe(duration)
+        for host, (sent, received) in event.host_bytes.items():
+            shard.incr('bytes_sent', host.name, sent)
+            shard.incr('bytes_received', host.name, received)
+        if event.hits:
+            shard.incr('hits', event.command, event.hits)
+        if event.misses:
+            shard.incr('misses', event.command, event.misses)
+        if event.outcome != 'ok':
+            shard.incr('errors', event.command)
+
+    def incr(self, name, label='', n=1):
+        """Add C{n} to the counter C{name}, for C{label}."""
+        self._shard().incr(name, label, n)
+
+    def host_event(self, host, name):
+        """Count an event such as C{"mark_dead"} for C{host}."""
+        self._shard().incr(name, host.name)
+
+    def reset(self):
+        """Reset all the metrics to zero.
+
+        The shards of the other threads are dropped rather than cleared
+        under their feet; each thread starts a new one on its next
+        command.
+        """
+        with self._lock:
+            self._generation += 1
+            self._shards = []
+
+    def snapshot(self):
+        """Return the metrics of all threads, merged.
+
+        @return: A dictionary with the keys C{"commands"} and
+        C{"servers"}, mapping command names and server names to
+        latency histograms, and C{"counters"}, mapping counter names to
+        dictionaries of label -> value.  A histogram is a dictionary
+        with the C{"count"} and C{"sum"} of the observed latencies, and
+        C{"buckets"}, a list of (upper bound, cumulative count) tuples.
+        """
+        commands = {}
+        servers = {}
+        counters = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for merged, histograms in ((commands, shard.commands),
+                                       (servers, shard.servers)):
+                for name, histogram in list(histograms.items()):
+                    if name not in merged:
+                        merged[name] = _Histogram()
+                    merged[name].merge(histogram)
+            for name, values in list(shard.counters.items()):
+                counter = counters.setdefault(name, {})
+                for label, value in list(values.items()):
+                    counter[label] = counter.get(label, 0) + value
+        return {
+            'commands': dict((name, histogram.snapshot())
+                             for name, histogram in commands.items()),
+            'servers': dict((name, histogram.snapshot())
+                            for name, histogram in servers.items()),
+            'counters': counters,
+        }
+
+    def prometheus_text(self, prefix='memcache_client'):
+        """Return the metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+
+        def histogram(name, label, histograms, help):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s histogram' % (prefix, name))
+            for value, data in sorted(histograms.items()):
+                value = _prometheus_label(value)
+                for bound, count in data['buckets']:
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_%s_bucket{%s="%s",le="%s"} %d' % (
+                        prefix, name, label, value, le, count))
+                lines.append('%s_%s_sum{%s="%s"} %r' % (
+                    prefix, name, label, value, data['sum']))
+                lines.append('%s_%s_count{%s="%s"} %d' % (
+                    prefix, name, label, value, data['count']))
+
+        histogram('command_duration_seconds', 'command',
+                  snapshot['commands'], 'Latency of client commands.')
+        histogram('server_duration_seconds', 'server',
+                  snapshot['servers'], 'Latency of commands per server.')
+        for name, values in sorted(snapshot['counters'].items()):
+            label = 'command' if name in ('hits', 'misses', 'errors') else (
+                'server' if name in _SERVER_COUNTERS else 'name')
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            for value, count in sorted(values.items()):
+                lines.append('%s_%s_total{%s="%s"} %d' % (
+                    prefix, name, label, _prometheus_label(value), count))
+        return '\n'.join(lines) + '\n'
+
+
+_SERVER_COUNTERS = ('bytes_sent', 'bytes_received', 'timeouts', 'mark_dead',
+                    'connects', 'reconnects')
+
+
+def _prometheus_label(value):
+    """Escape a label value for the Prometheus text format."""
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class SlowLog:
+    """Bounded log of the slowest commands of one or more L{Client}s.
+
+    Pass an instance as the C{slowlog} argument of a L{Client}.
+    Commands taking C{threshold} seconds or more are recorded into a
+    ring buffer holding the last C{maxlen} of them.  With a
+    C{sample_rate}, that fraction of the faster commands is recorded
+    into a second buffer, as a baseline to compare the slow ones with.
+
+    Entries are dictionaries with the keys C{"time"} (wall clock time
+    of the start of the command), C{"command"}, C{"key"} (None for
+    multi-key commands), C{"nkeys"}, C{"value_size"}, C{"servers"},
+    C{"duration"} and C{"outcome"}.
+    """
+
+    def __init__(self, threshold=0.01, maxlen=128, sample_rate=0.0):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self._slow = deque(maxlen=maxlen)
+        self._sampled = deque(maxlen=maxlen)
+
+    def command_started(self, event):
+        pass
+
+    def command_finished(self, event):
+        if event.duration >= self.threshold:
+            self._slow.append(self._entry(event))
+        elif self.sample_rate and random.random() < self.sample_rate:
+            self._sampled.append(self._entry(event))
+
+    def _entry(self, event):
+        key = event.key
+        if isinstance(key, bytes):
+            key = key.decode('utf-8', 'backslashreplace')
+        return {
+            'time': time.time() - event.duration,
+            'command': event.command,
+            'key': key,
+            'nkeys': event.nkeys,
+            'value_size': event.value_size,
+            'servers': [host.name for host in event.hosts],
+            'duration': event.duration,
+            'outcome': event.outcome,
+        }
+
+    def entries(self, sampled=False):
+        """Return the recorded slow commands, oldest first.
+
+        @param sampled: return the sampled fast commands instead.
+        """
+        return list(self._sampled if sampled else self._slow)
+
+    def clear(self):
+        self._slow.clear()
+        self._sampled.clear()
+
+    def dump(self, fileobj, sampled=False):
+        """Write the entries to C{fileobj} as JSON lines."""
+        for entry in self.entries(sampled):
+            fileobj.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+# General statistics which are not summed up across servers.
+_NON_ADDITIVE_STATS = frozenset(('pid', 'uptime', 'time', 'version',
+                                 'libevent', 'pointer_size'))
+
+
+def _parse_stat_value(value):
+    """Convert a statistic value to an int or a float if possible."""
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def _fetch_stats(host, command, timeout):
+    """Run C{command} on a new connection to C{host}, return the stats."""
+    s = host._connect_socket(timeout)
+    try:
+        s.sendall(command + b'\r\n')
+        buf = b''
+        while not (buf == b'END\r\n' or buf.endswith(b'\r\nEND\r\n')):
+            data = s.recv(65536)
+            if not data:
+                raise OSError('connection closed')
+            buf += data
+            if buf.startswith(b'ERROR') or buf.startswith(b'CLIENT_ERROR'):
+                raise OSError(buf.strip().decode('ascii', 'replace'))
+    finally:
+        s.close()
+    stats = {}
+    for line in buf.decode('ascii', 'replace').split('\r\n'):
+        parts = line.split(' ', 2)
+        if len(parts) == 3 and parts[0] == 'STAT':
+            stats[parts[1]] = _parse_stat_value(parts[2])
+    return stats
+
+
+class _Encoded:
+    """A value as received from memcached, see L{LazyResults}."""
+
+    __slots__ = ('flags', 'buf')
+
+    def __init__(self, flags, buf):
+        self.flags = flags
+        self.buf = buf
+
+
+class LazyResults(MutableMapping):
+    """Mapping returned by L{Client.get_multi} with C{lazy=True}.
+
+    The values are kept as the bytes and flags received from memcached,
+    and only decompressed and unpickled when first accessed; the result
+    is memoized.  Iterating over the keys, C{len} and C{in} don't decode
+    anything, so decoding costs are proportional to the values used.
+    """
+
+    def __init__(self, decode):
+        self._decode = decode
+        self._items = {}
+
+    def _store_encoded(self, key, flags, buf):
+        self._items[key] = _Encoded(flags, buf)
+
+    def __getitem__(self, key):
+        value = self._items[key]
+        if type(value) is _Encoded:
+            value = self._items[key] = self._decode(value.flags, value.buf)
+        return value
+
+    def __setitem__(self, key, value):
+        self._items[key] = value
+
+    def __delitem__(self, key):
+        del self._items[key]
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        decoded = sum(1 for value in self._items.values()
+                      if type(value) is not _Encoded)
+        return '<LazyResults of %d keys, %d decoded>' % (
+            len(self._items), decoded)
+
+
+KeyMetadata = namedtuple('KeyMetadata', ('server', 'key', 'exp', 'size',
+                                         'last_access', 'slab_class'))
+KeyMetadata.__doc__ = """Metadata of one item, see L{Client.iter_metadump}.
+
+The C{key} is a byte string as stored on the C{server}, C{exp} and
+C{last_access} are Unix timestamps (C{exp} is -1 for items which never
+expire) and C{size} is the size in bytes of the whole item.
+"""
+
+
+def _metadump(host, command, timeout, stop=None):
+    """Yield the KeyMetadata of every item dumped by C{command}.
+
+    The output is parsed as it is received, so memory use doesn't grow
+    with the number of items.
+    """
+    s = host._connect_socket(timeout)
+    try:
+        s.sendall(command + b'\r\n')
+        buf = b''
+        while stop is None or not stop.is_set():
+            data = s.recv(65536)
+            if not data:
+                raise OSError('connection closed during metadump')
+            buf += data
+            lines = buf.split(b'\r\n')
+            buf = lines.pop()
+            for line in lines:
+                if line == b'END':
+                    return
+                if not line.startswith(b'key='):
+                    raise _Error('%s: %s' % (
+                        host.name, line.decode('ascii', 'replace')))
+                fields = dict(field.split(b'=', 1) for field in line.split())
+                yield KeyMetadata(host.name, unquote_to_bytes(fields[b'key']),
+                                  int(fields[b'exp']), int(fields[b'size']),
+                                  int(fields[b'la']), int(fields[b'cls']))
+    finally:
+        s.close()
+
+
+class ClusterStats:
+    """Statistics of all the servers of a client, at one point in time.
+
+    Returned by L{Client.get_cluster_stats}.
+
+    @ivar nodes: dictionary mapping server names to dictionaries of
+    statistics, with the values converted to ints and floats.
+    @ivar errors: dictionary mapping the names of the servers which
+    failed to answer in time to the error.
+    @ivar totals: the numeric statistics summed up across servers,
+    plus C{hit_ratio}, the cluster-wide fraction of gets that hit.
+    @ivar timestamp: when the statistics were collected, in seconds
+    (from C{time.monotonic}).
+    """
+
+    # Counters for which rates_since() computes per-second rates.
+    RATE_STATS = ('cmd_get', 'cmd_set', 'get_hits', 'get_misses',
+                  'evictions', 'bytes_read', 'bytes_written',
+                  'total_connections', 'total_items')
+
+    def __init__(self, nodes, errors, timestamp):
+        self.nodes = nodes
+        self.errors = errors
+        self.timestamp = timestamp
+        totals = {}
+        for stats in nodes.values():
+            for name, value in stats.items():
+                if name not in _NON_ADDITIVE_STATS and isinstance(value, (int, float)):
+                    totals[name] = totals.get(name, 0) + value
+        gets = totals.get('get_hits', 0) + totals.get('get_misses', 0)
+        if gets:
+            totals['hit_ratio'] = float(totals['get_hits']) / gets
+        self.totals = totals
+
+    def rates_since(self, previous, stats=None):
+        """Compute per-second rates since the C{previous} snapshot.
+
+        Servers restarted in between (counters going backwards) and
+        servers missing from either snapshot are left out.
+
+        @param previous: an older L{ClusterStats}.
+        @param stats: names of the counters, by default L{RATE_STATS}.
+        @return: A tuple of a dictionary mapping server names to
+        dictionaries of rates, and a dictionary of the rates summed up
+        across servers.
+        """
+        elapsed = self.timestamp - previous.timestamp
+        if elapsed <= 0:
+            raise ValueError('previous snapshot is not older')
+        node_rates = {}
+        totals = {}
+        for name, current in self.nodes.items():
+            before = previous.nodes.get(name)
+            if before is None:
+                continue
+            rates = {}
+            for stat in stats or self.RATE_STATS:
+                if stat not in current or stat not in before:
+                    continue
+                delta = current[stat] - before[stat]
+                if delta < 0:
+                    rates = None
+                    break
+                rates[stat] = delta / elapsed
+            if rates is None:
+                continue
+            node_rates[name] = rates
+            for stat, rate in rates.items():
+                totals[stat] = totals.get(stat, 0) + rate
+        return node_rates, totals
+
+
+class _Deadline:
+    """Context manager returned by L{Client.deadline}."""
+
+    __slots__ = ('_cell', '_timeout', '_previous')
+
+    def __init__(self, cell, timeout):
+        self._cell = cell
+        self._timeout = timeout
+
+    def __enter__(self):
+        self._previous = self._cell[0]
+        deadline = time.monotonic() + self._timeout
+        if self._previous is not None:
+            deadline = min(deadline, self._previous)
+        self._cell[0] = deadline
+        return self
+
+    def __exit__(self, *exc_info):
+        self._cell[0] = self._previous
+
+
+def _same_key(key):
+    # The default key_encoder.  A single function rather than one per
+    # thread, so that the settings of the threads compare equal, see
+    # _WorkerClient.
+    return key
+
+
+def _write_all(servers, write):
+    """Call C{write(server)} for each of C{servers}, primary first.
+
+    @return: the result of the primary server.
+    """
+    result = write(servers[0])
+    for server in servers[1:]:
+        write(server)
+    return result
 
 
 class Client(threading.local):
@@ -131,8 +1880,9 @@ class Client(threading.local):
     _FLAG_LONG = 1 << 2
     _FLAG_COMPRESSED = 1 << 3
     _FLAG_TEXT = 1 << 4
-
-    _SERVER_RETRIES = 10  # how many times to try finding a free server.
+    _FLAG_PICKLE_BUFFERS = 1 << 5
+    _FLAG_NUMPY = 1 << 6
+    _FLAG_BYTEARRAY = 1 << 7
 
     # exceptions for Client
     class MemcachedKeyError(Exception):
@@ -160,14 +1910,27 @@ class Client(threading.local):
                  server_max_key_length=None, server_max_value_length=None,
                  dead_retry=_DEAD_RETRY, socket_timeout=_SOCKET_TIMEOUT,
                  cache_cas=False, flush_on_reconnect=0, check_keys=True,
-                 key_encoder=None):
+                 key_encoder=None, dead_retry_max=_DEAD_RETRY_MAX,
+                 dead_retry_jitter=_DEAD_RETRY_JITTER, failure_threshold=1,
+                 error_rate_threshold=None, health_checker=None,
+                 replication_factor=1, hedge_after=None,
+                 hot_key_detector=None, metrics=None, hooks=None,
+                 slowlog=None, connect_timeout=None, dns_ttl=_DNS_TTL,
+                 write_behind=None, auto_batch=None,
+                 preconnect_on_fork=False, namespace_ttl=_NAMESPACE_TTL,
+                 negative_cache=None, compression_pool=None,
+                 pickle_buffers=None, return_memoryview=False):
         """Create a new Client object with the given list of servers.
 
         @param servers: C{servers} is passed to L{set_servers}.
         @param debug: whether to display error messages when a server
         can't be contacted.
         @param pickleProtocol: number to mandate protocol used by
-        (c)Pickle.
+        (c)Pickle.  The default of 0 can be read by any client, even
+        on Python 2; C{pickle.HIGHEST_PROTOCOL} is a lot faster and
+        more compact.  The flags stored with values don't depend on
+        the protocol, so clients using different protocols read each
+        other's values.
         @param pickler: optional override of default Pickler to allow
         subclassing.
         @param unpickler: optional override of default Unpickler to
@@ -178,7 +1941,8 @@ class Client(threading.local):
         @param pid: optional persistent_id function to call on pickle
         storing.  Useful for cPickle since subclassing isn't allowed.
         @param dead_retry: number of seconds before retrying a
-        blacklisted server. Default to 30 s.
+        blacklisted server. Default to 30 s.  Each time the retry
+        fails this delay is doubled, up to C{dead_retry_max}.
         @param socket_timeout: timeout in seconds for all calls to a
         server. Defaults to 3 seconds.
         @param cache_cas: (default False) If true, cas operations will
@@ -207,12 +1971,131 @@ class Client(threading.local):
         be called to encode keys before they are checked and used. It will
         be expected to take one parameter (the key) and return a new encoded
         key as a result.
+        @param dead_retry_max: (default 300) Upper bound in seconds for
+        the exponential backoff applied to a server that keeps failing.
+        @param dead_retry_jitter: (default 0.1) Fraction of random
+        jitter added to each backoff, so that clients don't all retry
+        a recovering server at the same instant.
+        @param failure_threshold: (default 1) Number of consecutive
+        failures after which a server is considered dead.
+        @param error_rate_threshold: (default None) If set, a server is
+        also considered dead once this fraction (0.0 - 1.0) of its
+        recent requests have failed.
+        @param health_checker: (default None) A L{HealthChecker} which
+        probes dead and idle servers in a background thread, so that
+        requests don't pay for reconnecting to a server that is still
+        down.  The same checker can be shared between clients.
+        @param replication_factor: (default 1) Number of distinct
+        servers every key is stored on.  Writes (L{set}, L{set_multi},
+        L{delete}, L{incr}, ...) go to all of them, reads try the
+        primary server first and fall back to the replicas on a miss
+        or an error.  Each server applies L{incr} and L{decr} on its
+        own, so a replica which missed one, e.g. while it was down,
+        keeps a different count until the key is set again.
+        @param hedge_after: (default None) With replication, if the
+        primary server hasn't answered a L{get} after this many
+        seconds, the same request is also sent to a replica and the
+        first answer wins.
+        @param hot_key_detector: (default None) A L{HotKeyDetector}
+        which tracks the most frequently read keys and serves them
+        from a short-lived local copy.  See L{get_hot_keys}.
+        @param metrics: (default None) A L{ClientMetrics} recording
+        latencies, bytes, hits and misses and server errors.  Unlike
+        L{stats}, it is shared by all the threads using the client.
+        @param hooks: (default None) A L{CommandHooks} whose callbacks
+        are run before and after every command.
+        @param slowlog: (default None) A L{SlowLog} recording the
+        commands slower than its threshold.  See L{get_slowlog}.
+        @param connect_timeout: (default None) Timeout in seconds for
+        connecting to a server, by default the same as C{socket_timeout},
+        which then only applies to sends and reads.  When a server name
+        resolves to several addresses, a new one is tried every 0.25
+        seconds without giving up on the previous ones, and the first
+        to connect is used.
+        @param dns_ttl: (default 60) Number of seconds server addresses
+        are cached for, so that reconnects don't all resolve the names
+        again.  The cache is shared by all clients; 0 disables it.
+        @param write_behind: (default None) A L{WriteBehindQueue}
+        sending the writes of L{set_async} and L{delete_async} from a
+        background thread.
+        @param auto_batch: (default None) An L{AutoBatcher} which
+        collects the L{get}s made concurrently by several threads into
+        multi-gets.  See also L{batch} and L{aget}.
+        @param preconnect_on_fork: (default False) In the child
+        process after a fork, connect to all the servers right away
+        with L{preconnect}, so that its first requests don't pay for
+        it.  The connections inherited from the parent are never
+        used by the child, regardless of this setting.
+        @param namespace_ttl: (default 1) Number of seconds the
+        versions of namespaces are cached by each thread, see
+        L{namespace_version}.  Other clients see an invalidation once
+        their cached version expires.
+        @param negative_cache: (default None) A L{NegativeCache}
+        remembering the keys L{get} and L{get_multi} didn't find, so
+        that they are answered locally for a while.  It can be shared
+        between clients.
+        @param compression_pool: (default None) A L{CompressionPool}
+        in which L{set_multi} and L{get_multi} compress and decompress
+        large values, in parallel with each other and with the network.
+        @param pickle_buffers: (default None) If set, values are pickled
+        with protocol 5 or above, and their C{bytes}, C{bytearray} and
+        C{pickle.PickleBuffer} members (such as NumPy arrays) of at
+        least this many bytes are stored out-of-band: they are appended
+        to the pickle as separate segments, sent without being copied,
+        and read back as views of the receive buffer.  Those values
+        can only be read by clients of this version.
+
+        When NumPy is installed, C{numpy.ndarray} values (of plain, non
+        object dtypes) aren't pickled but stored as their raw data
+        behind a short header, and read back as arrays sharing the
+        received buffer.
+        @param return_memoryview: (default False) If set, plain bytes
+        values (including those stored from a C{memoryview},
+        C{array.array} or C{mmap}) are read into a buffer and returned
+        as a C{memoryview} of it, rather than copied into C{bytes}.
+        C{bytearray} values are always read back as C{bytearray}.
         """
         super().__init__()
         self.debug = debug
         self.dead_retry = dead_retry
+        self.dead_retry_max = dead_retry_max
+        self.dead_retry_jitter = dead_retry_jitter
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.health_checker = health_checker
+        self.replication_factor = max(1, replication_factor)
+        self.hedge_after = hedge_after
+        self.hot_key_detector = hot_key_detector
+        self.negative_cache = negative_cache
+        self.compression_pool = compression_pool
+        # Local caches told about every write, see _invalidate_local().
+        self._local_caches = tuple(c for c in (hot_key_detector,
+                                               negative_cache)
+                                   if c is not None)
+        self.metrics = metrics
+        self.hooks = hooks
+        self.slowlog = slowlog
+        self.write_behind = write_behind
+        if write_behind is not None:
+            write_behind._attach(self)
+        self.auto_batch = auto_batch
+        if auto_batch is not None:
+            auto_batch._attach(self)
+        self.preconnect_on_fork = preconnect_on_fork
+        if preconnect_on_fork:
+            _fork_listeners.add(self)
+        self.namespace_ttl = namespace_ttl
+        # namespace -> (expiry, version), see namespace_version().
+        self._namespace_versions = {}
+        # Objects notified of every command, see _start_event().
+        self._observers = tuple(o for o in (metrics, hooks, slowlog)
+                                if o is not None)
         self.socket_timeout = socket_timeout
+        self.connect_timeout = connect_timeout
+        self.dns_ttl = dns_ttl
         self.flush_on_reconnect = flush_on_reconnect
+        # Deadline of the current thread's commands, see deadline().
+        self._deadline = [None]
         self.set_servers(servers)
         self.stats = {}
         self.cache_cas = cache_cas
@@ -227,10 +2110,11 @@ class Client(threading.local):
         self.decompressor = decompressor
         self.persistent_load = pload
         self.persistent_id = pid
+        self.pickle_buffers = pickle_buffers
+        self.return_memoryview = return_memoryview
         self.server_max_key_length = server_max_key_length
         if key_encoder is None:
-            def key_encoder(key):
-                return key
+            key_encoder = _same_key
         self.key_encoder = key_encoder
         if self.server_max_key_length is None:
             self.server_max_key_length = SERVER_MAX_KEY_LENGTH
@@ -292,11 +2176,29 @@ class Client(threading.local):
             C{weight} is an integer weight value.
 
         """
+        servers = list(servers)
+        # Compared by the clients of background threads, see _WorkerClient.
+        self._server_specs = servers
         self.servers = [_Host(s, self.debug, dead_retry=self.dead_retry,
                               socket_timeout=self.socket_timeout,
-                              flush_on_reconnect=self.flush_on_reconnect)
+                              flush_on_reconnect=self.flush_on_reconnect,
+                              dead_retry_max=self.dead_retry_max,
+                              dead_retry_jitter=self.dead_retry_jitter,
+                              failure_threshold=self.failure_threshold,
+                              error_rate_threshold=self.error_rate_threshold,
+                              connect_timeout=self.connect_timeout,
+                              dns_ttl=self.dns_ttl)
                         for s in servers]
+        # Shared by all the hosts, bumped whenever one of them changes
+        # between dead and alive so the failover table gets rebuilt.
+        self._topology = [0]
+        for s in self.servers:
+            s._topology = self._topology
+            s._deadline = self._deadline
+            s.metrics = self.metrics
         self._init_buckets()
+        if self.health_checker is not None:
+            self.health_checker.register(self.servers)
 
     def get_stats(self, stat_args=None):
         """Get statistics from each of the servers.
@@ -371,6 +2273,128 @@ class Client(threading.local):
                     serverData[slab[0]][slab[1]] = item[2]
         return data
 
+    def get_cluster_stats(self, stat_args=None, timeout=1.0):
+        """Collect the statistics of all the servers concurrently.
+
+        Every server is queried on a new connection of its own, from
+        its own thread, so that slow or dead servers don't hold up the
+        others nor the connections used for requests.
+
+        @param stat_args: Additional arguments to pass to the memcache
+            "stats" command.
+        @param timeout: (default 1.0) Deadline in seconds for the whole
+            call.  Servers which haven't answered by then are listed in
+            the C{errors} of the result.
+        @return: A L{ClusterStats}.  Pass an older one to its
+            L{ClusterStats.rates_since} to get per-second rates.
+        """
+        command = b'stats'
+        if stat_args:
+            command += b' ' + stat_args.encode('ascii')
+        deadline = time.monotonic() + timeout
+        results = {}
+
+        def fetch(host):
+            try:
+                results[host.name] = _fetch_stats(
+                    host, command, max(deadline - time.monotonic(), 0.001))
+            except OSError as msg:
+                results[host.name] = msg
+
+        threads = []
+        for host in self.servers:
+            thread = threading.Thread(target=fetch, args=(host,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        timestamp = time.monotonic()
+
+        nodes = {}
+        errors = {}
+        for host in self.servers:
+            result = results.get(host.name)
+            if result is None:
+                errors[host.name] = 'timed out'
+            elif isinstance(result, Exception):
+                errors[host.name] = str(result)
+            else:
+                nodes[host.name] = result
+        return ClusterStats(nodes, errors, timestamp)
+
+    def iter_metadump(self, slab_classes=None, parallel=False,
+                      queue_size=1000, timeout=None):
+        """Enumerate the keys of every server with C{lru_crawler metadump}.
+
+        This is meant for cache analysis and migrations.  It needs
+        memcached 1.4.31 or later, and items may be missed or
+        reported twice if they are modified during the dump.  Each
+        server is dumped on a connection of its own, and its output is
+        parsed as it streams in, so memory use stays flat whatever the
+        number of items.
+
+        @param slab_classes: (default None) Dump only the items of
+            these slab class ids, instead of all of them.
+        @param parallel: (default False) Dump all the servers at the
+            same time from background threads.  Items of different
+            servers are then interleaved.
+        @param queue_size: (default 1000) With C{parallel}, the maximum
+            number of items buffered between the threads and the
+            caller.
+        @param timeout: (default None) Socket timeout for the dump
+            connections, by default the client's socket_timeout.
+        @return: A generator of L{KeyMetadata}.  Errors from a server
+            are raised from the generator.
+        """
+        if slab_classes is None:
+            command = b'lru_crawler metadump all'
+        else:
+            command = b'lru_crawler metadump ' + ','.join(
+                str(int(c)) for c in slab_classes).encode('ascii')
+        if not parallel:
+            for host in self.servers:
+                for item in _metadump(host, command, timeout):
+                    yield item
+            return
+
+        items = queue.Queue(queue_size)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def dump(host):
+            try:
+                for item in _metadump(host, command, timeout, stop):
+                    put(item)
+            except Exception as e:
+                put(e)
+            put(done)
+
+        for host in self.servers:
+            thread = threading.Thread(target=dump, args=(host,))
+            thread.daemon = True
+            thread.start()
+        try:
+            running = len(self.servers)
+            while running:
+                item = items.get()
+                if item is done:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+
     def quit_all(self) -> None:
         '''Send a "quit" command to all servers and wait for the connection to close.'''
         for s in self.servers:
@@ -421,16 +2445,93 @@ class Client(threading.local):
         else:
             self.stats[func] += 1
 
+    def deadline(self, timeout):
+        """Bound the total time of the commands run in a C{with} block::
+
+            with mc.deadline(0.05):
+                user = mc.get('user:42')
+                friends = mc.get_multi(user.friend_keys)
+
+        All the connects, sends and reads of the block share a budget
+        of C{timeout} seconds, whereas C{socket_timeout} applies to
+        each socket call on its own.  Once the budget is spent,
+        commands fail as if the servers were unreachable: L{get}
+        returns the default, L{set} returns 0, L{get_multi} returns the
+        values read so far, and so on.  The servers are not marked
+        dead for it, only their connections are closed, as responses
+        may still be pending on them.
+
+        The deadline applies to the calling thread only.  A nested
+        deadline can shorten the outer one, but not extend it.  Most
+        commands also take a C{timeout} argument, which is a shortcut
+        for running them in such a block.
+        """
+        return _Deadline(self._deadline, timeout)
+
+    def get_hot_keys(self):
+        """Return the keys detected as hot by the C{hot_key_detector}.
+
+        @return: A list of (key, estimated reads) tuples, hottest
+        first.  Keys are returned as sent to the server.
+        """
+        if self.hot_key_detector is None:
+            return []
+        return self.hot_key_detector.hot_keys()
+
+    def get_slowlog(self, sampled=False):
+        """Return the commands recorded by the C{slowlog}.
+
+        @param sampled: return the sampled fast commands instead of the
+        slow ones.
+        @return: A list of dictionaries, oldest first.  See L{SlowLog}.
+        """
+        if self.slowlog is None:
+            return []
+        return self.slowlog.entries(sampled)
+
+    def _invalidate_local(self, key):
+        """Drop what the local caches know about C{key}."""
+        if isinstance(key, tuple):
+            key = key[1]
+        for cache in self._local_caches:
+            cache.invalidate(key)
+
+    def _start_event(self, command, hosts, nkeys=1, key=None):
+        event = CommandEvent(command, hosts, nkeys, key)
+        for observer in self._observers:
+            observer.command_started(event)
+        return event
+
+    def _finish_event(self, event, hits=0, misses=0):
+        event.finish(hits, misses)
+        for observer in self._observers:
+            observer.command_finished(event)
+
     def forget_dead_hosts(self):
         """Reset every host in the pool to an "alive" state."""
         for s in self.servers:
-            s.deaduntil = 0
+            s.mark_alive()
 
     def _init_buckets(self):
         self.buckets = []
         for server in self.servers:
             for i in range(server.weight):
                 self.buckets.append(server)
+        self._failover_buckets = None
+        self._failover_version = -1
+
+    def _get_failover_buckets(self):
+        """Return the buckets of all servers that are not known dead.
+
+        Keys whose server is dead are remapped onto this table, which
+        is only rebuilt when a server changes between dead and alive.
+        """
+        if self._failover_version != self._topology[0]:
+            self._failover_version = self._topology[0]
+            self._failover_buckets = [
+                server for server in self.buckets
+                if server._breaker.state != _CircuitBreaker.OPEN]
+        return self._failover_buckets
 
     def _get_server(self, key):
         if isinstance(key, tuple):
@@ -441,22 +2542,174 @@ class Client(threading.local):
         if not self.buckets:
             return None, None
 
-        for i in range(Client._SERVER_RETRIES):
-            server = self.buckets[serverhash % len(self.buckets)]
+        server = self.buckets[serverhash % len(self.buckets)]
+        if server.connect():
+            return server, key
+
+        # Every failed connect below marks another server dead, so
+        # this is bounded by the number of servers.
+        for i in range(len(self.servers)):
+            buckets = self._get_failover_buckets()
+            if not buckets:
+                break
+            server = buckets[serverhash % len(buckets)]
             if server.connect():
-                # print("(using server %s)" % server,)
                 return server, key
-            serverhash = str(serverhash) + str(i)
-            if isinstance(serverhash, str):
-                serverhash = serverhash.encode('ascii')
-            serverhash = serverHashFunction(serverhash)
         return None, None
 
+    def _get_replica_servers(self, key):
+        """Return up to C{replication_factor} distinct live servers.
+
+        The first one is the server L{_get_server} picks, the replicas
+        are the next distinct servers following the key's bucket.
+        """
+        if isinstance(key, tuple):
+            serverhash, key = key
+        else:
+            serverhash = serverHashFunction(key)
+
+        server, key = self._get_server((serverhash, key))
+        if not server:
+            return [], None
+        servers = [server]
+        nbuckets = len(self.buckets)
+        start = serverhash % nbuckets
+        for i in range(1, nbuckets):
+            if len(servers) >= self.replication_factor:
+                break
+            server = self.buckets[(start + i) % nbuckets]
+            if server not in servers and server.connect():
+                servers.append(server)
+        return servers, key
+
+    def _get_write_servers(self, key):
+        """Return the servers a write to C{key} goes to, primary first."""
+        if self.replication_factor > 1:
+            return self._get_replica_servers(key)
+        server, key = self._get_server(key)
+        if not server:
+            return [], None
+        return [server], key
+
     def disconnect_all(self):
         for s in self.servers:
             s.close_socket()
 
-    def delete_multi(self, keys, time=None, key_prefix='', noreply=False):
+    def preconnect(self, timeout=None):
+        """Connect to all the servers that aren't connected yet.
+
+        The servers are connected in parallel, so this takes about as
+        long as the slowest one.
+
+        @param timeout: (default None) Bound in seconds on the total
+        time, see L{deadline}.
+        @return: the number of servers connected.
+        """
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.preconnect()
+        servers = self.servers
+        threads = [threading.Thread(target=s._get_socket) for s in servers[1:]]
+        for thread in threads:
+            thread.start()
+        if servers:
+            servers[0]._get_socket()
+        for thread in threads:
+            thread.join()
+        return sum(1 for s in servers if s.socket is not None)
+
+    def _after_fork(self):
+        if self.preconnect_on_fork:
+            self.preconnect()
+
+    def _namespace_version_key(self, namespace):
+        return _NAMESPACE_VERSION_PREFIX + self._encode_key(namespace)
+
+    def namespace_version(self, namespace):
+        """Return the current version of C{namespace}.
+
+        L{get}, L{set}, L{delete} and their C{_multi} versions take a
+        C{namespace} argument.  The keys of a namespace are stored with
+        its name and version as prefix, so that L{invalidate_namespace}
+        can make all of them unreachable at once by incrementing the
+        version, which is stored in memcached under
+        C{"__ns:" + namespace}.  The old values are left to expire or
+        be evicted.  Keys starting with C{"__ns:"} are therefore
+        reserved, and plain keys shouldn't look like namespaced ones,
+        C{namespace + ":" + version + ":" + key}.
+
+        The version is created on first use, from the current time in
+        microseconds, so that a namespace whose version got evicted
+        doesn't get back to an older one.  It is then cached by the
+        calling thread for C{namespace_ttl} seconds.
+
+        @return: the version, or None if it couldn't be read.
+        """
+        now = time.monotonic()
+        cached = self._namespace_versions.get(namespace)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        key = self._namespace_version_key(namespace)
+        version = self.get(key)
+        if version is None:
+            initial = int(time.time() * 1000000)
+            if self.add(key, initial):
+                version = initial
+            else:
+                # Created by another client in the meantime, or the
+                # server is down.
+                version = self.get(key)
+                if version is None:
+                    return None
+        if self.namespace_ttl:
+            self._namespace_versions[namespace] = (
+                now + self.namespace_ttl, version)
+        return version
+
+    def _namespace_prefix(self, namespace):
+        """Return the key prefix of the current version of C{namespace}."""
+        version = self.namespace_version(namespace)
+        if version is None:
+            return None
+        return self._encode_key(namespace) + b':%d:' % version
+
+    def _namespaced_key(self, key, namespace):
+        prefix = self._namespace_prefix(namespace)
+        if prefix is None:
+            return None
+        key = self._encode_key(self.key_encoder(key))
+        if isinstance(key, tuple):
+            return (key[0], prefix + self._key_bytes(key[1]))
+        return prefix + self._key_bytes(key)
+
+    def _key_bytes(self, key):
+        """Turn the int / long keys set_multi supports into bytes."""
+        if isinstance(key, bytes):
+            return key
+        if key is None:
+            self.check_key(key)
+        return str(key).encode('utf8')
+
+    def invalidate_namespace(self, namespace):
+        """Make all the keys of C{namespace} unreachable with one incr.
+
+        See L{namespace_version}.
+
+        @return: the new version, or None if the server couldn't be
+        reached.
+        """
+        self._namespace_versions.pop(namespace, None)
+        key = self._namespace_version_key(namespace)
+        version = self.incr(key)
+        if version is None:
+            # Never used or evicted, any new version will do.
+            version = int(time.time() * 1000000)
+            if not self.add(key, version):
+                return self.incr(key)
+        return version
+
+    def delete_multi(self, keys, time=None, key_prefix='', noreply=False, timeout=None,
+                     namespace=None):
         """Delete multiple keys in the memcache doing just one query.
 
         >>> notset_keys = mc.set_multi({'a1' : 'val1', 'a2' : 'val2'})
@@ -481,13 +2734,51 @@ class Client(threading.local):
             reply.
         @return: 1 if no failure in communication with any memcacheds.
         @rtype: int
+
+        @param timeout: (default None) Bound in seconds on the
+        total time of the call, see L{deadline}.
+        @param namespace: (default None) Namespace of the keys, see
+        L{namespace_version}.
         """
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.delete_multi(keys, time, key_prefix, noreply,
+                                         namespace=namespace)
+        if namespace is not None:
+            prefix = self._namespace_prefix(namespace)
+            if prefix is None:
+                return 0
+            key_prefix = prefix + self._encode_key(key_prefix)
 
         self._statlog('delete_multi')
 
+        if self.replication_factor > 1:
+            keys = list(keys)
+        rc = 1
+        for replica in range(self.replication_factor):
+            if not self._delete_multi(keys, time, key_prefix, noreply,
+                                      replica):
+                rc = 0
+        return rc
+
+    def _delete_multi(self, keys, time, key_prefix, noreply, replica):
         server_keys, prefixed_to_orig_key = self._map_and_prefix_keys(
-            keys, key_prefix)
+            keys, key_prefix, replica)
+        if self._local_caches:
+            for key in prefixed_to_orig_key:
+                self._invalidate_local(key)
+        if not self._observers:
+            return self._delete_multi_from_servers(time, noreply, server_keys)
+        event = self._start_event('delete_multi', list(server_keys),
+                                  len(prefixed_to_orig_key))
+        try:
+            return self._delete_multi_from_servers(time, noreply, server_keys,
+                                                   event)
+        finally:
+            self._finish_event(event)
 
+    def _delete_multi_from_servers(self, time, noreply, server_keys,
+                                   event=None):
         # send out all requests on each server before reading anything
         dead_servers = []
 
@@ -528,40 +2819,65 @@ class Client(threading.local):
                     msg = msg[1]
                 server.mark_dead(msg)
                 rc = 0
+            if event is not None:
+                event.host_done(server)
         return rc
 
-    def delete(self, key, noreply=False):
+    def delete(self, key, noreply=False, timeout=None, namespace=None):
         '''Deletes a key from the memcache.
 
         @return: Nonzero on success.
         @param noreply: optional parameter instructs the server to not send the
             reply.
         @rtype: int
+        @param timeout: (default None) Bound in seconds on the
+        total time of the call, see L{deadline}.
+        @param namespace: (default None) Namespace of the key, see
+        L{namespace_version}.
         '''
-        key = self._encode_key(self.key_encoder(key))
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.delete(key, noreply, namespace=namespace)
+        if namespace is not None:
+            key = self._namespaced_key(key, namespace)
+            if key is None:
+                return 0
+        else:
+            key = self._encode_key(self.key_encoder(key))
         if self.do_check_key:
             self.check_key(key)
-        server, key = self._get_server(key)
-        if not server:
+        if self._local_caches:
+            self._invalidate_local(key)
+        servers, key = self._get_write_servers(key)
+        if not servers:
             return 0
         self._statlog('delete')
         fullcmd = self._encode_cmd('delete', key, None, noreply)
 
+        def _delete(server):
+            try:
+                server.send_cmd(fullcmd)
+                if noreply:
+                    return 1
+                line = server.readline()
+                if line and line.strip() == b'DELETED':
+                    return 1
+                self.debuglog('delete expected DELETED, got: {!r}'.format(line))
+            except OSError as msg:
+                if isinstance(msg, tuple):
+                    msg = msg[1]
+                server.mark_dead(msg)
+            return 0
+
+        if not self._observers:
+            return _write_all(servers, _delete)
+        event = self._start_event('delete', servers, key=key)
         try:
-            server.send_cmd(fullcmd)
-            if noreply:
-                return 1
-            line = server.readline()
-            if line and line.strip() == b'DELETED':
-                return 1
-            self.debuglog('delete expected DELETED, got: {!r}'.format(line))
-        except OSError as msg:
-            if isinstance(msg, tuple):
-                msg = msg[1]
-            server.mark_dead(msg)
-        return 0
+            return _write_all(servers, _delete)
+        finally:
+            self._finish_event(event)
 
-    def touch(self, key, time=0, noreply=False):
+    def touch(self, key, time=0, noreply=False, timeout=None):
         '''Updates the expiration time of a key in memcache.
 
         @return: Nonzero on success.
@@ -573,31 +2889,47 @@ class Client(threading.local):
         @param noreply: optional parameter instructs the server to not send the
             reply.
         @rtype: int
+        @param timeout: (default None) Bound in seconds on the
+        total time of the call, see L{deadline}.
         '''
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.touch(key, time, noreply)
         key = self._encode_key(self.key_encoder(key))
         if self.do_check_key:
             self.check_key(key)
-        server, key = self._get_server(key)
-        if not server:
+        if self._local_caches:
+            self._invalidate_local(key)
+        servers, key = self._get_write_servers(key)
+        if not servers:
             return 0
         self._statlog('touch')
         fullcmd = self._encode_cmd('touch', key, str(time), noreply)
 
+        def _touch(server):
+            try:
+                server.send_cmd(fullcmd)
+                if noreply:
+                    return 1
+                line = server.readline()
+                if line and line.strip() in [b'TOUCHED']:
+                    return 1
+                self.debuglog('touch expected TOUCHED, got: {!r}'.format(line))
+            except OSError as msg:
+                if isinstance(msg, tuple):
+                    msg = msg[1]
+                server.mark_dead(msg)
+            return 0
+
+        if not self._observers:
+            return _write_all(servers, _touch)
+        event = self._start_event('touch', servers, key=key)
         try:
-            server.send_cmd(fullcmd)
-            if noreply:
-                return 1
-            line = server.readline()
-            if line and line.strip() in [b'TOUCHED']:
-                return 1
-            self.debuglog('touch expected TOUCHED, got: {!r}'.format(line))
-        except OSError as msg:
-            if isinstance(msg, tuple):
-                msg = msg[1]
-            server.mark_dead(msg)
-        return 0
+            return _write_all(servers, _touch)
+        finally:
+            self._finish_event(event)
 
-    def incr(self, key, delta=1, noreply=False):
+    def incr(self, key, delta=1, noreply=False, timeout=None):
         """Increment value for C{key} by C{delta}
 
         Sends a command to the server to atomically increment the
@@ -619,6 +2951,10 @@ class Client(threading.local):
         Overflow on server is not checked.  Be aware of values
         approaching 2**32.  See L{decr}.
 
+        With a C{replication_factor}, the primary's new value is
+        returned; the replicas may have diverged from it after a
+        failure, see L{__init__}.
+
         @param delta: Integer amount to increment by (should be zero
         or greater).
 
@@ -627,10 +2963,16 @@ class Client(threading.local):
 
         @return: New value after incrementing, no None for noreply or error.
         @rtype: int
+
+        @param timeout: (default None) Bound in seconds on the
+        total time of the call, see L{deadline}.
         """
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.incr(key, delta, noreply)
         return self._incrdecr("incr", self.key_encoder(key), delta, noreply)
 
-    def decr(self, key, delta=1, noreply=False):
+    def decr(self, key, delta=1, noreply=False, timeout=None):
         """Decrement value for C{key} by C{delta}
 
         Like L{incr}, but decrements.  Unlike L{incr}, underflow is
@@ -645,33 +2987,82 @@ class Client(threading.local):
 
         @return: New value after decrementing,  or None for noreply or error.
         @rtype: int
+
+        @param timeout: (default None) Bound in seconds on the
+        total time of the call, see L{deadline}.
         """
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.decr(key, delta, noreply)
         return self._incrdecr("decr", self.key_encoder(key), delta, noreply)
 
     def _incrdecr(self, cmd, key, delta, noreply=False):
         key = self._encode_key(key)
         if self.do_check_key:
             self.check_key(key)
-        server, key = self._get_server(key)
-        if not server:
+        if self._local_caches:
+            self._invalidate_local(key)
+        servers, key = self._get_write_servers(key)
+        if not servers:
             return None
         self._statlog(cmd)
         fullcmd = self._encode_cmd(cmd, key, str(delta), noreply)
-        try:
-            server.send_cmd(fullcmd)
-            if noreply:
-                return
-            line = server.readline()
-            if line is None or line.strip() == b'NOT_FOUND':
+
+        def _incrdecr(server):
+            try:
+                server.send_cmd(fullcmd)
+                if noreply:
+                    return
+                line = server.readline()
+                if line is None or line.strip() == b'NOT_FOUND':
+                    return None
+                return int(line)
+            except OSError as msg:
+                if isinstance(msg, tuple):
+                    msg = msg[1]
+                server.mark_dead(msg)
                 return None
-            return int(line)
-        except OSError as msg:
-            if isinstance(msg, tuple):
-                msg = msg[1]
-            server.mark_dead(msg)
-            return None
 
-    def add(self, key, val, time=0, min_compress_len=0, noreply=False):
+        if not self._observers:
+            return _write_all(servers, _incrdecr)
+        event = self._start_event(cmd, servers, key=key)
+        try:
+            return _write_all(servers, _incrdecr)
+        finally:
+            self._finish_event(event)
+
+    def set_async(self, key, val, time=0, min_compress_len=0):
+        '''Queue a set, to be sent by the C{write_behind} queue.
+
+        This is for best-effort writes such as cache populates: it
+        returns without waiting for the network, and the outcome is
+        only reported by L{WriteBehindQueue.stats}.  Without a
+        C{write_behind} queue, the set is sent right away with noreply.
+
+        @return: True if the set was queued, False if the queue was
+        full and it was dropped.
+        '''
+        if self.write_behind is None:
+            self.set(key, val, time, min_compress_len, noreply=True)
+            return True
+        if isinstance(time, timedelta):
+            time = int(time.total_seconds())
+        return self.write_behind.put(('set', key, val, time,
+                                      min_compress_len))
+
+    def delete_async(self, key):
+        '''Queue a delete, to be sent by the C{write_behind} queue.
+
+        See L{set_async}.
+
+        @return: True if the delete was queued, False if it was dropped.
+        '''
+        if self.write_behind is None:
+            self.delete(key, noreply=True)
+            return True
+        return self.write_behind.put(('delete', key))
+
+    def add(self, key, val, time=0, min_compress_len=0, noreply=False, timeout=None):
         '''Add new key with value.
 
         Like L{set}, but only stores in memcache if the key doesn't
@@ -679,10 +3070,15 @@ class Client(threading.local):
 
         @return: Nonzero on success.
         @rtype: int
+        @param timeout: (default None) Bound in seconds on the
+        total time of the call, see L{deadline}.
         '''
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.add(key, val, time, min_compress_len, noreply)
         return self._set("add", self.key_encoder(key), val, time, min_compress_len, noreply)
 
-    def append(self, key, val, time=0, min_compress_len=0, noreply=False):
+    def append(self, key, val, time=0, min_compress_len=0, noreply=False, timeout=None):
         '''Append the value to the end of the existing key's value.
 
         Only stores in memcache if key already exists.
@@ -690,10 +3086,15 @@ class Client(threading.local):
 
         @return: Nonzero on success.
         @rtype: int
+        @param timeout: (default None) Bound in seconds on the
+        total time of the call, see L{deadline}.
         '''
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.append(key, val, time, min_compress_len, noreply)
         return self._set("append", self.key_encoder(key), val, time, min_compress_len, noreply)
 
-    def prepend(self, key, val, time=0, min_compress_len=0, noreply=False):
+    def prepend(self, key, val, time=0, min_compress_len=0, noreply=False, timeout=None):
         '''Prepend the value to the beginning of the existing key's value.
 
         Only stores in memcache if key already exists.
@@ -701,10 +3102,15 @@ class Client(threading.local):
 
         @return: Nonzero on success.
         @rtype: int
+        @param timeout: (default None) Bound in seconds on the
+        total time of the call, see L{deadline}.
         '''
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.prepend(key, val, time, min_compress_len, noreply)
         return self._set("prepend", self.key_encoder(key), val, time, min_compress_len, noreply)
 
-    def replace(self, key, val, time=0, min_compress_len=0, noreply=False):
+    def replace(self, key, val, time=0, min_compress_len=0, noreply=False, timeout=None):
         '''Replace existing key with value.
 
         Like L{set}, but only stores in memcache if the key already exists.
@@ -712,10 +3118,16 @@ class Client(threading.local):
 
         @return: Nonzero on success.
         @rtype: int
+        @param timeout: (default None) Bound in seconds on the
+        total time of the call, see L{deadline}.
         '''
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.replace(key, val, time, min_compress_len, noreply)
         return self._set("replace", self.key_encoder(key), val, time, min_compress_len, noreply)
 
-    def set(self, key, val, time=0, min_compress_len=0, noreply=False):
+    def set(self, key, val, time=0, min_compress_len=0, noreply=False, timeout=None,
+            namespace=None):
         '''Unconditionally sets a key to a given value in the memcache.
 
         The C{key} can optionally be an tuple, with the first element
@@ -746,12 +3158,27 @@ class Client(threading.local):
 
         @param noreply: optional parameter instructs the server to not
         send the reply.
+
+        @param timeout: (default None) Bound in seconds on the
+        total time of the call, see L{deadline}.
+
+        @param namespace: (default None) Namespace of the key, see
+        L{namespace_version}.
         '''
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.set(key, val, time, min_compress_len, noreply,
+                                namespace=namespace)
         if isinstance(time, timedelta):
             time = int(time.total_seconds())
+        if namespace is not None:
+            key = self._namespaced_key(key, namespace)
+            if key is None:
+                return 0
+            return self._set("set", key, val, time, min_compress_len, noreply)
         return self._set("set", self.key_encoder(key), val, time, min_compress_len, noreply)
 
-    def cas(self, key, val, time=0, min_compress_len=0, noreply=False):
+    def cas(self, key, val, time=0, min_compress_len=0, noreply=False, timeout=None):
         '''Check and set (CAS)
 
         Sets a key to a given value in the memcache if it hasn't been
@@ -785,16 +3212,32 @@ class Client(threading.local):
 
         @param noreply: optional parameter instructs the server to not
         send the reply.
+
+        @param timeout: (default None) Bound in seconds on the
+        total time of the call, see L{deadline}.
         '''
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.cas(key, val, time, min_compress_len, noreply)
         return self._set("cas", self.key_encoder(key), val, time, min_compress_len, noreply)
 
-    def _map_and_prefix_keys(self, key_iterable, key_prefix):
+    def _map_and_prefix_keys(self, key_iterable, key_prefix, replica=0):
         """Map keys to the servers they will reside on.
 
         Compute the mapping of server (_Host instance) -> list of keys to
         stuff onto that server, as well as the mapping of prefixed key
-        -> original key.
+        -> original key.  If C{replica} is nonzero, keys are mapped to
+        their n-th replica server instead, and keys without one are
+        left out.
         """
+        if replica:
+            def get_server(key):
+                servers, key = self._get_replica_servers(key)
+                if len(servers) <= replica:
+                    return None, None
+                return servers[replica], key
+        else:
+            get_server = self._get_server
         key_prefix = self._encode_key(key_prefix)
         # Check it just once ...
         key_extra_len = len(key_prefix)
@@ -821,15 +3264,14 @@ class Client(threading.local):
 
                 # Gotta pre-mangle key before hashing to a
                 # server. Returns the mangled key.
-                server, key = self._get_server(
-                    (serverhash, key_prefix + key))
+                server, key = get_server((serverhash, key_prefix + key))
             else:
                 key = self._encode_key(self.key_encoder(orig_key))
                 if not isinstance(key, bytes):
                     # set_multi supports int / long keys.
                     key = str(key).encode('utf8')
                 bytes_orig_key = key
-                server, key = self._get_server(key_prefix + key)
+                server, key = get_server(key_prefix + key)
 
             #  alert when passed in key is None
             if orig_key is None:
@@ -850,7 +3292,7 @@ class Client(threading.local):
         return (server_keys, prefixed_to_orig_key)
 
     def set_multi(self, mapping, time=0, key_prefix='', min_compress_len=0,
-                  noreply=False):
+                  noreply=False, timeout=None, namespace=None):
         '''Sets multiple keys in the memcache doing just one query.
 
         >>> notset_keys = mc.set_multi({'key1' : 'val1', 'key2' : 'val2'})
@@ -908,12 +3350,65 @@ class Client(threading.local):
            of memory, etc. ].
 
         @rtype: list
+
+        @param timeout: (default None) Bound in seconds on the
+        total time of the call, see L{deadline}.
+
+        @param namespace: (default None) Namespace of the keys, see
+        L{namespace_version}.
         '''
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.set_multi(mapping, time, key_prefix, min_compress_len, noreply,
+                                      namespace=namespace)
+        if namespace is not None:
+            prefix = self._namespace_prefix(namespace)
+            if prefix is None:
+                return list(mapping)
+            key_prefix = prefix + self._encode_key(key_prefix)
         self._statlog('set_multi')
 
-        server_keys, prefixed_to_orig_key = self._map_and_prefix_keys(
-            mapping.keys(), key_prefix)
+        # Values are only serialized once, even when stored on replicas.
+        store_infos = {}
+        notstored = self._set_multi(mapping, time, key_prefix,
+                                    min_compress_len, noreply, 0, store_infos)
+        for replica in range(1, self.replication_factor):
+            self._set_multi(mapping, time, key_prefix, min_compress_len,
+                            noreply, replica, store_infos)
+        return notstored
 
+    def _set_multi(self, mapping, time, key_prefix, min_compress_len,
+                   noreply, replica, store_infos):
+        server_keys, prefixed_to_orig_key = self._map_and_prefix_keys(
+            mapping.keys(), key_prefix, replica)
+        if self._local_caches:
+            for key in prefixed_to_orig_key:
+                self._invalidate_local(key)
+        pool = self.compression_pool
+        if pool is not None and min_compress_len and not store_infos:
+            # Serialize everything first, so that the pool compresses
+            # the values of the next servers while we send to the first.
+            for keys in server_keys.values():
+                for key in keys:
+                    orig_key = prefixed_to_orig_key[key]
+                    store_infos[orig_key] = self._val_to_store_info(
+                        mapping[orig_key], min_compress_len, pool)
+        if not self._observers:
+            return self._set_multi_to_servers(
+                mapping, time, min_compress_len, noreply, store_infos,
+                server_keys, prefixed_to_orig_key)
+        event = self._start_event('set_multi', list(server_keys),
+                                  len(prefixed_to_orig_key))
+        try:
+            return self._set_multi_to_servers(
+                mapping, time, min_compress_len, noreply, store_infos,
+                server_keys, prefixed_to_orig_key, event)
+        finally:
+            self._finish_event(event)
+
+    def _set_multi_to_servers(self, mapping, time, min_compress_len, noreply,
+                              store_infos, server_keys, prefixed_to_orig_key,
+                              event=None):
         # send out all requests on each server before reading anything
         dead_servers = []
         notstored = []  # original keys.
@@ -921,21 +3416,37 @@ class Client(threading.local):
         for server in server_keys.keys():
             bigcmd = []
             write = bigcmd.append
+            segmented = False
             try:
                 for key in server_keys[server]:  # These are mangled keys
-                    store_info = self._val_to_store_info(
-                        mapping[prefixed_to_orig_key[key]],
-                        min_compress_len)
+                    orig_key = prefixed_to_orig_key[key]
+                    store_info = store_infos.get(orig_key)
+                    if store_info is None:
+                        store_info = self._val_to_store_info(
+                            mapping[orig_key], min_compress_len)
+                        store_infos[orig_key] = store_info
+                    elif isinstance(store_info, Future):
+                        store_info = store_infos[orig_key] = store_info.result()
                     if store_info:
                         flags, len_val, val = store_info
                         headers = "%d %d %d" % (flags, time, len_val)
+                        if isinstance(val, list):
+                            write(self._encode_cmd('set', self.key_encoder(key),
+                                                   headers, noreply, b'\r\n'))
+                            bigcmd.extend(val)
+                            write(b'\r\n')
+                            segmented = True
+                            continue
                         fullcmd = self._encode_cmd('set', self.key_encoder(key), headers,
                                                    noreply,
                                                    b'\r\n', val, b'\r\n')
                         write(fullcmd)
                     else:
                         notstored.append(prefixed_to_orig_key[key])
-                server.send_cmds(b''.join(bigcmd))
+                if segmented:
+                    server.send_segments(bigcmd)
+                else:
+                    server.send_cmds(b''.join(bigcmd))
             except OSError as msg:
                 if isinstance(msg, tuple):
                     msg = msg[1]
@@ -966,13 +3477,18 @@ class Client(threading.local):
                 if isinstance(msg, tuple):
                     msg = msg[1]
                 server.mark_dead(msg)
+            if event is not None:
+                event.host_done(server)
         return notstored
 
-    def _val_to_store_info(self, val, min_compress_len):
+    def _val_to_store_info(self, val, min_compress_len, pool=None):
         """Transform val to a storable representation.
 
         Returns a tuple of the flags, the length of the new value, and
-        the new value itself.
+        the new value itself, which is a list of segments for buffers,
+        NumPy arrays and values pickled with out-of-band buffers.  If a
+        L{CompressionPool} is given, large values are compressed there,
+        and a Future of the tuple is returned instead.
         """
         flags = 0
         # Check against the exact type, rather than using isinstance(), so that
@@ -981,6 +3497,16 @@ class Client(threading.local):
         val_type = type(val)
         if val_type == bytes:
             pass
+        elif val_type in (bytearray, memoryview, array, mmap.mmap):
+            # Stored raw and sent without a copy; only bytearray keeps
+            # its type.
+            if val_type == bytearray:
+                flags |= Client._FLAG_BYTEARRAY
+            val = memoryview(val)
+            if val.c_contiguous:
+                val = [val.cast('B')]
+            else:
+                val = val.tobytes()
         elif val_type == str:
             flags |= Client._FLAG_TEXT
             val = val.encode('utf-8')
@@ -989,6 +3515,11 @@ class Client(threading.local):
             val = ('%d' % val).encode('ascii')
             # force no attempt to compress this silly string.
             min_compress_len = 0
+        elif numpy is not None and val_type == numpy.ndarray and val.dtype.fields is None and not val.dtype.hasobject:
+            flags |= Client._FLAG_NUMPY
+            val = self._encode_array(val)
+        elif self.pickle_buffers is not None:
+            flags, val = self._pickle_with_buffers(val)
         else:
             flags |= Client._FLAG_PICKLE
             file = BytesIO()
@@ -1001,53 +3532,175 @@ class Client(threading.local):
             pickler.dump(val)
             val = file.getvalue()
 
-        lv = len(val)
-        # We should try to compress if min_compress_len > 0
-        # and this string is longer than our min threshold.
-        if min_compress_len and lv > min_compress_len:
-            comp_val = self.compressor(val)
-            # Only retain the result if the compression result is smaller
-            # than the original.
-            if len(comp_val) < lv:
-                flags |= Client._FLAG_COMPRESSED
-                val = comp_val
-
-        #  silently do not store if value length exceeds maximum
-        if (self.server_max_value_length != 0 and len(val) > self.server_max_value_length):
-            return 0
+        if isinstance(val, list):
+            lv = sum(len(segment) for segment in val)
+        else:
+            lv = len(val)
+        args = (self.compressor, self.server_max_value_length, flags, val,
+                lv, min_compress_len)
+        if pool is not None and min_compress_len and lv > max(min_compress_len, pool.threshold):
+            return pool.submit(_compress_store_info, *args)
+        return _compress_store_info(*args)
 
-        return (flags, len(val), val)
+    def _pickle_with_buffers(self, val):
+        """Pickle C{val} with its large buffers out-of-band.
+
+        Unless no buffer was large enough, the value is stored as the
+        segments::
+
+            <count: uint32> <pickle length: uint64> <buffer lengths: uint64>...
+            <pickle> <buffers>...
+
+        @return: the flags and either the pickle or a list of segments.
+        """
+        min_size = self.pickle_buffers
+        buffers = []
+
+        def buffer_callback(buffer):
+            try:
+                raw = buffer.raw()
+            except BufferError:
+                return True  # not contiguous, pickled in-band
+            if raw.nbytes < min_size:
+                return True
+            buffers.append(raw)
+            return False
+
+        user_persistent_id = self.persistent_id
+
+        def persistent_id(obj):
+            # bytes and bytearray are always pickled in-band, turn the
+            # large ones into buffers.
+            if type(obj) in (bytes, bytearray) and len(obj) >= min_size:
+                return pickle.PickleBuffer(obj)
+            if user_persistent_id:
+                return user_persistent_id(obj)
+            return None
+
+        file = BytesIO()
+        pickler = self.pickler(file, protocol=max(self.pickleProtocol, 5),
+                               buffer_callback=buffer_callback)
+        pickler.persistent_id = persistent_id
+        pickler.dump(val)
+        if not buffers:
+            return Client._FLAG_PICKLE, file.getvalue()
+        stream = file.getbuffer()
+        header = struct.pack('<IQ%dQ' % len(buffers), len(buffers),
+                             len(stream), *[b.nbytes for b in buffers])
+        return (Client._FLAG_PICKLE | Client._FLAG_PICKLE_BUFFERS,
+                [header, stream] + buffers)
+
+    def _encode_array(self, val):
+        """Store a NumPy array as a header and its raw data::
+
+            <ndim: uint8> <order: C or F> <dtype length: uint8>
+            <shape: uint64>... <dtype> <data>
+
+        The data is not copied unless the array isn't contiguous.
+
+        @return: a list of the two segments.
+        """
+        if val.flags.c_contiguous:
+            order = b'C'
+        elif val.flags.f_contiguous:
+            order = b'F'
+        else:
+            order = b'C'
+            val = numpy.ascontiguousarray(val)
+        dtype = val.dtype.str.encode('ascii')
+        header = struct.pack('<BcB%dQ' % val.ndim, val.ndim, order,
+                             len(dtype), *val.shape) + dtype
+        data = val.ravel(order='K').view(numpy.uint8)
+        return [header, memoryview(data)]
+
+    def _decode_array(self, buf):
+        """Load an array stored by L{_encode_array}, as a view of C{buf}."""
+        ndim, order, dtype_len = struct.unpack_from('<BcB', buf)
+        shape = struct.unpack_from('<%dQ' % ndim, buf, 3)
+        offset = 3 + 8 * ndim
+        dtype = numpy.dtype(bytes(buf[offset:offset + dtype_len]).decode('ascii'))
+        order = order.decode('ascii')
+        if not math.prod(shape):
+            # frombuffer() refuses empty buffers on older NumPy versions
+            return numpy.empty(shape, dtype, order=order)
+        val = numpy.frombuffer(buf, dtype, offset=offset + dtype_len)
+        return val.reshape(shape, order=order)
+
+    def _unpickle_with_buffers(self, buf):
+        """Load a value stored by L{_pickle_with_buffers}."""
+        view = memoryview(buf)
+        if view.readonly:
+            # Loaded buffers which were bytearrays must stay writable.
+            view = memoryview(bytearray(view))
+        count, = struct.unpack_from('<I', view)
+        lengths = struct.unpack_from('<%dQ' % (count + 1), view, 4)
+        segments = []
+        offset = 4 + 8 * (count + 1)
+        for length in lengths:
+            segments.append(view[offset:offset + length])
+            offset += length
+        user_persistent_load = self.persistent_load
+
+        def persistent_load(pid):
+            if isinstance(pid, memoryview):
+                return bytes(pid) if pid.readonly else bytearray(pid)
+            if user_persistent_load is None:
+                raise pickle.UnpicklingError(
+                    'unsupported persistent id encountered')
+            return user_persistent_load(pid)
+
+        unpickler = self.unpickler(BytesIO(segments[0]), buffers=segments[1:])
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
 
     def _set(self, cmd, key, val, time, min_compress_len=0, noreply=False):
         key = self._encode_key(key)
         if self.do_check_key:
             self.check_key(key)
-        server, key = self._get_server(key)
-        if not server:
+        if self._local_caches:
+            self._invalidate_local(key)
+        if cmd == 'cas':
+            # cas ids are per server, so cas can't be replicated.
+            server, key = self._get_server(key)
+            servers = [server] if server else []
+        else:
+            servers, key = self._get_write_servers(key)
+        if not servers:
             return 0
+        store_infos = []
+        event = None
 
-        def _unsafe_set():
+        def _unsafe_set(server):
             self._statlog(cmd)
 
             if cmd == 'cas' and key not in self.cas_ids:
                 return self._set('set', key, val, time, min_compress_len,
                                  noreply)
 
-            store_info = self._val_to_store_info(val, min_compress_len)
+            if not store_infos:
+                store_infos.append(
+                    self._val_to_store_info(val, min_compress_len))
+            store_info = store_infos[0]
             if not store_info:
                 return 0
             flags, len_val, encoded_val = store_info
+            if event is not None:
+                event.value_size = len_val
 
             if cmd == 'cas':
                 headers = ("%d %d %d %d"
                            % (flags, time, len_val, self.cas_ids[key]))
             else:
                 headers = "%d %d %d" % (flags, time, len_val)
-            fullcmd = self._encode_cmd(cmd, key, headers, noreply,
-                                       b'\r\n', encoded_val)
-
             try:
-                server.send_cmd(fullcmd)
+                if isinstance(encoded_val, list):
+                    segments = [self._encode_cmd(cmd, key, headers, noreply, b'\r\n')]
+                    segments.extend(encoded_val)
+                    segments.append(b'\r\n')
+                    server.send_segments(segments)
+                else:
+                    server.send_cmd(self._encode_cmd(cmd, key, headers, noreply,
+                                                     b'\r\n', encoded_val))
                 if noreply:
                     return True
                 return server.expect(b"STORED", raise_exception=True) == b"STORED"
@@ -1057,25 +3710,77 @@ class Client(threading.local):
                 server.mark_dead(msg)
             return 0
 
-        try:
-            return _unsafe_set()
-        except _ConnectionDeadError:
-            # retry once
+        def _set_one(server):
             try:
-                if server._get_socket():
-                    return _unsafe_set()
-            except (_ConnectionDeadError, OSError) as msg:
-                server.mark_dead(msg)
-            return 0
+                return _unsafe_set(server)
+            except _ConnectionDeadError:
+                # retry once
+                try:
+                    if server._get_socket():
+                        return _unsafe_set(server)
+                except (_ConnectionDeadError, OSError) as msg:
+                    server.mark_dead(msg)
+                return 0
+
+        if not self._observers:
+            return _write_all(servers, _set_one)
+        event = self._start_event(cmd, servers, key=key)
+        try:
+            return _write_all(servers, _set_one)
+        finally:
+            self._finish_event(event)
 
     def _get(self, cmd, key, default=None):
         key = self._encode_key(key)
         if self.do_check_key:
             self.check_key(key)
+        detector = self.hot_key_detector
+        if detector is not None and cmd == 'get':
+            rawkey = key[1] if isinstance(key, tuple) else key
+            detector.record(rawkey)
+            found, value = detector.get_local(rawkey)
+            if found:
+                return value
+        else:
+            detector = None
+        negative = self.negative_cache
+        if negative is not None and cmd == 'get':
+            rawkey = key[1] if isinstance(key, tuple) else key
+            if rawkey in negative:
+                return default
+        else:
+            negative = None
+        hashkey = key
         server, key = self._get_server(key)
         if not server:
             return None
 
+        event = None
+        if self._observers:
+            event = self._start_event(cmd, [server], key=key)
+        if cmd == 'get' and self.replication_factor > 1:
+            value = self._get_replicated(hashkey, server, key, event)
+        else:
+            value = self._get_from_server(cmd, server, key)
+        hit = value is not _MISS and value is not _FAILED
+        if event is not None:
+            self._finish_event(event, hits=int(hit),
+                               misses=int(value is _MISS))
+        if hit and detector is not None and detector.is_hot(rawkey):
+            detector.store_local(rawkey, value)
+        if value is _MISS:
+            if negative is not None:
+                negative.add(rawkey)
+            return default
+        if value is _FAILED:
+            return None
+        return value
+
+    def _get_from_server(self, cmd, server, key):
+        """Look up a single key on C{server}, reconnecting once.
+
+        @return: The value, or one of _MISS and _FAILED.
+        """
         def _unsafe_get():
             self._statlog(cmd)
 
@@ -1083,32 +3788,12 @@ class Client(threading.local):
                 cmd_bytes = cmd.encode('utf-8')
                 fullcmd = b''.join((cmd_bytes, b' ', key))
                 server.send_cmd(fullcmd)
-                rkey = flags = rlen = cas_id = None
-
-                if cmd == 'gets':
-                    rkey, flags, rlen, cas_id, = self._expect_cas_value(
-                        server, raise_exception=True
-                    )
-                    if rkey and self.cache_cas:
-                        self.cas_ids[rkey] = cas_id
-                else:
-                    rkey, flags, rlen, = self._expectvalue(
-                        server, raise_exception=True
-                    )
-
-                if not rkey:
-                    return default
-                try:
-                    value = self._recv_value(server, flags, rlen)
-                finally:
-                    server.expect(b"END", raise_exception=True)
-            except (_Error, OSError) as msg:
+            except OSError as msg:
                 if isinstance(msg, tuple):
                     msg = msg[1]
                 server.mark_dead(msg)
-                return None
-
-            return value
+                return _FAILED
+            return self._read_get_response(cmd, server)
 
         try:
             return _unsafe_get()
@@ -1117,26 +3802,183 @@ class Client(threading.local):
             try:
                 if server.connect():
                     return _unsafe_get()
-                return None
+                return _FAILED
             except (_ConnectionDeadError, OSError) as msg:
                 server.mark_dead(msg)
-            return None
+            return _FAILED
 
-    def get(self, key, default=None):
+    def _read_get_response(self, cmd, server):
+        """Read the response to a single key get or gets.
+
+        @return: The value, or one of _MISS and _FAILED.
+        """
+        try:
+            rkey = flags = rlen = cas_id = None
+
+            if cmd == 'gets':
+                rkey, flags, rlen, cas_id, = self._expect_cas_value(
+                    server, raise_exception=True
+                )
+                if rkey and self.cache_cas:
+                    self.cas_ids[rkey] = cas_id
+            else:
+                rkey, flags, rlen, = self._expectvalue(
+                    server, raise_exception=True
+                )
+
+            if not rkey:
+                return _MISS
+            try:
+                value = self._recv_value(server, flags, rlen)
+            finally:
+                server.expect(b"END", raise_exception=True)
+        except (_Error, OSError) as msg:
+            if isinstance(msg, tuple):
+                msg = msg[1]
+            server.mark_dead(msg)
+            return _FAILED
+
+        return value
+
+    def _get_replicated(self, hashkey, server, key, event=None):
+        """Look up key on its primary server, then on the replicas."""
+        replicas = None
+        tried = [server]
+        if self.hedge_after is not None:
+            replicas = self._get_replica_servers(hashkey)[0]
+            replicas = [s for s in replicas if s is not server]
+        if replicas:
+            if event is not None:
+                event.add_host(replicas[0])
+            value, answered = self._get_hedged(server, replicas[0], key)
+            tried.append(answered)
+        else:
+            value = self._get_from_server('get', server, key)
+        if value is not _MISS and value is not _FAILED:
+            return value
+
+        if replicas is None:
+            replicas = self._get_replica_servers(hashkey)[0]
+        missed = value is _MISS
+        for replica in replicas:
+            if replica in tried:
+                continue
+            if event is not None:
+                event.add_host(replica)
+            value = self._get_from_server('get', replica, key)
+            if value is not _MISS and value is not _FAILED:
+                return value
+            missed = missed or value is _MISS
+        return _MISS if missed else _FAILED
+
+    def _get_hedged(self, primary, replica, key):
+        """Send a get to primary, and to replica if primary is slow.
+
+        The reply of the slower server is discarded by closing its
+        connection.
+
+        @return: A tuple of the value (or _MISS or _FAILED) and the
+        server which provided it.
+        """
+        self._statlog('get')
+        fullcmd = b'get ' + key
+        try:
+            primary.send_cmd(fullcmd)
+        except OSError as msg:
+            primary.mark_dead(msg)
+            return _FAILED, primary
+
+        winner = primary
+        if not primary.buffer and not _select_readable(
+                [primary], self._time_left(self.hedge_after)):
+            try:
+                replica.send_cmd(fullcmd)
+            except OSError as msg:
+                replica.mark_dead(msg)
+            else:
+                ready = _select_readable([primary, replica],
+                                         self._time_left(self.socket_timeout))
+                if ready == [replica]:
+                    winner = replica
+                    primary.close_socket()
+                else:
+                    replica.close_socket()
+
+        try:
+            return self._read_get_response('get', winner), winner
+        except _ConnectionDeadError:
+            return _FAILED, winner
+
+    def _time_left(self, timeout):
+        """Return C{timeout}, shortened to what is left of the deadline."""
+        deadline = self._deadline[0]
+        if deadline is None:
+            return timeout
+        left = max(deadline - time.monotonic(), 0)
+        return left if timeout is None else min(timeout, left)
+
+    def get(self, key, default=None, timeout=None, namespace=None):
         '''Retrieves a key from the memcache.
 
         @return: The value or None.
+        @param timeout: (default None) Bound in seconds on the
+        total time of the call, see L{deadline}.
+        @param namespace: (default None) Namespace of the key, see
+        L{namespace_version}.
         '''
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.get(key, default, namespace=namespace)
+        if namespace is not None:
+            key = self._namespaced_key(key, namespace)
+            if key is None:
+                return default
+            return self._get('get', key, default)
+        if self.auto_batch is not None and self._deadline[0] is None:
+            return self.auto_batch.submit(key, default).result()
         return self._get('get', self.key_encoder(key), default)
 
-    def gets(self, key):
+    async def aget(self, key, default=None):
+        '''Coroutine version of L{get}, for asyncio tasks.
+
+        With an C{auto_batch} L{AutoBatcher}, the gets of concurrent
+        tasks are sent together, otherwise the get runs in the default
+        executor of the event loop.
+        '''
+        import asyncio
+        if self.auto_batch is not None:
+            return await asyncio.wrap_future(
+                self.auto_batch.submit(key, default))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get, key, default)
+
+    def batch(self):
+        '''Return a scope collecting gets into a single multi-get.
+
+        Each C{get} made on the scope returns a
+        C{concurrent.futures.Future}; the keys are fetched with one
+        L{get_multi} when the C{with} block exits, or on C{execute()}::
+
+            with mc.batch() as batch:
+                futures = [batch.get(key) for key in keys]
+            values = [future.result() for future in futures]
+        '''
+        return _GetBatch(self)
+
+    def gets(self, key, timeout=None):
         '''Retrieves a key from the memcache. Used in conjunction with 'cas'.
 
         @return: The value or None.
+        @param timeout: (default None) Bound in seconds on the
+        total time of the call, see L{deadline}.
         '''
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.gets(key)
         return self._get('gets', self.key_encoder(key))
 
-    def get_multi(self, keys, key_prefix=''):
+    def get_multi(self, keys, key_prefix='', timeout=None, namespace=None,
+                  lazy=False):
         '''Retrieves multiple keys from the memcache doing just one query.
 
         >>> success = mc.set("foo", "bar")
@@ -1189,12 +4031,105 @@ class Client(threading.local):
         @return: A dictionary of key/value pairs that were
         available. If key_prefix was provided, the keys in the returned
         dictionary will not have it present.
+
+        @param timeout: (default None) Bound in seconds on the
+        total time of the call, see L{deadline}.  If it runs out, the
+        values received so far are returned.
+
+        @param namespace: (default None) Namespace of the keys, see
+        L{namespace_version}.
+
+        @param lazy: (default False) If True, return a L{LazyResults}
+        which only decodes the values that are accessed.
         '''
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.get_multi(keys, key_prefix, namespace=namespace,
+                                      lazy=lazy)
+        retvals = LazyResults(self._decode_value) if lazy else {}
+        if namespace is not None:
+            prefix = self._namespace_prefix(namespace)
+            if prefix is None:
+                return retvals
+            key_prefix = prefix + self._encode_key(key_prefix)
 
         self._statlog('get_multi')
 
+        keys = [self.key_encoder(k) for k in keys]
+        return self._get_multi_replicas(keys, key_prefix, retvals)
+
+    def _get_multi_replicas(self, keys, key_prefix, retvals):
+        """Look up C{keys} on their servers, then the keys not found on
+        each replica in turn.
+        """
+        # The keys answered as misses by the negative cache, which the
+        # replicas aren't asked for either.
+        skipped = set()
+        self._get_multi(keys, key_prefix, 0, retvals, skipped)
+        for replica in range(1, self.replication_factor):
+            missing = [k for k in keys
+                       if k not in retvals and k not in skipped]
+            if not missing:
+                break
+            self._get_multi(missing, key_prefix, replica, retvals)
+        return retvals
+
+    def _get_multi(self, keys, key_prefix, replica, retvals=None,
+                   skipped=None):
+        """Look up C{keys} on their servers, or C{replica}-th replicas.
+
+        @param retvals: dict or L{LazyResults} the values found are
+        added to, and which is returned.
+        @param skipped: optional set the keys answered as misses by the
+        negative cache are added to.
+        """
         server_keys, prefixed_to_orig_key = self._map_and_prefix_keys(
-            [self.key_encoder(k) for k in keys], key_prefix)
+            keys, key_prefix, replica)
+
+        if retvals is None:
+            retvals = {}
+        lazy = isinstance(retvals, LazyResults)
+        found_before = len(retvals)
+        pool = None if lazy else self.compression_pool
+        # orig_key -> (server key, flags, Future of the decompressed bytes)
+        decompressing = {}
+        detector = self.hot_key_detector
+        if detector is not None:
+            for server in list(server_keys):
+                remaining = []
+                for key in server_keys[server]:
+                    detector.record(key)
+                    found, val = detector.get_local(key)
+                    if found:
+                        retvals[prefixed_to_orig_key[key]] = val
+                    else:
+                        remaining.append(key)
+                if remaining:
+                    server_keys[server] = remaining
+                else:
+                    del server_keys[server]
+        negative = self.negative_cache
+        if negative is not None:
+            if not replica:
+                for server in list(server_keys):
+                    remaining = []
+                    for key in server_keys[server]:
+                        if key not in negative:
+                            remaining.append(key)
+                        elif skipped is not None:
+                            skipped.add(prefixed_to_orig_key[key])
+                    if remaining:
+                        server_keys[server] = remaining
+                    else:
+                        del server_keys[server]
+            if replica < self.replication_factor - 1:
+                # Not a miss until the last replica is checked.
+                negative = None
+
+        event = None
+        if self._observers:
+            event = self._start_event('get_multi', list(server_keys),
+                                      len(prefixed_to_orig_key))
 
         # send out all requests on each server before reading anything
         dead_servers = []
@@ -1212,7 +4147,6 @@ class Client(threading.local):
         for server in dead_servers:
             del server_keys[server]
 
-        retvals = {}
         for server in server_keys.keys():
             try:
                 line = server.readline()
@@ -1220,16 +4154,201 @@ class Client(threading.local):
                     rkey, flags, rlen = self._expectvalue(server, line)
                     #  Bo Yang reports that this can sometimes be None
                     if rkey is not None:
-                        val = self._recv_value(server, flags, rlen)
                         # un-prefix returned key.
-                        retvals[prefixed_to_orig_key[rkey]] = val
+                        orig_key = prefixed_to_orig_key[rkey]
+                        hot = detector is not None and detector.is_hot(rkey)
+                        if lazy and not hot:
+                            retvals._store_encoded(
+                                orig_key, flags,
+                                self._recv_raw(server, rlen, flags))
+                        elif pool is not None and rlen > pool.threshold and flags & Client._FLAG_COMPRESSED:
+                            decompressing[orig_key] = (
+                                rkey, flags & ~Client._FLAG_COMPRESSED,
+                                pool.submit(self.decompressor,
+                                            self._recv_raw(server, rlen,
+                                                           flags)))
+                        else:
+                            val = self._recv_value(server, flags, rlen)
+                            retvals[orig_key] = val
+                            if hot:
+                                detector.store_local(rkey, val)
                     line = server.readline()
+                if negative is not None and line == b'END':
+                    for key in server_keys[server]:
+                        orig_key = prefixed_to_orig_key[key]
+                        if orig_key not in retvals and orig_key not in decompressing:
+                            negative.add(key)
             except (_Error, OSError) as msg:
                 if isinstance(msg, tuple):
                     msg = msg[1]
                 server.mark_dead(msg)
+            if event is not None:
+                event.host_done(server)
+        for orig_key, (rkey, flags, future) in decompressing.items():
+            val = retvals[orig_key] = self._decode_value(flags, future.result())
+            if detector is not None and detector.is_hot(rkey):
+                detector.store_local(rkey, val)
+        if event is not None:
+            hits = len(retvals) - found_before
+            self._finish_event(event, hits=hits,
+                               misses=len(prefixed_to_orig_key) - hits)
         return retvals
 
+    def iter_get_multi(self, keys, key_prefix='', batch_size=100,
+                       max_in_flight=2):
+        '''Retrieve many keys, yielding the values as they arrive.
+
+        Like L{get_multi}, but C{keys} can be any iterable, consumed
+        C{batch_size} keys at a time.  Keys are grouped into one
+        C{get} command of up to C{batch_size} keys per server, and at
+        most C{max_in_flight} of them are sent to a server before its
+        responses are read.  So memory use doesn't depend on the total
+        number of keys, and the first values come back before all
+        keys are sent:
+
+        >>> mc.set_multi({'ik1': 1, 'ik2': 2}) == []
+        True
+        >>> sorted(mc.iter_get_multi(iter(['ik1', 'ik2', 'ik3'])))
+        [('ik1', 1), ('ik2', 2)]
+
+        While iterating, responses may still be pending on the
+        connections, so the client must not be used for other commands
+        until the iteration is finished.  Connections with pending
+        responses are closed if the generator is closed early.
+
+        With a C{replication_factor}, keys not found on their primary
+        server are looked up on the replicas once all the primaries
+        have answered.
+
+        @param keys: An iterable of keys.
+        @param key_prefix: A string to prefix each key with, as in
+        L{get_multi}.
+        @param batch_size: (default 100) Maximum number of keys per
+        C{get} command.
+        @param max_in_flight: (default 2) Maximum number of commands
+        sent to a server without having read their response.
+        @return: A generator of (key, value) tuples for the keys that
+        were found, without the key_prefix.
+        '''
+        self._statlog('iter_get_multi')
+        detector = self.hot_key_detector
+        # Keys not found on their primary server, to try on replicas.
+        missing = [] if self.replication_factor > 1 else None
+        pending = {}  # server -> {prefixed key: key} not sent yet
+        in_flight = {}  # server -> deque of (batch, event) sent
+        keys = iter(keys)
+        try:
+            while True:
+                chunk = [self.key_encoder(k) for k in islice(keys, batch_size)]
+                if not chunk:
+                    break
+                server_keys, prefixed_to_orig_key = self._map_and_prefix_keys(
+                    chunk, key_prefix)
+                for server, server_chunk in server_keys.items():
+                    batch = pending.setdefault(server, {})
+                    for key in server_chunk:
+                        if detector is not None:
+                            detector.record(key)
+                            found, val = detector.get_local(key)
+                            if found:
+                                yield prefixed_to_orig_key[key], val
+                                continue
+                        batch[key] = prefixed_to_orig_key[key]
+                    if len(batch) >= batch_size:
+                        del pending[server]
+                        yield from self._send_batch(
+                            server, batch, in_flight, max_in_flight, missing)
+            for server, batch in list(pending.items()):
+                if batch:
+                    yield from self._send_batch(
+                        server, batch, in_flight, max_in_flight, missing)
+            for server, batches in in_flight.items():
+                while batches:
+                    yield from self._read_batch(server, batches, missing)
+        finally:
+            for server, batches in in_flight.items():
+                if batches:
+                    server.close_socket()
+                    self._fail_batches(batches, None)
+
+        for replica in range(1, self.replication_factor):
+            if not missing:
+                break
+            still_missing = []
+            for i in range(0, len(missing), batch_size):
+                chunk = missing[i:i + batch_size]
+                found = self._get_multi(chunk, key_prefix, replica)
+                for key in chunk:
+                    if key in found:
+                        yield key, found[key]
+                    else:
+                        still_missing.append(key)
+            missing = still_missing
+
+    def _send_batch(self, server, batch, in_flight, max_in_flight, missing):
+        """Send a get for the keys of C{batch}, see L{iter_get_multi}.
+
+        Reads the oldest response first if C{max_in_flight} commands
+        are already pending on C{server}, yielding its values.
+        """
+        batches = in_flight.setdefault(server, deque())
+        if len(batches) >= max_in_flight:
+            yield from self._read_batch(server, batches, missing)
+        event = None
+        if self._observers:
+            event = self._start_event('iter_get_multi', [server], len(batch))
+        try:
+            if not server.connect():
+                raise OSError('server is dead')
+            server.send_cmd(b'get ' + b' '.join(batch))
+        except OSError as msg:
+            server.mark_dead(msg)
+            batches.append((batch, event))
+            self._fail_batches(batches, missing)
+            return
+        batches.append((batch, event))
+
+    def _read_batch(self, server, batches, missing):
+        """Read the response to the oldest command pending on C{server}.
+
+        The command stays pending until its END is read, so that the
+        connection is closed if the generator is closed mid-response.
+        """
+        batch, event = batches[0]
+        nkeys = len(batch)
+        detector = self.hot_key_detector
+        try:
+            line = server.readline()
+            while line and line != b'END':
+                rkey, flags, rlen = self._expectvalue(server, line)
+                if rkey is not None:
+                    val = self._recv_value(server, flags, rlen)
+                    if detector is not None and detector.is_hot(rkey):
+                        detector.store_local(rkey, val)
+                    yield batch.pop(rkey), val
+                line = server.readline()
+            failed = not line
+        except (_Error, OSError) as msg:
+            server.mark_dead(msg)
+            failed = True
+        batches.popleft()
+        if event is not None:
+            self._finish_event(event, hits=nkeys - len(batch),
+                               misses=len(batch))
+        if missing is not None:
+            missing.extend(batch.values())
+        if failed:
+            self._fail_batches(batches, missing)
+
+    def _fail_batches(self, batches, missing):
+        """Give up on the commands pending on a failed server."""
+        while batches:
+            batch, event = batches.popleft()
+            if event is not None:
+                self._finish_event(event, misses=len(batch))
+            if missing is not None:
+                missing.extend(batch.values())
+
     def _expect_cas_value(self, server, line=None, raise_exception=False):
         if not line:
             line = server.readline(raise_exception)
@@ -1253,27 +4372,54 @@ class Client(threading.local):
             return (None, None, None)
 
     def _recv_value(self, server, flags, rlen):
+        return self._decode_value(flags, self._recv_raw(server, rlen, flags))
+
+    def _recv_raw(self, server, rlen, flags=0):
+        """Read a value of C{rlen} bytes and its trailing \r\n.
+
+        Values returned as views, bytearrays, NumPy arrays and values
+        with out-of-band pickle buffers are read into a bytearray instead,
+        which the decoded value then shares.
+        """
         rlen += 2  # include \r\n
+        shared_flags = Client._FLAG_PICKLE_BUFFERS | Client._FLAG_NUMPY | Client._FLAG_BYTEARRAY
+        if flags & shared_flags or (flags == 0 and self.return_memoryview):
+            buf = server.recv_buffer(rlen)
+            if buf[-2:] != b'\r\n':
+                raise _Error("value of %d bytes not terminated by \\r\\n"
+                             % rlen)
+            del buf[-2:]
+            return buf
         buf = server.recv(rlen)
         if len(buf) != rlen:
             raise _Error("received %d bytes when expecting %d"
                          % (len(buf), rlen))
+        return buf[:-2]  # strip \r\n
 
-        if len(buf) == rlen:
-            buf = buf[:-2]  # strip \r\n
-
+    def _decode_value(self, flags, buf):
+        """Turn the bytes of a value back into what was stored."""
         if flags & Client._FLAG_COMPRESSED:
             buf = self.decompressor(buf)
             flags &= ~Client._FLAG_COMPRESSED
         if flags == 0:
             # Bare bytes
-            val = buf
+            val = memoryview(buf) if self.return_memoryview else buf
+        elif flags & Client._FLAG_BYTEARRAY:
+            val = buf if type(buf) is bytearray else bytearray(buf)
         elif flags & Client._FLAG_TEXT:
             val = buf.decode('utf-8')
         elif flags & Client._FLAG_INTEGER:
             val = int(buf)
         elif flags & Client._FLAG_LONG:
             val = int(buf)
+        elif flags & Client._FLAG_NUMPY and numpy is not None:
+            val = self._decode_array(buf)
+        elif flags & Client._FLAG_PICKLE_BUFFERS:
+            try:
+                val = self._unpickle_with_buffers(buf)
+            except Exception as e:
+                self.debuglog('Pickle error: %s\n' % e)
+                return None
         elif flags & Client._FLAG_PICKLE:
             try:
                 file = BytesIO(buf)
@@ -1328,9 +4474,23 @@ class Client(threading.local):
 class _Host:
 
     def __init__(self, host, debug=0, dead_retry=_DEAD_RETRY,
-                 socket_timeout=_SOCKET_TIMEOUT, flush_on_reconnect=0):
+                 socket_timeout=_SOCKET_TIMEOUT, flush_on_reconnect=0,
+                 dead_retry_max=_DEAD_RETRY_MAX,
+                 dead_retry_jitter=_DEAD_RETRY_JITTER, failure_threshold=1,
+                 error_rate_threshold=None, connect_timeout=None,
+                 dns_ttl=_DNS_TTL):
         self.dead_retry = dead_retry
+        self._breaker = _CircuitBreaker(
+            dead_retry, dead_retry_max, dead_retry_jitter,
+            failure_threshold, error_rate_threshold)
+        self._topology = [0]
+        self._deadline = [None]
+        self._deadline_timeout = False
         self.socket_timeout = socket_timeout
+        if connect_timeout is None:
+            connect_timeout = socket_timeout
+        self.connect_timeout = connect_timeout
+        self.dns_ttl = dns_ttl
         self.debug = debug
         self.flush_on_reconnect = flush_on_reconnect
         if isinstance(host, tuple):
@@ -1366,9 +4526,19 @@ class _Host:
             self.port = int(hostData.get('port') or 11211)
             self.address = (self.ip, self.port)
 
-        self.deaduntil = 0
         self.socket = None
+        # Value of _fork_generation when the socket was connected.
+        self._generation = _fork_generation
+        # HealthChecker this host is registered with, and the result
+        # of its last probe, not yet applied by the owning thread.
+        self._health_checker = None
+        self._health_update = None
+        self._health_lock = threading.Lock()
         self.flush_on_next_connect = 0
+        self.uses = 0
+        self.metrics = None
+        self.bytes_sent = self.bytes_received = 0
+        self.errors = self.timeouts = self.connects = 0
 
         self.buffer = b''
 
@@ -1376,35 +4546,149 @@ class _Host:
         if self.debug:
             sys.stderr.write("MemCached: %s\n" % str)
 
+    @property
+    def deaduntil(self):
+        """Time until which this server is considered dead, or 0."""
+        if self._breaker.state == _CircuitBreaker.CLOSED:
+            return 0
+        return self._breaker.open_until
+
+    @deaduntil.setter
+    def deaduntil(self, value):
+        if value:
+            self._breaker.state = _CircuitBreaker.OPEN
+            self._breaker.open_until = value
+            self._topology[0] += 1
+        else:
+            self.mark_alive()
+
     def _check_dead(self):
-        if self.deaduntil and self.deaduntil > time.time():
+        if self._health_update is not None:
+            self._apply_health_update()
+        checker = self._health_checker
+        if self._breaker.state != _CircuitBreaker.CLOSED and checker is not None and checker.running():
+            # Left to the health checker to revive.
             return 1
-        self.deaduntil = 0
-        return 0
+        if self._breaker.allow():
+            return 0
+        return 1
+
+    def _post_health_update(self, alive, s=None):
+        """Hand the result of a health check over to the thread owning
+        this host, see L{_apply_health_update}.
+
+        Called from the L{HealthChecker} thread, which must not touch
+        the connection state of the host itself.
+
+        @param s: a connected socket for the host to use.
+        """
+        update = (alive, s, self.uses, _fork_generation)
+        with self._health_lock:
+            previous, self._health_update = self._health_update, update
+        if previous is not None and previous[1] is not None:
+            previous[1].close()
+
+    def _apply_health_update(self):
+        with self._health_lock:
+            update, self._health_update = self._health_update, None
+        if update is None:
+            return
+        alive, s, uses, generation = update
+        if s is not None and generation != _fork_generation:
+            # Connected in the parent process.
+            s.close()
+            s = None
+        if not alive:
+            # Unless the host was used successfully since.
+            if uses == self.uses:
+                self.mark_dead('health check failed')
+        elif s is not None:
+            self._adopt_socket(s)
+        else:
+            self.mark_alive()
 
     def connect(self):
+        self.uses += 1
         if self._get_socket():
             return 1
         return 0
 
+    def _count_timeout(self):
+        self.timeouts += 1
+        if self.metrics is not None:
+            self.metrics.host_event(self, 'timeouts')
+
+    def _deadline_passed(self):
+        deadline = self._deadline[0]
+        # Allow for the rounding of socket timeouts.
+        return deadline is not None and time.monotonic() >= deadline - 0.001
+
+    def _apply_deadline(self):
+        """Shorten the socket timeout to what is left of the deadline."""
+        deadline = self._deadline[0]
+        if self.socket is None:
+            return
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # A timeout of 0 would make the socket non-blocking.
+                raise socket.timeout('deadline exceeded')
+            self.socket.settimeout(remaining)
+            self._deadline_timeout = True
+        elif self._deadline_timeout:
+            self.socket.settimeout(self.socket_timeout)
+            self._deadline_timeout = False
+
     def mark_dead(self, reason):
-        self.debuglog("MemCache: {}: {}.  Marking dead.".format(self, reason))
-        self.deaduntil = time.time() + self.dead_retry
+        if self._deadline_passed():
+            # The caller ran out of time, the server may only be slow.
+            # Drop the connection, which may have responses pending.
+            self.debuglog("MemCache: {}: {}.  Deadline exceeded.".format(
+                self, reason))
+            self._count_timeout()
+            self.close_socket()
+            return
+        self.errors += 1
+        if isinstance(reason, socket.timeout):
+            self._count_timeout()
+        if self._breaker.record_failure():
+            self.debuglog("MemCache: {}: {}.  Marking dead.".format(self, reason))
+            self._topology[0] += 1
+            if self.metrics is not None:
+                self.metrics.host_event(self, 'mark_dead')
+        else:
+            self.debuglog("MemCache: {}: {}.  Failure {} of {}.".format(
+                self, reason, self._breaker.consecutive_failures,
+                self._breaker.failure_threshold))
         if self.flush_on_reconnect:
             self.flush_on_next_connect = 1
         self.close_socket()
 
+    def mark_alive(self):
+        """Reset the server to an "alive" state."""
+        if self._breaker.state != _CircuitBreaker.CLOSED:
+            self._topology[0] += 1
+        self._breaker.reset()
+
     def _get_socket(self):
         if self._check_dead():
             return None
         if self.socket:
-            return self.socket
-        s = socket.socket(self.family, socket.SOCK_STREAM)
-        if hasattr(s, 'settimeout'):
-            s.settimeout(self.socket_timeout)
+            if self._generation == _fork_generation:
+                return self.socket
+            # Inherited from the parent process, which still uses it.
+            self.close_socket()
+        timeout = None
+        if self._deadline[0] is not None:
+            timeout = self._deadline[0] - time.monotonic()
+            if timeout <= 0:
+                return None
+            if self.connect_timeout is not None:
+                timeout = min(timeout, self.connect_timeout)
         try:
-            s.connect(self.address)
+            s = self._connect_socket(timeout)
         except socket.timeout as msg:
+            self._count_timeout()
             self.mark_dead("connect: %s" % msg)
             return None
         except OSError as msg:
@@ -1413,12 +4697,62 @@ class _Host:
             self.mark_dead("connect: %s" % msg)
             return None
         self.socket = s
+        self._generation = _fork_generation
         self.buffer = b''
+        self._deadline_timeout = timeout is not None
+        self.connects += 1
+        if self.metrics is not None:
+            self.metrics.host_event(
+                self, 'reconnects' if self.connects > 1 else 'connects')
+        if self._breaker.record_connect():
+            self._topology[0] += 1
         if self.flush_on_next_connect:
             self.flush()
             self.flush_on_next_connect = 0
         return s
 
+    def _connect_socket(self, timeout=None):
+        """Open a new connection to the server and return it.
+
+        Unlike L{_get_socket}, this does not touch the connection
+        state of this host and raises OSError on failure.
+
+        @param timeout: timeout for both connecting and the socket,
+        instead of C{connect_timeout} and C{socket_timeout}.
+        """
+        connect_timeout = self.connect_timeout if timeout is None else timeout
+        if self.family == socket.AF_UNIX:
+            s = socket.socket(self.family, socket.SOCK_STREAM)
+            if hasattr(s, 'settimeout'):
+                s.settimeout(connect_timeout)
+            try:
+                s.connect(self.address)
+            except Exception:
+                s.close()
+                raise
+        else:
+            try:
+                addresses = _dns_cache.resolve(self.ip, self.port,
+                                               self.family, self.dns_ttl)
+            except socket.gaierror:
+                # Let connect() resolve the name and fail as it always did.
+                addresses = [(self.family, socket.SOCK_STREAM, 0, '',
+                              self.address)]
+            s = _connect_staggered(addresses, connect_timeout)
+        if hasattr(s, 'settimeout'):
+            s.settimeout(self.socket_timeout if timeout is None else timeout)
+        return s
+
+    def _adopt_socket(self, s):
+        """Use the already connected socket C{s} and mark us alive."""
+        if self.socket is None:
+            self.buffer = b''
+            self.socket = s
+            self._generation = _fork_generation
+        else:
+            s.close()
+        self.mark_alive()
+
     def close_socket(self):
         if self.socket:
             self.socket.close()
@@ -1427,13 +4761,43 @@ class _Host:
     def send_cmd(self, cmd):
         if isinstance(cmd, str):
             cmd = cmd.encode('utf8')
+        if self._deadline[0] is not None or self._deadline_timeout:
+            self._apply_deadline()
         self.socket.sendall(cmd + b'\r\n')
+        self.bytes_sent += len(cmd) + 2
 
     def send_cmds(self, cmds):
         """cmds already has trailing \r\n's applied."""
         if isinstance(cmds, str):
             cmds = cmds.encode('utf8')
+        if self._deadline[0] is not None or self._deadline_timeout:
+            self._apply_deadline()
         self.socket.sendall(cmds)
+        self.bytes_sent += len(cmds)
+
+    def send_segments(self, segments):
+        """Send a list of buffers with vectored writes, without joining
+        them into a single copy first.
+        """
+        if self._deadline[0] is not None or self._deadline_timeout:
+            self._apply_deadline()
+        sendmsg = getattr(self.socket, 'sendmsg', None)
+        if sendmsg is None:
+            data = b''.join(segments)
+            self.socket.sendall(data)
+            self.bytes_sent += len(data)
+            return
+        segments = [memoryview(segment).cast('B') for segment in segments]
+        first = 0
+        while first < len(segments):
+            sent = sendmsg(segments[first:first + _IOV_MAX])
+            self.bytes_sent += sent
+            # skip what went out, including any partially sent buffer
+            while first < len(segments) and sent >= segments[first].nbytes:
+                sent -= segments[first].nbytes
+                first += 1
+            if sent:
+                segments[first] = segments[first][sent:]
 
     def readline(self, raise_exception=False):
         """Read a line and return it.
@@ -1452,6 +4816,8 @@ class _Host:
             index = buf.find(b'\r\n')
             if index >= 0:
                 break
+            if self._deadline[0] is not None or self._deadline_timeout:
+                self._apply_deadline()
             data = recv(4096)
             if not data:
                 # connection close, let's kill it and raise
@@ -1461,8 +4827,13 @@ class _Host:
                 else:
                     return ''
 
+            self.bytes_received += len(data)
             buf += data
         self.buffer = buf[index + 2:]
+        if self._breaker.consecutive_failures:
+            # A response made it, the server works again.
+            if self._breaker.record_success():
+                self._topology[0] += 1
         return buf[:index]
 
     def expect(self, text, raise_exception=False):
@@ -1478,7 +4849,10 @@ class _Host:
         self_socket_recv = self.socket.recv
         buf = self.buffer
         while len(buf) < rlen:
+            if self._deadline[0] is not None or self._deadline_timeout:
+                self._apply_deadline()
             foo = self_socket_recv(max(rlen - len(buf), 4096))
+            self.bytes_received += len(foo)
             buf += foo
             if not foo:
                 raise _Error('Read %d bytes, expecting %d, '
@@ -1486,6 +4860,27 @@ class _Host:
         self.buffer = buf[rlen:]
         return buf[:rlen]
 
+    def recv_buffer(self, rlen):
+        """Like L{recv}, but read straight into a new bytearray, which is
+        returned.
+        """
+        buf = bytearray(rlen)
+        view = memoryview(buf)
+        pos = min(len(self.buffer), rlen)
+        view[:pos] = self.buffer[:pos]
+        self.buffer = self.buffer[pos:]
+        recv_into = self.socket.recv_into
+        while pos < rlen:
+            if self._deadline[0] is not None or self._deadline_timeout:
+                self._apply_deadline()
+            received = recv_into(view[pos:])
+            if not received:
+                raise _Error('Read %d bytes, expecting %d, '
+                             'read returned 0 length bytes' % (pos, rlen))
+            self.bytes_received += received
+            pos += received
+        return buf
+
     def quit(self) -> None:
         '''Send a "quit" command to remote server and wait for connection to close.'''
         if self.socket:
@@ -1506,17 +4901,422 @@ class _Host:
         self.send_cmd('flush_all')
         self.expect(b'OK')
 
+    @property
+    def name(self):
+        """The address of the server, as a string."""
+        if self.family == socket.AF_INET:
+            return "inet:%s:%d" % (self.address[0], self.address[1])
+        elif self.family == socket.AF_INET6:
+            return "inet6:[%s]:%d" % (self.address[0], self.address[1])
+        else:
+            return "unix:{}".format(self.address)
+
     def __str__(self):
         d = ''
         if self.deaduntil:
             d = " (dead until %d)" % self.deaduntil
+        return self.name + d
 
-        if self.family == socket.AF_INET:
-            return "inet:%s:%d%s" % (self.address[0], self.address[1], d)
-        elif self.family == socket.AF_INET6:
-            return "inet6:[%s]:%d%s" % (self.address[0], self.address[1], d)
+
+_STORAGE_COMMANDS = (b'set', b'add', b'replace', b'append', b'prepend', b'cas')
+_RELATIVE_EXPTIME_MAX = 60 * 60 * 24 * 30
+_ITEM_OVERHEAD = 48  # bytes of item header counted by memcached
+
+
+class EmbeddedServer:
+    """Pure-Python stand-in for a memcached server, for tests and benchmarks.
+
+    It implements the text protocol commands used by L{Client}: get,
+    gets, set, add, replace, append, prepend, cas, incr, decr, touch,
+    delete, stats, flush_all, version, verbosity, quit and
+    C{lru_crawler metadump}.  Each
+    connection is served by its own thread::
+
+        with EmbeddedServer() as server:
+            mc = Client([server.address])
+
+    Faults can be injected at any time by changing the attributes:
+
+      - C{latency}: seconds to wait before answering each batch of
+        pipelined commands, like a network round trip.
+      - C{drop_rate}: probability (0.0 - 1.0) of closing the
+        connection instead of answering a command.
+      - C{write_chunk}: if set, responses are written this many bytes
+        at a time, so that clients receive partial responses.
+
+    This is not meant to replace memcached: apart from the
+    C{item_size_max} limit on single items there is no memory limit and
+    no eviction, and all data is kept in a single dictionary.
+    """
+
+    version = '1.6.0-embedded'
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, drop_rate=0.0,
+                 write_chunk=None, item_size_max=1024 * 1024):
+        self.host = host
+        self.port = port
+        self.item_size_max = item_size_max
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.write_chunk = write_chunk
+        # key -> [flags, expiry time (0 for never), value, cas unique]
+        self.data = {}
+        self.counters = dict.fromkeys((
+            'total_connections', 'cmd_get', 'cmd_set', 'cmd_touch',
+            'cmd_flush', 'get_hits', 'get_misses', 'delete_hits',
+            'delete_misses', 'incr_hits', 'incr_misses', 'decr_hits',
+            'decr_misses', 'cas_hits', 'cas_misses', 'cas_badval',
+            'touch_hits', 'touch_misses', 'total_items', 'bytes_read',
+            'bytes_written'), 0)
+        self._cas_unique = 0
+        self._lock = threading.Lock()
+        self._listener = None
+        self._thread = None
+        self._connections = set()
+        self._started = None
+
+    @property
+    def address(self):
+        """The server address, in the form accepted by L{Client}."""
+        return '%s:%d' % (self.host, self.port)
+
+    def start(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(128)
+        self.port = listener.getsockname()[1]
+        self._listener = listener
+        self._started = time.time()
+        self._thread = threading.Thread(target=self._accept_loop,
+                                        name='EmbeddedServer %s'
+                                        % self.address)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop listening and close all the connections."""
+        if self._listener is None:
+            return
+        try:
+            self._listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._listener.close()
+        self._listener = None
+        self._thread.join()
+        with self._lock:
+            connections = list(self._connections)
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _accept_loop(self):
+        listener = self._listener
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._lock:
+                self._connections.add(conn)
+                self.counters['total_connections'] += 1
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        buf = b''
+        try:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                with self._lock:
+                    self.counters['bytes_read'] += len(data)
+                buf += data
+                out = []
+                while True:
+                    index = buf.find(b'\r\n')
+                    if index < 0:
+                        break
+                    parts = buf[:index].split()
+                    block = None
+                    if parts and parts[0] in _STORAGE_COMMANDS:
+                        try:
+                            end = index + 2 + int(parts[4])
+                        except (IndexError, ValueError):
+                            end = index
+                        else:
+                            if len(buf) < end + 2:
+                                break
+                            block = buf[index + 2:end]
+                            index = end
+                    buf = buf[index + 2:]
+                    if self.drop_rate and random.random() < self.drop_rate:
+                        return
+                    response = self._handle(parts, block)
+                    if response is None:
+                        return
+                    out.append(response)
+                if out:
+                    self._write(conn, b''.join(out))
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._connections.discard(conn)
+            conn.close()
+
+    def _write(self, conn, data):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.counters['bytes_written'] += len(data)
+        chunk = self.write_chunk
+        if not chunk:
+            conn.sendall(data)
+            return
+        for i in range(0, len(data), chunk):
+            conn.sendall(data[i:i + chunk])
+
+    def _lookup(self, key):
+        item = self.data.get(key)
+        if item is not None and item[1] and item[1] <= time.time():
+            del self.data[key]
+            item = None
+        return item
+
+    def _expiry(self, exptime):
+        exptime = int(exptime)
+        if exptime == 0:
+            return 0
+        if exptime < 0:
+            return -1
+        if exptime > _RELATIVE_EXPTIME_MAX:
+            return exptime
+        return time.time() + exptime
+
+    def _handle(self, parts, block):
+        """Run one command, return the response or None to disconnect."""
+        if not parts:
+            return b'ERROR\r\n'
+        command = parts[0]
+        noreply = parts[-1] == b'noreply'
+        if noreply:
+            parts = parts[:-1]
+        handler = getattr(self, '_cmd_' + command.decode('ascii', 'replace'),
+                          None)
+        if handler is None:
+            return b'ERROR\r\n'
+        try:
+            with self._lock:
+                response = handler(parts, block)
+        except (IndexError, ValueError):
+            response = b'CLIENT_ERROR bad command line format\r\n'
+        if noreply and response is not None:
+            return b''
+        return response
+
+    def _cmd_get(self, parts, block, cas=False):
+        out = []
+        for key in parts[1:]:
+            self.counters['cmd_get'] += 1
+            item = self._lookup(key)
+            if item is None:
+                self.counters['get_misses'] += 1
+                continue
+            self.counters['get_hits'] += 1
+            flags, _, value, unique = item
+            if cas:
+                out.append(b'VALUE %s %d %d %d\r\n'
+                           % (key, flags, len(value), unique))
+            else:
+                out.append(b'VALUE %s %d %d\r\n' % (key, flags, len(value)))
+            out.append(value)
+            out.append(b'\r\n')
+        out.append(b'END\r\n')
+        return b''.join(out)
+
+    def _cmd_gets(self, parts, block):
+        return self._cmd_get(parts, block, cas=True)
+
+    def _store(self, key, flags, exptime, value):
+        self._cas_unique += 1
+        self.data[key] = [flags, self._expiry(exptime), value,
+                          self._cas_unique]
+        self.counters['total_items'] += 1
+        return b'STORED\r\n'
+
+    def _cmd_set(self, parts, block):
+        self.counters['cmd_set'] += 1
+        if block is None:
+            raise ValueError(parts)
+        if len(parts[1]) + len(block) + _ITEM_OVERHEAD > self.item_size_max:
+            # Like memcached, a failed set invalidates the old value.
+            self.data.pop(parts[1], None)
+            return b'SERVER_ERROR object too large for cache\r\n'
+        return self._store(parts[1], int(parts[2]), parts[3], block)
+
+    def _cmd_add(self, parts, block):
+        if self._lookup(parts[1]) is not None:
+            self.counters['cmd_set'] += 1
+            return b'NOT_STORED\r\n'
+        return self._cmd_set(parts, block)
+
+    def _cmd_replace(self, parts, block):
+        if self._lookup(parts[1]) is None:
+            self.counters['cmd_set'] += 1
+            return b'NOT_STORED\r\n'
+        return self._cmd_set(parts, block)
+
+    def _cmd_append(self, parts, block, prepend=False):
+        self.counters['cmd_set'] += 1
+        item = self._lookup(parts[1])
+        if item is None or block is None:
+            return b'NOT_STORED\r\n'
+        item[2] = block + item[2] if prepend else item[2] + block
+        self._cas_unique += 1
+        item[3] = self._cas_unique
+        return b'STORED\r\n'
+
+    def _cmd_prepend(self, parts, block):
+        return self._cmd_append(parts, block, prepend=True)
+
+    def _cmd_cas(self, parts, block):
+        item = self._lookup(parts[1])
+        if item is None:
+            self.counters['cmd_set'] += 1
+            self.counters['cas_misses'] += 1
+            return b'NOT_FOUND\r\n'
+        if item[3] != int(parts[5]):
+            self.counters['cmd_set'] += 1
+            self.counters['cas_badval'] += 1
+            return b'EXISTS\r\n'
+        self.counters['cas_hits'] += 1
+        return self._cmd_set(parts, block)
+
+    def _cmd_incr(self, parts, block, decr=False):
+        name = 'decr' if decr else 'incr'
+        item = self._lookup(parts[1])
+        if item is None:
+            self.counters[name + '_misses'] += 1
+            return b'NOT_FOUND\r\n'
+        delta = int(parts[2])
+        try:
+            value = int(item[2])
+        except ValueError:
+            return (b'CLIENT_ERROR cannot increment or decrement '
+                    b'non-numeric value\r\n')
+        if decr:
+            value = max(0, value - delta)
         else:
-            return "unix:{}{}".format(self.address, d)
+            value = (value + delta) % 2 ** 64
+        self.counters[name + '_hits'] += 1
+        item[2] = b'%d' % value
+        self._cas_unique += 1
+        item[3] = self._cas_unique
+        return item[2] + b'\r\n'
+
+    def _cmd_decr(self, parts, block):
+        return self._cmd_incr(parts, block, decr=True)
+
+    def _cmd_touch(self, parts, block):
+        self.counters['cmd_touch'] += 1
+        item = self._lookup(parts[1])
+        if item is None:
+            self.counters['touch_misses'] += 1
+            return b'NOT_FOUND\r\n'
+        self.counters['touch_hits'] += 1
+        item[1] = self._expiry(parts[2])
+        return b'TOUCHED\r\n'
+
+    def _cmd_delete(self, parts, block):
+        if self._lookup(parts[1]) is None:
+            self.counters['delete_misses'] += 1
+            return b'NOT_FOUND\r\n'
+        self.counters['delete_hits'] += 1
+        del self.data[parts[1]]
+        return b'DELETED\r\n'
+
+    def _cmd_flush_all(self, parts, block):
+        self.counters['cmd_flush'] += 1
+        self.data.clear()
+        return b'OK\r\n'
+
+    def _cmd_version(self, parts, block):
+        return b'VERSION %s\r\n' % self.version.encode('ascii')
+
+    def _cmd_verbosity(self, parts, block):
+        return b'OK\r\n'
+
+    def _cmd_quit(self, parts, block):
+        return None
+
+    def _slab_class(self, size):
+        """Slab class of an item of C{size}, with memcached's defaults."""
+        slab_class, chunk = 1, 96
+        while chunk < size:
+            slab_class += 1
+            chunk = (int(chunk * 1.25) + 7) & ~7
+        return slab_class
+
+    def _cmd_lru_crawler(self, parts, block):
+        if parts[1] != b'metadump':
+            return b'OK\r\n'
+        classes = None
+        if parts[2] != b'all':
+            classes = set(int(c) for c in parts[2].split(b','))
+        out = []
+        now = int(time.time())
+        for key in list(self.data):
+            item = self._lookup(key)
+            if item is None:
+                continue
+            flags, expiry, value, unique = item
+            size = len(key) + len(value) + _ITEM_OVERHEAD
+            slab_class = self._slab_class(size)
+            if classes is not None and slab_class not in classes:
+                continue
+            out.append(b'key=%s exp=%d la=%d cas=%d fetch=no cls=%d size=%d\r\n'
+                       % (quote_from_bytes(key, safe='').encode('ascii'),
+                          int(expiry) if expiry else -1, now, unique,
+                          slab_class, size))
+        out.append(b'END\r\n')
+        return b''.join(out)
+
+    def _cmd_stats(self, parts, block):
+        if len(parts) > 1:
+            # Only the general statistics are implemented.
+            return b'END\r\n'
+        now = time.time()
+        stats = [
+            ('pid', os.getpid()),
+            ('uptime', int(now - self._started)),
+            ('time', int(now)),
+            ('version', self.version),
+            ('pointer_size', 64),
+            ('curr_connections', len(self._connections)),
+            ('curr_items', len(self.data)),
+            ('bytes', sum(len(item[2]) for item in self.data.values())),
+            ('evictions', 0),
+            ('limit_maxbytes', 0),
+            ('threads', threading.active_count()),
+        ]
+        stats.extend(sorted(self.counters.items()))
+        return b''.join(b'STAT %s %s\r\n'
+                        % (name.encode('ascii'), str(value).encode('ascii'))
+                        for name, value in stats) + b'END\r\n'
 
 
 def _doctest():
@@ -1532,4 +5332,219 @@ def _doctest():
         sys.exit(1)
 
 
+def _parse_range(text):
+    """Parse "N" or "MIN-MAX" into a (min, max) tuple of ints."""
+    low, _, high = text.partition('-')
+    return int(low), int(high or low)
+
+
+def _zipf_cum_weights(n, s):
+    """Cumulative weights of ranks 1..n in a Zipf distribution."""
+    total = 0.0
+    cum_weights = []
+    for rank in range(1, n + 1):
+        total += 1.0 / rank ** s
+        cum_weights.append(total)
+    return cum_weights
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _bench_worker(mc, args, keys, cum_weights, deadline, seed, latencies,
+                  counts):
+    rand = random.Random(seed)
+    gets, sets = args.ratio
+    get_fraction = float(gets) / (gets + sets)
+    value_min, value_max = args.value_size
+    values = {}
+    batch = args.multi
+    timer = time.perf_counter
+    get_times = latencies.setdefault('get_multi' if batch > 1 else 'get', [])
+    set_times = latencies.setdefault('set', [])
+    hits = misses = 0
+
+    while timer() < deadline:
+        if rand.random() < get_fraction:
+            if cum_weights is None:
+                batch_keys = [rand.choice(keys) for i in range(batch)]
+            else:
+                batch_keys = rand.choices(keys, cum_weights=cum_weights,
+                                          k=batch)
+            start = timer()
+            if batch > 1:
+                found = len(mc.get_multi(batch_keys))
+            else:
+                found = mc.get(batch_keys[0]) is not None
+            get_times.append(timer() - start)
+            hits += found
+            misses += len(batch_keys) - found
+        else:
+            if cum_weights is None:
+                key = rand.choice(keys)
+            else:
+                key = rand.choices(keys, cum_weights=cum_weights)[0]
+            size = rand.randint(value_min, value_max)
+            value = values.get(size)
+            if value is None:
+                value = values[size] = b'x' * size
+            start = timer()
+            mc.set(key, value)
+            set_times.append(timer() - start)
+    counts.append((hits, misses))
+
+
+def _bench(args):
+    """Run the load generator described by the parsed C{args}."""
+    embedded = [EmbeddedServer(latency=args.latency).start()
+                for i in range(args.embedded)]
+    servers = [s.address for s in embedded] + (args.servers or [])
+    try:
+        return _run_bench(args, servers)
+    finally:
+        for server in embedded:
+            server.stop()
+
+
+def _run_bench(args, servers):
+    mc = Client(servers, socket_timeout=args.timeout)
+    keys = ['bench:%d' % i for i in range(args.keys)]
+    cum_weights = None
+    if args.distribution == 'zipf':
+        cum_weights = _zipf_cum_weights(args.keys, args.zipf_s)
+
+    if args.prefill:
+        value_min, value_max = args.value_size
+        for i in range(0, len(keys), 100):
+            mc.set_multi(dict((key, b'x' * random.randint(value_min,
+                                                          value_max))
+                              for key in keys[i:i + 100]))
+
+    deadline = time.perf_counter() + args.duration
+    latencies = [{} for i in range(args.threads)]
+    counts = []
+    threads = [threading.Thread(target=_bench_worker, args=(
+        mc, args, keys, cum_weights, deadline, i, latencies[i], counts))
+        for i in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    ops = {}
+    for thread_latencies in latencies:
+        for op, times in thread_latencies.items():
+            ops.setdefault(op, []).extend(times)
+    total = 0
+    print('%-10s %10s %10s %9s %9s %9s %9s %9s' % (
+        'op', 'count', 'ops/sec', 'p50 ms', 'p90 ms', 'p99 ms', 'p99.9 ms',
+        'max ms'))
+    for op, times in sorted(ops.items()):
+        if not times:
+            continue
+        times.sort()
+        total += len(times)
+        percentiles = tuple(_percentile(times, p) * 1000
+                            for p in (50, 90, 99, 99.9, 100))
+        print('%-10s %10d %10.0f %9.3f %9.3f %9.3f %9.3f %9.3f' % (
+            (op, len(times), len(times) / elapsed) + percentiles))
+    hits = sum(h for h, m in counts)
+    misses = sum(m for h, m in counts)
+    print('total: %d ops in %.2fs, %.0f ops/sec, %d threads' % (
+        total, elapsed, total / elapsed, args.threads))
+    if hits + misses:
+        print('hit rate: %.1f%% (%d hits, %d misses)' % (
+            100.0 * hits / (hits + misses), hits, misses))
+    mc.disconnect_all()
+    return 0
+
+
+def main(argv=None):
+    """Command line entry point, C{python -m memcache bench --help}."""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m memcache',
+        description='Tools for the memcache client.')
+    commands = parser.add_subparsers(dest='command')
+    bench = commands.add_parser(
+        'bench', help='generate load against memcached servers',
+        description='Generate load with this client and report '
+                    'throughput and latency percentiles per operation.')
+    bench.add_argument('-s', '--server', dest='servers', action='append',
+                       help='server address, as accepted by Client '
+                            '(repeatable, default 127.0.0.1:11211)')
+    bench.add_argument('--keys', type=int, default=10000,
+                       help='size of the key space (default 10000)')
+    bench.add_argument('--distribution', choices=('uniform', 'zipf'),
+                       default='uniform', help='key popularity')
+    bench.add_argument('--zipf-s', type=float, default=1.0,
+                       help='exponent of the zipf distribution')
+    bench.add_argument('--value-size', type=_parse_range, default=(100, 100),
+                       metavar='N|MIN-MAX',
+                       help='value size in bytes (default 100)')
+    bench.add_argument('--ratio', default='9:1', metavar='GET:SET',
+                       type=lambda text: tuple(map(int, text.split(':'))),
+                       help='get to set ratio (default 9:1)')
+    bench.add_argument('--multi', type=int, default=1, metavar='N',
+                       help='keys per get, more than 1 uses get_multi')
+    bench.add_argument('--threads', type=int, default=1)
+    bench.add_argument('--duration', type=float, default=10.0,
+                       help='seconds to run (default 10)')
+    bench.add_argument('--timeout', type=float, default=_SOCKET_TIMEOUT,
+                       help='socket timeout in seconds')
+    bench.add_argument('--no-prefill', dest='prefill', action='store_false',
+                       help="don't store every key before starting")
+    bench.add_argument('--embedded', type=int, default=0, metavar='N',
+                       help='start N embedded servers and use them')
+    bench.add_argument('--latency', type=float, default=0.0,
+                       help='latency in seconds of the embedded servers')
+
+    serve = commands.add_parser(
+        'serve', help='run an embedded stand-in server',
+        description='Run a pure-Python memcached stand-in server until '
+                    'interrupted.')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('-p', '--port', type=int, default=11211)
+    serve.add_argument('--latency', type=float, default=0.0,
+                       help='seconds to wait before each response')
+    serve.add_argument('--drop-rate', type=float, default=0.0,
+                       help='probability of dropping the connection '
+                            'instead of answering')
+    serve.add_argument('--write-chunk', type=int, default=None, metavar='N',
+                       help='write responses N bytes at a time')
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return 0
+    if args.command == 'serve':
+        server = EmbeddedServer(args.host, args.port, args.latency,
+                                args.drop_rate, args.write_chunk).start()
+        print('Listening on %s' % server.address)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.stop()
+        return 0
+    # Checked before any thread starts, the workers would fail one by one.
+    if args.keys < 1:
+        bench.error('--keys must be at least 1')
+    if len(args.ratio) != 2 or min(args.ratio) < 0 or not sum(args.ratio):
+        bench.error('--ratio must be GET:SET, with at least one non-zero')
+    if not args.servers and not args.embedded:
+        args.servers = ['127.0.0.1:11211']
+    return _bench(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
 # vim: ts=4 sw=4 et :
@@ -0,0 +1,49 @@
+from __future__ import print_function
+
+import unittest
+
+import memcache
+from .utils import captured_output, fake_servers
+
+
+class TestBench(unittest.TestCase):
+    def run_bench(self, *args):
+        with fake_servers(('a', 11211), ('b', 11211)) as servers:
+            with captured_output('stdout') as out:
+                status = memcache.main(
+                    ['bench', '-s', 'a:11211', '-s', 'b:11211',
+                     '--keys', '50', '--duration', '0.1'] + list(args))
+        self.assertEqual(status, 0)
+        return out.getvalue(), servers
+
+    def test_get_set(self):
+        out, servers = self.run_bench('--ratio', '1:1', '--threads', '2',
+                                      '--value-size', '10-20')
+        lines = out.splitlines()
+        self.assertEqual(lines[0].split()[:3], ['op', 'count', 'ops/sec'])
+        self.assertEqual([line.split()[0] for line in lines[1:3]],
+                         ['get', 'set'])
+        self.assertIn('hit rate: 100.0%', out)
+        self.assertEqual(sum(len(s.data) for s in servers), 50)
+
+    def test_zipf_multi(self):
+        out, servers = self.run_bench('--distribution', 'zipf', '--multi',
+                                      '5', '--ratio', '1:0', '--no-prefill')
+        self.assertTrue(out.splitlines()[1].startswith('get_multi '))
+        self.assertIn('hit rate: 0.0%', out)
+
+    def test_bad_arguments(self):
+        for args in (['--keys', '0'], ['--ratio', '0:0'], ['--ratio', '1']):
+            with captured_output('stderr') as err:
+                self.assertRaises(SystemExit, memcache.main,
+                                  ['bench', '-s', 'a:11211'] + args)
+            self.assertIn(args[0], err.getvalue())
+
+    def test_no_command(self):
+        with captured_output('stdout') as out:
+            self.assertEqual(memcache.main([]), 0)
+        self.assertIn('bench', out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,780 @@
+from __future__ import print_function
+
+import array
+import asyncio
+import itertools
+import mmap
+import os
+import pickle
+import socket
+import threading
+import time
+import unittest
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import memcache
+from memcache import AutoBatcher, Client, CompressionPool, EmbeddedServer
+from .utils import captured_output, captured_stderr
+
+
+class EmbeddedTestCase(unittest.TestCase):
+    nservers = 1
+    client_args = {}
+
+    def setUp(self):
+        self.servers = []
+        for i in range(self.nservers):
+            server = EmbeddedServer().start()
+            self.addCleanup(server.stop)
+            self.servers.append(server)
+        self.mc = Client([s.address for s in self.servers], **self.client_args)
+        self.addCleanup(self.mc.disconnect_all)
+
+
+class TestProtocol(EmbeddedTestCase):
+    def test_storage_commands(self):
+        self.assertTrue(self.mc.set('key', 'value'))
+        self.assertFalse(self.mc.add('key', 'other'))
+        self.assertTrue(self.mc.replace('key', 'new'))
+        self.assertFalse(self.mc.replace('missing', 'value'))
+        self.assertTrue(self.mc.append('key', 'er'))
+        self.assertTrue(self.mc.prepend('key', 're'))
+        self.assertEqual(self.mc.get('key'), 'renewer')
+
+    def test_cas(self):
+        mc = Client([self.servers[0].address], cache_cas=True)
+        mc.set('key', 1)
+        self.assertEqual(mc.gets('key'), 1)
+        self.mc.set('key', 2)
+        self.assertFalse(mc.cas('key', 3))
+        self.assertEqual(mc.gets('key'), 2)
+        self.assertTrue(mc.cas('key', 3))
+        self.assertEqual(self.mc.get('key'), 3)
+
+    def test_incr_decr(self):
+        self.assertEqual(self.mc.incr('counter'), None)
+        self.mc.set('counter', 10)
+        self.assertEqual(self.mc.incr('counter', 5), 15)
+        self.assertEqual(self.mc.decr('counter', 20), 0)
+
+    def test_touch_and_expiry(self):
+        self.mc.set('key', 'value')
+        self.assertTrue(self.mc.touch('key', -1))
+        self.assertEqual(self.mc.get('key'), None)
+        self.assertFalse(self.mc.touch('key', 10))
+
+    def test_delete_and_flush(self):
+        self.mc.set_multi({'a': 1, 'b': 2}, noreply=True)
+        self.assertEqual(self.mc.delete('a'), 1)
+        self.assertEqual(self.mc.get_multi(['a', 'b']), {'b': 2})
+        self.mc.flush_all()
+        self.assertEqual(self.mc.get('b'), None)
+
+    def test_stats(self):
+        self.mc.set('key', 'value')
+        self.mc.get('key')
+        self.mc.get('missing')
+        (name, stats), = self.mc.get_stats()
+        self.assertEqual(stats['version'], EmbeddedServer.version)
+        self.assertEqual(stats['curr_items'], '1')
+        self.assertEqual((stats['get_hits'], stats['get_misses']), ('1', '1'))
+
+    def test_too_large(self):
+        self.servers[0].item_size_max = 1000
+        self.mc.set('key', 'value')
+        with captured_stderr():
+            self.assertFalse(self.mc.set('key', b'x' * 1000))
+        self.assertEqual(self.mc.get('key'), None)
+
+
+class TestFaultInjection(EmbeddedTestCase):
+    def test_partial_writes(self):
+        self.servers[0].write_chunk = 7
+        value = dict((i, 'x' * i) for i in range(100))
+        self.mc.set_multi({'a': value, 'b': 'short'})
+        self.assertEqual(self.mc.get_multi(['a', 'b']),
+                         {'a': value, 'b': 'short'})
+
+    def test_dropped_connection(self):
+        self.mc.set('key', 'value')
+        self.servers[0].drop_rate = 1.0
+        with captured_stderr():
+            self.assertEqual(self.mc.get('key'), None)
+        self.assertTrue(self.mc.servers[0].deaduntil)
+
+    def test_latency(self):
+        self.servers[0].latency = 0.05
+        start = time.time()
+        self.mc.get('key')
+        self.assertGreaterEqual(time.time() - start, 0.05)
+
+
+class TestHedgedReads(EmbeddedTestCase):
+    nservers = 2
+    client_args = {'replication_factor': 2, 'hedge_after': 0.01}
+
+    def test_slow_primary(self):
+        self.mc.set('key', 'value')
+        primary = self.mc._get_server(b'key')[0]
+        slow, = [s for s in self.servers if s.port == primary.address[1]]
+        slow.latency = 1.0
+        start = time.time()
+        self.assertEqual(self.mc.get('key'), 'value')
+        self.assertLess(time.time() - start, 0.5)
+
+
+class TestClusterStats(EmbeddedTestCase):
+    nservers = 2
+
+    def test_typed_stats_and_totals(self):
+        self.mc.set_multi(dict(('key%d' % i, i) for i in range(10)))
+        self.mc.get_multi(['key1', 'key2', 'missing'])
+        stats = self.mc.get_cluster_stats()
+        self.assertEqual(stats.errors, {})
+        self.assertEqual(sorted(stats.nodes),
+                         sorted(s.name for s in self.mc.servers))
+        for node in stats.nodes.values():
+            self.assertIsInstance(node['curr_items'], int)
+            self.assertEqual(node['version'], EmbeddedServer.version)
+        self.assertEqual(stats.totals['curr_items'], 10)
+        self.assertEqual(stats.totals['get_hits'], 2)
+        self.assertAlmostEqual(stats.totals['hit_ratio'], 2.0 / 3)
+        self.assertNotIn('pid', stats.totals)
+
+    def test_rates(self):
+        before = self.mc.get_cluster_stats()
+        for i in range(10):
+            self.mc.get('key%d' % i)
+        after = self.mc.get_cluster_stats()
+        nodes, totals = after.rates_since(before)
+        self.assertEqual(len(nodes), 2)
+        elapsed = after.timestamp - before.timestamp
+        self.assertAlmostEqual(totals['get_misses'] * elapsed, 10)
+        self.assertGreater(totals['bytes_read'], 0)
+
+    def test_deadline(self):
+        self.servers[0].latency = 1.0
+        self.servers[1].stop()
+        start = time.time()
+        stats = self.mc.get_cluster_stats(timeout=0.2)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(stats.nodes, {})
+        self.assertEqual(sorted(stats.errors),
+                         sorted(s.name for s in self.mc.servers))
+
+
+class TestMetadump(EmbeddedTestCase):
+    nservers = 2
+
+    def setUp(self):
+        super(TestMetadump, self).setUp()
+        # Keys are percent-encoded in the dump.
+        self.mapping = dict(('ns:%%%d' % i, 'x' * i * 10) for i in range(100))
+        self.mc.set_multi(self.mapping, time=3600)
+
+    def test_all_keys(self):
+        items = list(self.mc.iter_metadump())
+        self.assertEqual(sorted(item.key for item in items),
+                         sorted(key.encode('ascii') for key in self.mapping))
+        item = items[0]
+        self.assertIn(item.server, [s.name for s in self.mc.servers])
+        self.assertGreater(item.exp, time.time())
+        self.assertGreater(item.size, 0)
+        self.assertGreaterEqual(item.slab_class, 1)
+
+    def test_slab_classes(self):
+        items = list(self.mc.iter_metadump(slab_classes=[1]))
+        self.assertTrue(items)
+        self.assertEqual(set(item.slab_class for item in items), set([1]))
+
+    def test_parallel(self):
+        items = list(self.mc.iter_metadump(parallel=True, queue_size=5))
+        self.assertEqual(len(items), len(self.mapping))
+        self.assertEqual(len(set(item.server for item in items)), 2)
+
+    def test_early_close(self):
+        items = self.mc.iter_metadump(parallel=True, queue_size=1)
+        next(items)
+        items.close()
+
+    def test_server_error(self):
+        self.servers[1].stop()
+        with self.assertRaises(OSError):
+            list(self.mc.iter_metadump(parallel=True))
+
+
+class TestIterGetMulti(EmbeddedTestCase):
+    nservers = 2
+
+    def setUp(self):
+        super(TestIterGetMulti, self).setUp()
+        self.mapping = dict(('key%d' % i, i) for i in range(250))
+        self.mc.set_multi(self.mapping, key_prefix='p:')
+
+    def test_yields_all_found(self):
+        keys = (key for key in list(self.mapping) + ['missing1', 'missing2'])
+        result = list(self.mc.iter_get_multi(keys, key_prefix='p:',
+                                             batch_size=7, max_in_flight=3))
+        self.assertEqual(len(result), len(self.mapping))
+        self.assertEqual(dict(result), self.mapping)
+
+    def test_bounded_consumption(self):
+        keys = ('key%d' % (i % 250) for i in itertools.count())
+        results = self.mc.iter_get_multi(keys, key_prefix='p:', batch_size=10)
+        first = list(itertools.islice(results, 1000))
+        self.assertEqual(len(first), 1000)
+        results.close()
+        # Connections with unread responses were closed, not left
+        # out of sync.
+        self.assertEqual(self.mc.get('p:key3'), 3)
+        self.assertEqual(self.mc.get_multi(['key1', 'key2'], 'p:'),
+                         {'key1': 1, 'key2': 2})
+
+    def test_closed_mid_response(self):
+        mc = Client([self.servers[0].address])
+        self.addCleanup(mc.disconnect_all)
+        mapping = dict(('key%d' % i, i) for i in range(50))
+        mc.set_multi(mapping)
+        results = mc.iter_get_multi(mapping, batch_size=100, max_in_flight=1)
+        next(results)
+        results.close()
+        self.assertEqual(mc.get('key49'), 49)
+        self.assertEqual(mc.get_multi(['key1', 'key2']), {'key1': 1, 'key2': 2})
+
+    def test_server_failure(self):
+        self.servers[1].drop_rate = 1.0
+        with captured_stderr():
+            result = dict(self.mc.iter_get_multi(self.mapping, 'p:',
+                                                 batch_size=10))
+        self.assertTrue(result)
+        for key, value in result.items():
+            self.assertEqual(self.mapping[key], value)
+
+
+class TestIterGetMultiReplicas(EmbeddedTestCase):
+    nservers = 2
+    client_args = {'replication_factor': 2}
+
+    def test_falls_back_to_replica(self):
+        mapping = dict(('key%d' % i, i) for i in range(50))
+        self.mc.set_multi(mapping)
+        self.servers[0].data.clear()
+        self.assertEqual(dict(self.mc.iter_get_multi(mapping, batch_size=8)),
+                         mapping)
+
+
+class TestDeadline(EmbeddedTestCase):
+    nservers = 2
+
+    def setUp(self):
+        super(TestDeadline, self).setUp()
+        self.mapping = dict(('key%d' % i, i) for i in range(20))
+        self.mc.set_multi(self.mapping)
+        self.slow = self.servers[0]
+        self.slow_host, = [h for h in self.mc.servers
+                           if h.address[1] == self.slow.port]
+        self.slow_keys = [k for k in self.mapping
+                          if self.mc._get_server(k.encode())[0]
+                          is self.slow_host]
+        self.slow.latency = 0.5
+
+    def assertFaster(self, start, seconds):
+        self.assertLess(time.time() - start, seconds)
+
+    def test_single_key(self):
+        start = time.time()
+        self.assertEqual(self.mc.get(self.slow_keys[0], timeout=0.1), None)
+        self.assertFalse(self.mc.set(self.slow_keys[0], 1, timeout=0.1))
+        self.assertFaster(start, 0.4)
+        self.assertFalse(self.slow_host.deaduntil)
+
+        self.slow.latency = 0
+        self.assertEqual(self.mc.get(self.slow_keys[0]),
+                         self.mapping[self.slow_keys[0]])
+
+    def test_get_multi_partial_results(self):
+        start = time.time()
+        result = self.mc.get_multi(list(self.mapping), timeout=0.2)
+        self.assertFaster(start, 0.45)
+        fast = dict((k, v) for k, v in self.mapping.items()
+                    if k not in self.slow_keys)
+        self.assertEqual(result, fast)
+        self.assertFalse(any(h.deaduntil for h in self.mc.servers))
+
+    def test_budget_shared_by_block(self):
+        self.slow.latency = 0.1
+        start = time.time()
+        with self.mc.deadline(0.15):
+            self.assertEqual(self.mc.get(self.slow_keys[0]),
+                             self.mapping[self.slow_keys[0]])
+            self.assertEqual(self.mc.get(self.slow_keys[1]), None)
+            with self.mc.deadline(10):
+                self.assertEqual(self.mc.get(self.slow_keys[2]), None)
+        self.assertFaster(start, 0.25)
+        self.assertEqual(self.mc.get(self.slow_keys[1]),
+                         self.mapping[self.slow_keys[1]])
+
+    def test_expired_before_send(self):
+        self.assertTrue(self.slow_host.connect())
+        with self.mc.deadline(0.01):
+            time.sleep(0.02)
+            self.assertRaises(socket.timeout, self.slow_host.send_cmd,
+                              b'version')
+        # Not left non-blocking by a timeout of 0.
+        self.assertNotEqual(self.slow_host.socket.gettimeout(), 0)
+
+
+class TestAsyncGet(EmbeddedTestCase):
+    nservers = 2
+
+    def test_auto_batched(self):
+        batcher = AutoBatcher(window=0.05)
+        mc = Client([s.address for s in self.servers], auto_batch=batcher)
+        keys = ['key%d' % i for i in range(20)]
+        mc.set_multi(dict((key, key.upper()) for key in keys))
+
+        async def main():
+            return await asyncio.gather(
+                *[mc.aget(key) for key in keys + ['missing']],
+                mc.aget('missing', 'default'))
+        values = asyncio.run(main())
+        self.assertEqual(values, [key.upper() for key in keys] + [None, 'default'])
+        self.assertEqual(batcher.stats(), {'keys': 22, 'batches': 1})
+
+    def test_without_batcher(self):
+        self.mc.set('key', 1)
+        self.assertEqual(asyncio.run(self.mc.aget('key')), 1)
+
+
+class CountingUnpickler(pickle.Unpickler):
+    loads = 0
+
+    def load(self):
+        CountingUnpickler.loads += 1
+        return super(CountingUnpickler, self).load()
+
+
+class TestLazyGetMulti(EmbeddedTestCase):
+    nservers = 2
+    client_args = {'unpickler': CountingUnpickler}
+
+    def setUp(self):
+        super(TestLazyGetMulti, self).setUp()
+        self.values = dict(('key%d' % i, {'n': i}) for i in range(10))
+        self.mc.set_multi(self.values, min_compress_len=1)
+        self.mc.set('text', 'abc')
+        CountingUnpickler.loads = 0
+
+    def test_decoded_on_access(self):
+        result = self.mc.get_multi(list(self.values) + ['text', 'missing'],
+                                   lazy=True)
+        self.assertEqual(len(result), 11)
+        self.assertIn('key3', result)
+        self.assertNotIn('missing', result)
+        self.assertEqual(sorted(result), sorted(list(self.values) + ['text']))
+        self.assertEqual(CountingUnpickler.loads, 0)
+
+        self.assertEqual(result['key3'], {'n': 3})
+        self.assertIs(result['key3'], result['key3'])
+        self.assertEqual(result.get('text'), 'abc')
+        self.assertEqual(CountingUnpickler.loads, 1)
+        self.assertEqual(repr(result), '<LazyResults of 11 keys, 2 decoded>')
+
+        self.assertEqual(dict(result), dict(self.values, text='abc'))
+        self.assertEqual(CountingUnpickler.loads, 10)
+
+    def test_eager_by_default(self):
+        self.assertEqual(self.mc.get_multi(['key1', 'key2']),
+                         {'key1': {'n': 1}, 'key2': {'n': 2}})
+        self.assertEqual(CountingUnpickler.loads, 2)
+
+
+class TestCompressionPool(EmbeddedTestCase):
+    nservers = 2
+
+    def setUp(self):
+        self.threads = []
+        self.pool = CompressionPool(max_workers=2, threshold=1000)
+        self.addCleanup(self.pool.shutdown)
+        self.client_args = {'compression_pool': self.pool,
+                            'compressor': self.compress,
+                            'decompressor': self.decompress}
+        super(TestCompressionPool, self).setUp()
+        # Compresses to about half, still above the threshold.
+        self.values = dict(('key%d' % i, os.urandom(2000).hex())
+                           for i in range(10))
+        self.values['small'] = 'x' * 100
+
+    def compress(self, data):
+        self.threads.append(('compress', threading.current_thread().name))
+        return zlib.compress(data)
+
+    def decompress(self, data):
+        self.threads.append(('decompress', threading.current_thread().name))
+        return zlib.decompress(data)
+
+    def in_pool(self, operation):
+        return [name.startswith('memcache-compression')
+                for op, name in self.threads if op == operation]
+
+    def test_set_and_get_multi(self):
+        self.assertEqual(self.mc.set_multi(self.values, min_compress_len=10),
+                         [])
+        self.assertEqual(sorted(self.in_pool('compress')), [False] + [True] * 10)
+        self.assertEqual(self.mc.get_multi(list(self.values) + ['missing']),
+                         self.values)
+        self.assertEqual(sorted(self.in_pool('decompress')),
+                         [False] + [True] * 10)
+
+    def test_single_key_commands_not_pooled(self):
+        self.mc.set('key', self.values['key1'], min_compress_len=10)
+        self.assertEqual(self.mc.get('key'), self.values['key1'])
+        self.assertEqual(self.in_pool('compress') + self.in_pool('decompress'),
+                         [False, False])
+
+    def test_compressor_set_after_construction(self):
+        mc = Client([s.address for s in self.servers],
+                    compression_pool=self.pool)
+        self.addCleanup(mc.disconnect_all)
+        mc.compressor = self.compress
+        mc.decompressor = self.decompress
+        self.assertEqual(mc.set_multi(self.values, min_compress_len=10), [])
+        self.assertEqual(sorted(self.in_pool('compress')), [False] + [True] * 10)
+        self.assertEqual(mc.get_multi(list(self.values)), self.values)
+        self.assertEqual(sorted(self.in_pool('decompress')),
+                         [False] + [True] * 10)
+
+    def test_no_compression(self):
+        self.mc.set_multi(self.values)
+        self.assertEqual(self.mc.get_multi(list(self.values)), self.values)
+        self.assertEqual(self.threads, [])
+
+
+class TestPickleBuffers(EmbeddedTestCase):
+    nservers = 2
+    client_args = {'pickle_buffers': 1000}
+
+    def setUp(self):
+        super(TestPickleBuffers, self).setUp()
+        self.value = {'bytes': os.urandom(5000),
+                      'bytearray': bytearray(os.urandom(3000)),
+                      'buffer': pickle.PickleBuffer(bytearray(b'b' * 2000)),
+                      'small': b'x' * 10}
+
+    def check(self, value):
+        self.assertEqual(sorted(value), sorted(self.value))
+        self.assertIsInstance(value['bytes'], bytes)
+        self.assertEqual(value['bytes'], self.value['bytes'])
+        self.assertIsInstance(value['bytearray'], bytearray)
+        self.assertEqual(value['bytearray'], self.value['bytearray'])
+        self.assertEqual(bytes(value['buffer']), b'b' * 2000)
+        self.assertEqual(value['small'], b'x' * 10)
+
+    def test_set_and_get(self):
+        self.assertTrue(self.mc.set('key', self.value))
+        item = self.servers[0].data.get(b'key') or self.servers[1].data[b'key']
+        self.assertEqual(int(item[0]), Client._FLAG_PICKLE | Client._FLAG_PICKLE_BUFFERS)
+        self.check(self.mc.get('key'))
+
+    def test_multi(self):
+        values = dict(('key%d' % i, self.value) for i in range(10))
+        self.assertEqual(self.mc.set_multi(values), [])
+        result = self.mc.get_multi(list(values))
+        self.assertEqual(sorted(result), sorted(values))
+        for value in result.values():
+            self.check(value)
+        for value in self.mc.get_multi(list(values), lazy=True).values():
+            self.check(value)
+
+    def test_compressed(self):
+        self.mc.set('key', self.value, min_compress_len=1)
+        self.check(self.mc.get('key'))
+
+    def test_small_values_in_band(self):
+        self.mc.set('key', {'small': b'x' * 10})
+        other = Client([s.address for s in self.servers])
+        self.addCleanup(other.disconnect_all)
+        self.assertEqual(other.get('key'), {'small': b'x' * 10})
+
+    def test_persistent_id(self):
+        mc = Client([s.address for s in self.servers], pickle_buffers=1000,
+                    pid=lambda obj: 'one' if obj == 1 else None,
+                    pload=lambda pid: 1)
+        self.addCleanup(mc.disconnect_all)
+        mc.set('key', [1, os.urandom(2000)])
+        self.assertEqual(mc.get('key')[0], 1)
+
+    def test_partial_sendmsg(self):
+        sent = []
+
+        class Socket(object):
+            def sendmsg(self, buffers):
+                data = b''.join(buffers)[:3]
+                sent.append(data)
+                return len(data)
+
+        host = memcache._Host('127.0.0.1:1')
+        host.socket = Socket()
+        host.send_segments([b'ab', b'cdefg', bytearray(b'h')])
+        self.assertEqual(sent, [b'abc', b'def', b'gh'])
+        self.assertEqual(host.bytes_sent, 8)
+
+    def test_many_segments(self):
+        calls = []
+
+        class Socket(object):
+            def sendmsg(self, buffers):
+                calls.append(len(buffers))
+                return sum(len(b) for b in buffers[:-1]) + 1
+
+        segments = [b'%05d' % i for i in range(2000)]
+        host = memcache._Host('127.0.0.1:1')
+        host.socket = Socket()
+        host.send_segments(segments)
+        self.assertEqual(host.bytes_sent, 10000)
+        self.assertLessEqual(max(calls), memcache._IOV_MAX)
+        self.assertLess(len(calls), 10)
+
+    def test_protocols_interoperate(self):
+        old = Client([s.address for s in self.servers], pickleProtocol=0)
+        new = Client([s.address for s in self.servers],
+                     pickleProtocol=pickle.HIGHEST_PROTOCOL)
+        self.addCleanup(old.disconnect_all)
+        self.addCleanup(new.disconnect_all)
+        old.set('old', {'a': [1, 2]})
+        new.set('new', {'b': (3, 4)})
+        self.assertEqual(new.get('old'), {'a': [1, 2]})
+        self.assertEqual(old.get('new'), {'b': (3, 4)})
+        self.assertEqual(self.mc.get('old'), {'a': [1, 2]})
+
+
+class TestBufferValues(EmbeddedTestCase):
+    nservers = 2
+
+    def stored_flags(self, key):
+        item = (self.servers[0].data.get(key) or self.servers[1].data[key])
+        return int(item[0])
+
+    def test_stored_raw(self):
+        values = {'view': memoryview(b'view bytes'),
+                  'array': array.array('i', range(10)),
+                  'strided': memoryview(b'0123456789')[::2]}
+        for key, value in values.items():
+            self.assertTrue(self.mc.set(key, value))
+            self.assertEqual(self.stored_flags(key.encode('ascii')), 0)
+            self.assertEqual(self.mc.get(key), memoryview(value).tobytes())
+
+    def test_mmap(self):
+        region = mmap.mmap(-1, 4096)
+        self.addCleanup(region.close)
+        region.write(b'mapped')
+        self.mc.set('key', region)
+        self.assertEqual(self.mc.get('key'), b'mapped' + b'\0' * 4090)
+
+    def test_bytearray_keeps_type(self):
+        value = bytearray(os.urandom(5000))
+        self.assertEqual(self.mc.set_multi({'a': value, 'b': bytearray()}), [])
+        self.assertEqual(self.stored_flags(b'a'), Client._FLAG_BYTEARRAY)
+        result = self.mc.get_multi(['a', 'b'])
+        self.assertIs(type(result['a']), bytearray)
+        self.assertEqual(result, {'a': value, 'b': bytearray()})
+        self.mc.set('a', value, min_compress_len=1)
+        self.assertEqual(self.mc.get('a'), value)
+        self.assertIs(type(self.mc.get('a')), bytearray)
+
+    def test_return_memoryview(self):
+        mc = Client([s.address for s in self.servers], return_memoryview=True)
+        self.addCleanup(mc.disconnect_all)
+        mc.set_multi({'bytes': b'raw', 'text': 'text', 'ba': bytearray(b'x')})
+        value = mc.get('bytes')
+        self.assertIsInstance(value, memoryview)
+        self.assertEqual(value, b'raw')
+        self.assertEqual(mc.get_multi(['bytes', 'text', 'ba']),
+                         {'bytes': b'raw', 'text': 'text', 'ba': bytearray(b'x')})
+        self.assertIs(type(mc.get('ba')), bytearray)
+
+
+@unittest.skipIf(numpy is None, 'requires numpy')
+class TestNumpyArrays(EmbeddedTestCase):
+    nservers = 2
+
+    def check(self, value, expected):
+        self.assertIs(type(value), numpy.ndarray)
+        self.assertEqual(value.dtype, expected.dtype)
+        self.assertEqual(value.shape, expected.shape)
+        self.assertTrue(numpy.array_equal(value, expected))
+
+    def test_set_and_get(self):
+        arrays = [numpy.arange(12, dtype='<f8').reshape(3, 4),
+                  numpy.arange(12, dtype='>i4').reshape(3, 4).T,
+                  numpy.arange(24, dtype='u2').reshape(4, 6)[::2, 1:5],
+                  numpy.array(7, dtype='i8'),
+                  numpy.zeros((0, 3), dtype='f4'),
+                  numpy.array(['ab', 'cde'])]
+        for expected in arrays:
+            self.assertTrue(self.mc.set('key', expected))
+            item = self.servers[0].data.get(b'key') or self.servers[1].data[b'key']
+            self.assertEqual(int(item[0]), Client._FLAG_NUMPY)
+            self.check(self.mc.get('key'), expected)
+
+    def test_fortran_order(self):
+        array = numpy.asfortranarray(numpy.arange(6).reshape(2, 3))
+        self.mc.set('key', array)
+        value = self.mc.get('key')
+        self.check(value, array)
+        self.assertTrue(value.flags.f_contiguous)
+
+    def test_view_of_received_buffer(self):
+        array = numpy.arange(1000, dtype='f8')
+        self.mc.set('key', array)
+        value = self.mc.get('key')
+        self.check(value, array)
+        self.assertFalse(value.flags.owndata)
+        self.assertTrue(value.flags.writeable)
+
+    def test_multi_and_compressed(self):
+        arrays = dict(('key%d' % i, numpy.full((50, 20), i, dtype='i4'))
+                      for i in range(10))
+        self.assertEqual(self.mc.set_multi(arrays, min_compress_len=100), [])
+        result = self.mc.get_multi(list(arrays))
+        self.assertEqual(sorted(result), sorted(arrays))
+        for key, expected in arrays.items():
+            self.check(result[key], expected)
+
+    def test_object_arrays_pickled(self):
+        array = numpy.array([1, 'a', None], dtype=object)
+        self.mc.set('key', array)
+        item = self.servers[0].data.get(b'key') or self.servers[1].data[b'key']
+        self.assertEqual(int(item[0]), Client._FLAG_PICKLE)
+        self.assertEqual(list(self.mc.get('key')), [1, 'a', None])
+
+
+class TestNamespaces(EmbeddedTestCase):
+    nservers = 2
+
+    def test_invalidate(self):
+        self.assertTrue(self.mc.set('name', 'alice', namespace='user:42'))
+        self.mc.set_multi({'a': 1, 'b': 2}, namespace='user:42')
+        self.mc.set('name', 'bob', namespace='user:43')
+        self.assertEqual(self.mc.get('name', namespace='user:42'), 'alice')
+        self.assertEqual(self.mc.get_multi(['a', 'b'], namespace='user:42'),
+                         {'a': 1, 'b': 2})
+        self.assertEqual(self.mc.get('name'), None)
+
+        version = self.mc.namespace_version('user:42')
+        self.assertEqual(self.mc.invalidate_namespace('user:42'), version + 1)
+        self.assertEqual(self.mc.get('name', namespace='user:42'), None)
+        self.assertEqual(self.mc.get_multi(['a', 'b'], namespace='user:42'), {})
+        self.assertEqual(self.mc.get('name', namespace='user:43'), 'bob')
+
+    def test_delete(self):
+        self.mc.set_multi({'a': 1, 'b': 2, 'c': 3}, namespace='ns')
+        self.assertTrue(self.mc.delete('a', namespace='ns'))
+        self.mc.delete_multi(['b'], namespace='ns')
+        self.assertEqual(self.mc.get_multi(['a', 'b', 'c'], namespace='ns'),
+                         {'c': 3})
+
+    def test_int_keys(self):
+        self.assertTrue(self.mc.set(42, 'answer', namespace='ns'))
+        self.assertEqual(self.mc.get(42, namespace='ns'), 'answer')
+        self.assertTrue(self.mc.delete(42, namespace='ns'))
+        self.assertEqual(self.mc.get(42, namespace='ns'), None)
+
+    def test_version_key_reserved(self):
+        self.mc.set('ns:sessions', 'plain')
+        self.assertTrue(self.mc.set('x', 1, namespace='sessions'))
+        self.assertEqual(self.mc.get('x', namespace='sessions'), 1)
+        self.mc.invalidate_namespace('sessions')
+        self.assertEqual(self.mc.get('ns:sessions'), 'plain')
+        self.assertEqual(self.mc.get('x', namespace='sessions'), None)
+
+    def test_version_cached(self):
+        mc = Client([s.address for s in self.servers], namespace_ttl=60)
+        self.addCleanup(mc.disconnect_all)
+        mc.set('key', 1, namespace='ns')
+        self.mc.invalidate_namespace('ns')
+        # Stale until the cached version expires.
+        self.assertEqual(mc.get('key', namespace='ns'), 1)
+        mc._namespace_versions.clear()
+        self.assertEqual(mc.get('key', namespace='ns'), None)
+
+    def test_evicted_version_not_reused(self):
+        self.mc.set('key', 1, namespace='ns')
+        version = self.mc.namespace_version('ns')
+        self.mc.invalidate_namespace('ns')
+        self.mc.delete(self.mc._namespace_version_key('ns'))
+        self.mc._namespace_versions.clear()
+        self.assertGreater(self.mc.namespace_version('ns'), version + 1)
+        self.assertEqual(self.mc.get('key', namespace='ns'), None)
+
+    def test_unreachable(self):
+        for server in self.servers:
+            server.stop()
+        self.mc.disconnect_all()
+        with captured_stderr():
+            self.assertEqual(self.mc.get('key', 'default', namespace='ns'),
+                             'default')
+            self.assertEqual(self.mc.set_multi({'a': 1}, namespace='ns'), ['a'])
+            self.assertEqual(self.mc.invalidate_namespace('ns'), None)
+
+
+class TestFork(EmbeddedTestCase):
+    nservers = 2
+
+    def test_inherited_sockets_dropped(self):
+        self.mc.set_multi({'a': 1, 'b': 2})
+        inherited = [s.socket for s in self.mc.servers]
+        memcache._after_fork_in_child()
+        self.assertEqual(self.mc.get_multi(['a', 'b']), {'a': 1, 'b': 2})
+        for server, old in zip(self.mc.servers, inherited):
+            self.assertIsNotNone(server.socket)
+            self.assertIsNot(server.socket, old)
+            self.assertEqual(old.fileno(), -1)
+
+    def test_preconnect(self):
+        self.assertEqual(self.mc.preconnect(), 2)
+        sockets = [s.socket for s in self.mc.servers]
+        self.assertEqual(self.mc.preconnect(timeout=1), 2)
+        self.assertEqual([s.socket for s in self.mc.servers], sockets)
+
+        self.mc.disconnect_all()
+        self.servers[1].stop()
+        with captured_stderr():
+            self.assertEqual(self.mc.preconnect(), 1)
+
+    def test_preconnect_on_fork(self):
+        mc = Client([s.address for s in self.servers], preconnect_on_fork=True)
+        self.addCleanup(mc.disconnect_all)
+        memcache._after_fork_in_child()
+        self.assertTrue(all(s.socket is not None for s in mc.servers))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_fork(self):
+        self.mc.set('key', 'parent')
+        pid = os.fork()
+        if pid == 0:
+            ok = False
+            try:
+                ok = self.mc.get('key') == 'parent' and self.mc.set('key', 'child')
+            finally:
+                os._exit(0 if ok else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(self.mc.get('key'), 'child')
+
+
+class TestBenchEmbedded(unittest.TestCase):
+    def test_bench(self):
+        with captured_output('stdout') as out:
+            status = memcache.main(['bench', '--embedded', '2', '--keys',
+                                    '20', '--duration', '0.1'])
+        self.assertEqual(status, 0)
+        self.assertIn('hit rate: 100.0%', out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,408 @@
+from __future__ import print_function
+
+import socket
+import threading
+import time
+import unittest
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+from memcache import (Client, ClientMetrics, HealthChecker, _CircuitBreaker,
+                      _DNSCache, _Host, _connect_staggered)
+from .utils import captured_stderr, fake_servers
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_trips_after_consecutive_failures(self):
+        breaker = _CircuitBreaker(dead_retry=10, jitter=0, failure_threshold=3)
+        self.assertFalse(breaker.record_failure())
+        self.assertFalse(breaker.record_failure())
+        self.assertTrue(breaker.record_failure())
+        self.assertEqual(breaker.state, _CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_success_resets_consecutive_failures(self):
+        breaker = _CircuitBreaker(failure_threshold=2)
+        breaker.record_failure()
+        breaker.record_success()
+        self.assertFalse(breaker.record_failure())
+        self.assertEqual(breaker.state, _CircuitBreaker.CLOSED)
+
+    def test_connect_keeps_consecutive_failures(self):
+        breaker = _CircuitBreaker(failure_threshold=2)
+        breaker.record_failure()
+        breaker.record_connect()
+        self.assertTrue(breaker.record_failure())
+
+    def test_half_open_single_probe(self):
+        breaker = _CircuitBreaker(dead_retry=10, jitter=0)
+        with mock.patch('memcache.time.time', return_value=1000):
+            breaker.record_failure()
+        with mock.patch('memcache.time.time', return_value=1011):
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+        # The probe never reported back.
+        with mock.patch('memcache.time.time', return_value=1022):
+            self.assertTrue(breaker.allow())
+            self.assertTrue(breaker.record_connect())
+            self.assertTrue(breaker.allow())
+
+    def test_error_rate(self):
+        breaker = _CircuitBreaker(failure_threshold=100,
+                                  error_rate_threshold=0.5,
+                                  error_rate_min_requests=4)
+        tripped = False
+        for i in range(4):
+            self.assertTrue(breaker.allow())
+            tripped = breaker.record_failure()
+        self.assertTrue(tripped)
+
+    def test_exponential_backoff(self):
+        breaker = _CircuitBreaker(dead_retry=10, dead_retry_max=35, jitter=0)
+        with mock.patch('memcache.time.time', return_value=1000):
+            breaker.record_failure()
+            self.assertEqual(breaker.open_until, 1010)
+        with mock.patch('memcache.time.time', return_value=1011):
+            self.assertTrue(breaker.allow())
+            self.assertEqual(breaker.state, _CircuitBreaker.HALF_OPEN)
+            breaker.record_failure()
+            self.assertEqual(breaker.open_until, 1031)
+        with mock.patch('memcache.time.time', return_value=1032):
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+            self.assertEqual(breaker.open_until, 1067)
+            self.assertTrue(breaker.record_success())
+            self.assertEqual(breaker.state, _CircuitBreaker.CLOSED)
+
+
+class TestUnresponsiveServer(unittest.TestCase):
+    def setUp(self):
+        # Connections are accepted by the kernel, but never answered.
+        self.listener = socket.socket()
+        self.addCleanup(self.listener.close)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.mc = Client(['127.0.0.1:%d' % self.listener.getsockname()[1]],
+                         failure_threshold=3, socket_timeout=0.1)
+        self.addCleanup(self.mc.disconnect_all)
+
+    def test_read_timeouts_trip_breaker(self):
+        host = self.mc.servers[0]
+        for i in range(3):
+            self.assertEqual(self.mc.get('key'), None)
+        self.assertEqual(host.connects, 3)
+        self.assertEqual(host._breaker.state, _CircuitBreaker.OPEN)
+        self.mc.get('key')
+        self.assertEqual(host.connects, 3)
+
+    def test_mark_dead_metric_counts_trips(self):
+        metrics = ClientMetrics()
+        mc = Client(['127.0.0.1:%d' % self.listener.getsockname()[1]],
+                    failure_threshold=3, socket_timeout=0.1, metrics=metrics)
+        self.addCleanup(mc.disconnect_all)
+        for i in range(3):
+            mc.get('key')
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(sum(counters['mark_dead'].values()), 1)
+        self.assertEqual(sum(counters['timeouts'].values()), 3)
+
+
+class TestFailover(unittest.TestCase):
+    def setUp(self):
+        self.mc = Client(['a:11211', 'b:11211', 'c:11211'], debug=1)
+        self.connects = []
+
+        def connect(host):
+            self.connects.append(host)
+            return not host._check_dead()
+        patcher = mock.patch.object(_Host, 'connect', autospec=True,
+                                    side_effect=connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_remaps_keys_of_dead_server(self):
+        keys = [('k%d' % i).encode('ascii') for i in range(200)]
+        before = dict((key, self.mc._get_server(key)[0]) for key in keys)
+        dead = self.mc.servers[0]
+        with captured_stderr():
+            dead.mark_dead('test')
+
+        del self.connects[:]
+        for key in keys:
+            server, _ = self.mc._get_server(key)
+            self.assertIsNot(server, dead)
+            if before[key] is not dead:
+                self.assertIs(server, before[key])
+        # Keys that used to live on the dead server cost a single
+        # extra (refused) connect each, no rehash loop.
+        self.assertEqual(len(self.connects),
+                         len(keys) + list(before.values()).count(dead))
+
+    def test_failover_table_rebuilt_on_revive(self):
+        dead = self.mc.servers[1]
+        with captured_stderr():
+            dead.mark_dead('test')
+        self.assertNotIn(dead, self.mc._get_failover_buckets())
+        self.mc.forget_dead_hosts()
+        self.assertIn(dead, self.mc._get_failover_buckets())
+
+    def test_all_dead(self):
+        with captured_stderr():
+            for server in self.mc.servers:
+                server.mark_dead('test')
+        self.assertEqual(self.mc._get_server(b'key'), (None, None))
+
+
+class VersionServer(object):
+    """Listening socket which answers every connection with VERSION."""
+
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(8)
+        self.port = self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            if conn.recv(4096) == b'version\r\n':
+                conn.sendall(b'VERSION 1.6.0\r\n')
+
+    def close(self):
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        self.thread.join()
+
+
+class TestDNSCache(unittest.TestCase):
+    addresses = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.1', 11211))]
+
+    def setUp(self):
+        self.cache = _DNSCache()
+        patcher = mock.patch('memcache.socket.getaddrinfo',
+                             return_value=self.addresses)
+        self.getaddrinfo = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cached_until_ttl(self):
+        with mock.patch('memcache.time.monotonic', return_value=100):
+            self.cache.resolve('mc1', 11211, socket.AF_INET, 60)
+            self.assertEqual(self.cache.resolve('mc1', 11211, socket.AF_INET, 60),
+                             self.addresses)
+        self.assertEqual(self.getaddrinfo.call_count, 1)
+        with mock.patch('memcache.time.monotonic', return_value=161):
+            self.cache.resolve('mc1', 11211, socket.AF_INET, 60)
+        self.assertEqual(self.getaddrinfo.call_count, 2)
+
+    def test_stale_entry_used_on_failure(self):
+        with mock.patch('memcache.time.monotonic', return_value=100):
+            self.cache.resolve('mc1', 11211, socket.AF_INET, 60)
+        self.getaddrinfo.side_effect = socket.gaierror('lookup failed')
+        with mock.patch('memcache.time.monotonic', return_value=200):
+            self.assertEqual(self.cache.resolve('mc1', 11211, socket.AF_INET, 60),
+                             self.addresses)
+            self.assertRaises(socket.gaierror, self.cache.resolve,
+                              'mc2', 11211, socket.AF_INET, 60)
+
+
+class TestStaggeredConnect(unittest.TestCase):
+    def address(self, port):
+        return (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))
+
+    def closed_port(self):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        return port
+
+    def test_next_address_after_failure(self):
+        server = VersionServer()
+        self.addCleanup(server.close)
+        s = _connect_staggered([self.address(self.closed_port()),
+                                self.address(server.port)], timeout=1)
+        self.assertEqual(s.getpeername()[1], server.port)
+        s.close()
+
+    def test_all_addresses_fail(self):
+        self.assertRaises(OSError, _connect_staggered,
+                          [self.address(self.closed_port()),
+                           self.address(self.closed_port())], timeout=1)
+
+    def test_connect_timeout(self):
+        mc = Client(['127.0.0.1:1'], socket_timeout=5, connect_timeout=0.5)
+        self.assertEqual(mc.servers[0].connect_timeout, 0.5)
+        self.assertEqual(mc.servers[0].socket_timeout, 5)
+
+    def blackholed_port(self):
+        """Return the port of a listener whose accept queue is full, so
+        that new connections hang until they time out."""
+        listener = socket.socket()
+        self.addCleanup(listener.close)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(0)
+        port = listener.getsockname()[1]
+        for i in range(3):
+            s = socket.socket()
+            self.addCleanup(s.close)
+            s.settimeout(0.2)
+            try:
+                s.connect(('127.0.0.1', port))
+            except socket.timeout:
+                return port
+        self.skipTest('connections to a full accept queue are not dropped')
+
+    def test_connect_gives_up_after_connect_timeout(self):
+        mc = Client(['127.0.0.1:%d' % self.blackholed_port()],
+                    socket_timeout=10, connect_timeout=0.3)
+        start = time.monotonic()
+        self.assertFalse(mc.servers[0].connect())
+        elapsed = time.monotonic() - start
+        self.assertGreaterEqual(elapsed, 0.25)
+        self.assertLess(elapsed, 3)
+        self.assertEqual(mc.servers[0].timeouts, 1)
+
+
+class TestHealthChecker(unittest.TestCase):
+    def setUp(self):
+        self.server = VersionServer()
+        self.addCleanup(self.server.close)
+        self.transitions = []
+        self.checker = HealthChecker(
+            interval=3600, timeout=1,
+            on_transition=lambda host, alive: self.transitions.append(alive))
+        self.addCleanup(self.checker.stop)
+        self.mc = Client(['127.0.0.1:%d' % self.server.port],
+                         health_checker=self.checker)
+        self.host = self.mc.servers[0]
+
+    def test_revives_dead_host(self):
+        self.host.mark_dead('test')
+        self.assertTrue(self.host._check_dead())
+        self.checker.check()
+        self.assertEqual(self.transitions, [True])
+        self.assertFalse(self.host._check_dead())
+        self.assertIsNotNone(self.host.socket)
+        self.host.close_socket()
+
+    def test_host_still_down(self):
+        self.host.mark_dead('test')
+        self.server.close()
+        self.checker.check()
+        self.assertEqual(self.transitions, [])
+        self.assertTrue(self.host._check_dead())
+
+    def test_idle_host_marked_dead(self):
+        self.checker.idle_interval = 0
+        self.checker.check()  # records the initial use count
+        self.server.close()
+        with captured_stderr():
+            self.checker.check()
+        self.assertEqual(self.transitions, [False])
+        self.assertTrue(self.host._check_dead())
+
+    def check_in_thread(self):
+        thread = threading.Thread(target=self.checker.check)
+        thread.start()
+        thread.join()
+
+    def test_requests_leave_revival_to_checker(self):
+        self.host.mark_dead('test')
+        self.host._breaker.open_until = 0  # backoff expired
+        self.assertTrue(self.host._check_dead())
+        self.assertIsNone(self.host.socket)
+        self.checker.stop()
+        self.assertFalse(self.host._check_dead())
+
+    def test_revival_applied_by_owning_thread(self):
+        self.host.mark_dead('test')
+        self.check_in_thread()
+        self.assertEqual(self.transitions, [True])
+        self.assertIsNone(self.host.socket)
+        self.assertTrue(self.host.connect())
+        self.assertIsNotNone(self.host.socket)
+        self.host.close_socket()
+
+    def test_idle_socket_closed_by_owning_thread(self):
+        sock, other = socket.socketpair()
+        self.addCleanup(other.close)
+        self.host.socket = sock
+        self.checker.idle_interval = 0
+        self.checker.check()
+        self.server.close()
+        with captured_stderr():
+            self.check_in_thread()
+        self.assertEqual(self.transitions, [False])
+        self.assertIs(self.host.socket, sock)
+        self.assertTrue(self.host._check_dead())
+        self.assertIsNone(self.host.socket)
+
+
+class TestReplication(unittest.TestCase):
+    def setUp(self):
+        addresses = [('s%d' % i, 11211) for i in range(4)]
+        patcher = fake_servers(*addresses)
+        self.servers = patcher.__enter__()
+        self.addCleanup(patcher.__exit__, None, None, None)
+        self.mc = Client(['s%d:11211' % i for i in range(4)],
+                         replication_factor=2)
+
+    def holders(self, key):
+        return [s for s in self.servers if key in s.data]
+
+    def test_set_writes_to_n_servers(self):
+        self.assertTrue(self.mc.set('key', 'value'))
+        self.assertEqual(len(self.holders(b'key')), 2)
+        self.assertEqual(self.mc.incr('counter'), None)
+        self.mc.set('counter', 1)
+        self.assertEqual(self.mc.incr('counter'), 2)
+        for server in self.holders(b'counter'):
+            self.assertEqual(server.data[b'counter'][1], b'2')
+        self.assertTrue(self.mc.delete('key'))
+        self.assertEqual(self.holders(b'key'), [])
+
+    def test_get_falls_back_to_replica(self):
+        self.mc.set('key', 'value')
+        primary, replica = self.holders(b'key')
+        if self.mc._get_server(b'key')[0].address[0] != 's%d' % (
+                self.servers.index(primary)):
+            primary, replica = replica, primary
+        del primary.data[b'key']
+        self.assertEqual(self.mc.get('key'), 'value')
+
+        primary.down = True
+        self.mc.disconnect_all()
+        self.assertEqual(self.mc.get('key'), 'value')
+
+    def test_multi(self):
+        mapping = dict(('key%d' % i, i) for i in range(20))
+        self.assertEqual(self.mc.set_multi(mapping), [])
+        for key in mapping:
+            self.assertEqual(len(self.holders(key.encode('ascii'))), 2)
+
+        for server in self.servers[::2]:
+            server.data.clear()
+            del server.commands[:]
+        self.assertEqual(self.mc.get_multi(list(mapping)), mapping)
+        # Multi-key lookups stay batched per server.
+        for server in self.servers:
+            self.assertLessEqual(server.commands.count(b'get'), 2)
+
+        self.mc.delete_multi(list(mapping))
+        self.assertEqual(self.mc.get_multi(list(mapping)), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,498 @@
+from __future__ import print_function
+
+import io
+import json
+import threading
+import unittest
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+from memcache import (AutoBatcher, Client, ClientMetrics, CommandHooks,
+                      HotKeyDetector, NegativeCache, SlowLog,
+                      WriteBehindQueue, _Host)
+from .utils import captured_stderr, fake_servers
+
+
+class ClientTestCase(unittest.TestCase):
+    client_args = {}
+
+    def setUp(self):
+        patcher = fake_servers(('a', 11211), ('b', 11211))
+        self.servers = patcher.__enter__()
+        self.addCleanup(patcher.__exit__, None, None, None)
+        self.mc = Client(['a:11211', 'b:11211'], **self.client_args)
+
+    def gets_sent(self):
+        return sum(s.commands.count(b'get') for s in self.servers)
+
+
+class TestHotKeyDetector(unittest.TestCase):
+    def test_threshold(self):
+        detector = HotKeyDetector(threshold=5, sample_every=1)
+        for i in range(4):
+            detector.record(b'warm')
+        for i in range(5):
+            detector.record(b'hot')
+        self.assertFalse(detector.is_hot(b'warm'))
+        self.assertTrue(detector.is_hot(b'hot'))
+        self.assertEqual(detector.hot_keys(), [(b'hot', 5)])
+
+    def test_sampling(self):
+        detector = HotKeyDetector(threshold=50, sample_every=10)
+        for i in range(49):
+            detector.record(b'key')
+        self.assertFalse(detector.is_hot(b'key'))
+        detector.record(b'key')
+        self.assertTrue(detector.is_hot(b'key'))
+
+    def test_decay(self):
+        detector = HotKeyDetector(threshold=4, sample_every=1,
+                                  decay_interval=0)
+        for i in range(4):
+            detector.record(b'key')
+        self.assertFalse(detector.is_hot(b'key'))
+
+    def test_max_hot_keys(self):
+        detector = HotKeyDetector(threshold=1, sample_every=1, max_hot_keys=2)
+        for key in (b'a', b'a', b'b', b'b', b'c'):
+            detector.record(key)
+        self.assertEqual(sorted(dict(detector.hot_keys())), [b'a', b'b'])
+
+
+class TestHotKeyClient(ClientTestCase):
+    def setUp(self):
+        self.client_args = {'hot_key_detector': HotKeyDetector(
+            threshold=3, sample_every=1, local_ttl=60)}
+        super(TestHotKeyClient, self).setUp()
+
+    def test_get_served_locally(self):
+        self.mc.set('flag', 'on')
+        for i in range(5):
+            self.assertEqual(self.mc.get('flag'), 'on')
+        self.assertEqual(self.gets_sent(), 3)
+        self.assertEqual(self.mc.get_hot_keys(), [(b'flag', 5)])
+
+        self.mc.set('flag', 'off')
+        self.assertEqual(self.mc.get('flag'), 'off')
+        self.assertEqual(self.gets_sent(), 4)
+
+    def test_get_multi_served_locally(self):
+        self.mc.set_multi({'a': 1, 'b': 2})
+        for i in range(3):
+            self.assertEqual(self.mc.get_multi(['a', 'b']), {'a': 1, 'b': 2})
+        sent = self.gets_sent()
+        self.assertEqual(self.mc.get_multi(['a', 'b']), {'a': 1, 'b': 2})
+        self.assertEqual(self.gets_sent(), sent)
+
+        self.mc.delete_multi(['a'])
+        self.assertEqual(self.mc.get_multi(['a', 'b']), {'b': 2})
+
+
+class TestNegativeCache(unittest.TestCase):
+    def test_add_and_invalidate(self):
+        cache = NegativeCache()
+        cache.add(b'missing')
+        cache.add(b'missing')
+        self.assertIn(b'missing', cache)
+        self.assertNotIn(b'other', cache)
+        cache.invalidate(b'missing')
+        self.assertNotIn(b'missing', cache)
+
+    def test_expires(self):
+        with mock.patch('memcache.time.monotonic', return_value=100):
+            cache = NegativeCache(ttl=4, generations=4)
+            cache.add(b'old')
+        with mock.patch('memcache.time.monotonic', return_value=102.5):
+            cache.add(b'new')
+            self.assertIn(b'old', cache)
+        with mock.patch('memcache.time.monotonic', return_value=104):
+            self.assertNotIn(b'old', cache)
+            self.assertIn(b'new', cache)
+        with mock.patch('memcache.time.monotonic', return_value=1000):
+            self.assertNotIn(b'new', cache)
+
+    def test_false_positive_rate(self):
+        cache = NegativeCache(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            cache.add(b'key%d' % i)
+        false_positives = sum(b'other%d' % i in cache for i in range(10000))
+        self.assertLess(false_positives, 200)
+
+
+class TestNegativeCacheClient(ClientTestCase):
+    def setUp(self):
+        self.cache = NegativeCache()
+        self.client_args = {'negative_cache': self.cache}
+        super(TestNegativeCacheClient, self).setUp()
+
+    def test_get(self):
+        self.assertEqual(self.mc.get('missing'), None)
+        self.assertEqual(self.mc.get('missing', 'default'), 'default')
+        self.assertEqual(self.gets_sent(), 1)
+        self.mc.set('missing', 1)
+        self.assertEqual(self.mc.get('missing'), 1)
+        self.assertEqual(self.gets_sent(), 2)
+
+    def test_get_multi(self):
+        self.mc.set('a', 1)
+        keys = ['a', 'b', 'c', 'd']
+        self.assertEqual(self.mc.get_multi(keys), {'a': 1})
+        sent = self.gets_sent()
+        self.assertEqual(self.mc.get_multi(keys), {'a': 1})
+        self.assertEqual(self.mc.get('b'), None)
+        self.assertEqual(self.gets_sent(), sent + 1)
+
+        self.mc.set_multi({'b': 2})
+        self.mc.add('c', 3)
+        self.assertEqual(self.mc.get_multi(keys), {'a': 1, 'b': 2, 'c': 3})
+
+    def test_get_multi_replicated(self):
+        mc = Client(['a:11211', 'b:11211'], negative_cache=self.cache,
+                    replication_factor=2)
+        mc.set('a', 1)
+        keys = ['a', 'b', 'c']
+        self.assertEqual(mc.get_multi(keys), {'a': 1})
+        sent = self.gets_sent()
+        self.assertEqual(mc.get_multi(keys), {'a': 1})
+        self.assertEqual(self.gets_sent(), sent + 1)
+
+    def test_errors_not_recorded(self):
+        self.mc.get('a')
+        for server in self.servers:
+            server.down = True
+        with captured_stderr():
+            self.mc.get_multi(['b', 'c'])
+        for server in self.servers:
+            server.down = False
+        self.mc.forget_dead_hosts()
+        self.mc.set_multi({'b': 1, 'c': 2})
+        self.assertEqual(self.mc.get_multi(['b', 'c']), {'b': 1, 'c': 2})
+
+
+class TestMetrics(ClientTestCase):
+    def setUp(self):
+        self.metrics = ClientMetrics()
+        self.client_args = {'metrics': self.metrics}
+        super(TestMetrics, self).setUp()
+
+    def test_commands(self):
+        self.mc.set('a', 'value')
+        self.mc.get('a')
+        self.mc.get('b')
+        self.mc.get_multi(['a', 'b', 'c'])
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['commands']['get']['count'], 2)
+        self.assertEqual(snapshot['commands']['set']['count'], 1)
+        self.assertEqual(snapshot['commands']['get_multi']['count'], 1)
+        self.assertEqual(snapshot['counters']['hits'],
+                         {'get': 1, 'get_multi': 1})
+        self.assertEqual(snapshot['counters']['misses'],
+                         {'get': 1, 'get_multi': 2})
+        self.assertEqual(sorted(snapshot['counters']['connects']),
+                         ['inet:a:11211', 'inet:b:11211'])
+        sent = sum(snapshot['counters']['bytes_sent'].values())
+        self.assertGreater(sent, len(b'set a 16 0 5\r\nvalue\r\n'))
+        self.assertGreater(sum(snapshot['counters']['bytes_received'].values()), 0)
+
+    def test_aggregated_across_threads(self):
+        thread = threading.Thread(target=self.mc.get, args=('a',))
+        thread.start()
+        thread.join()
+        self.mc.get('a')
+        self.assertEqual(self.metrics.snapshot()['commands']['get']['count'], 2)
+
+    def test_mark_dead_and_reset(self):
+        self.servers[0].down = True
+        self.servers[1].down = True
+        self.mc.set('a', 1)
+        counters = self.metrics.snapshot()['counters']
+        self.assertEqual(sum(counters['mark_dead'].values()), 2)
+        self.metrics.reset()
+        self.assertEqual(self.metrics.snapshot()['counters'], {})
+
+    def test_reset_other_threads(self):
+        shards = []
+
+        def record():
+            self.metrics.incr('custom')
+            shards.append(self.metrics._shard())
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+        self.metrics.reset()
+        # A late increment on the shard of before the reset is dropped,
+        # not counted after it.
+        shards[0].incr('custom', '')
+        self.metrics.incr('custom')
+        self.assertEqual(self.metrics.snapshot()['counters'],
+                         {'custom': {'': 1}})
+
+    def test_prometheus_text(self):
+        self.mc.get('a')
+        text = self.metrics.prometheus_text()
+        self.assertIn('# TYPE memcache_client_command_duration_seconds '
+                      'histogram\n', text)
+        self.assertIn('memcache_client_command_duration_seconds_count'
+                      '{command="get"} 1\n', text)
+        self.assertIn('memcache_client_misses_total{command="get"} 1\n', text)
+
+    def test_prometheus_label_escaping(self):
+        self.metrics.incr('custom', 'a"b\\c\nd')
+        self.assertIn('memcache_client_custom_total{name="a\\"b\\\\c\\nd"} 1\n',
+                      self.metrics.prometheus_text())
+
+
+class TestCommandHooks(ClientTestCase):
+    def setUp(self):
+        self.hooks = CommandHooks()
+        self.started = []
+        self.finished = []
+        self.hooks.add(before=self.started.append, after=self.finished.append)
+        self.client_args = {'hooks': self.hooks}
+        super(TestCommandHooks, self).setUp()
+
+    def test_events(self):
+        self.mc.set('a', 'value')
+        self.mc.get_multi(['a', 'b'])
+        self.assertEqual([e.command for e in self.started], ['set', 'get_multi'])
+        self.assertEqual(self.started, self.finished)
+
+        event = self.finished[0]
+        self.assertEqual((event.key, event.nkeys), (b'a', 1))
+        self.assertEqual(event.value_size, len(b'value'))
+        self.assertEqual(event.outcome, 'ok')
+        self.assertIn(event.host.address[0], ('a', 'b'))
+        self.assertEqual(event.bytes_received, len(b'STORED\r\n'))
+        self.assertGreaterEqual(event.duration, 0)
+
+        event = self.finished[1]
+        self.assertEqual((event.nkeys, event.hits, event.misses), (2, 1, 1))
+
+    def test_error_outcome(self):
+        self.mc.get('a')
+        for server in self.servers:
+            server.down = True
+        with captured_stderr():
+            self.mc.get('a')
+        self.assertEqual(self.finished[-1].outcome, 'error')
+
+    def test_finished_on_exception(self):
+        self.assertRaises(Exception, self.mc.set, 'a', threading.Lock())
+        self.mc.set('n', 'not a number')
+        with mock.patch.object(_Host, 'send_cmd',
+                               side_effect=RuntimeError('boom')):
+            self.assertRaises(RuntimeError, self.mc.delete, 'a')
+            self.assertRaises(RuntimeError, self.mc.touch, 'a')
+            self.assertRaises(RuntimeError, self.mc.incr, 'n')
+        self.assertEqual([e.command for e in self.finished],
+                         ['set', 'set', 'delete', 'touch', 'incr'])
+
+    def test_remove(self):
+        self.hooks.remove(before=self.started.append)
+        self.mc.get('a')
+        self.assertEqual(self.started, [])
+        self.assertEqual(len(self.finished), 1)
+
+    def test_hook_exceptions_ignored(self):
+        self.hooks.add(before=lambda event: 1 / 0)
+        with captured_stderr() as err:
+            self.assertTrue(self.mc.set('a', 1))
+        self.assertIn('set hook failed', err.getvalue())
+        self.assertEqual(len(self.finished), 1)
+
+
+class TestSlowLog(ClientTestCase):
+    def setUp(self):
+        self.slowlog = SlowLog(threshold=0, maxlen=3)
+        self.client_args = {'slowlog': self.slowlog}
+        super(TestSlowLog, self).setUp()
+
+    def test_records_slow_commands(self):
+        self.mc.set('a', 'value')
+        self.mc.get_multi(['a', 'b'])
+        entries = self.mc.get_slowlog()
+        self.assertEqual([e['command'] for e in entries], ['set', 'get_multi'])
+        self.assertEqual(entries[0]['key'], 'a')
+        self.assertEqual(entries[0]['value_size'], len(b'value'))
+        self.assertEqual(len(entries[0]['servers']), 1)
+        self.assertEqual(entries[1]['key'], None)
+        self.assertEqual(entries[1]['nkeys'], 2)
+        self.assertEqual(self.mc.get_slowlog(sampled=True), [])
+
+    def test_bounded(self):
+        for i in range(5):
+            self.mc.get('k%d' % i)
+        self.assertEqual([e['key'] for e in self.mc.get_slowlog()],
+                         ['k2', 'k3', 'k4'])
+
+    def test_sampling_fast_commands(self):
+        self.slowlog.threshold = 3600
+        self.slowlog.sample_rate = 1.0
+        self.mc.get('a')
+        self.assertEqual(self.mc.get_slowlog(), [])
+        self.assertEqual(len(self.mc.get_slowlog(sampled=True)), 1)
+
+    def test_dump(self):
+        self.mc.get('a')
+        self.mc.delete('b')
+        out = io.StringIO()
+        self.slowlog.dump(out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual([json.loads(line)['command'] for line in lines],
+                         ['get', 'delete'])
+
+
+class TestWriteBehind(ClientTestCase):
+    def setUp(self):
+        self.queue = WriteBehindQueue(maxsize=100, flush_interval=0.01)
+        self.metrics = ClientMetrics()
+        self.client_args = {'write_behind': self.queue,
+                            'metrics': self.metrics}
+        super(TestWriteBehind, self).setUp()
+
+    def test_writes_pipelined(self):
+        self.mc.set('gone', 1)
+        for i in range(20):
+            self.assertTrue(self.mc.set_async('key%d' % i, i))
+        self.assertTrue(self.mc.delete_async('gone'))
+        self.assertTrue(self.queue.flush(timeout=5))
+        self.assertEqual(self.mc.get_multi(['key%d' % i for i in range(20)]),
+                         dict(('key%d' % i, i) for i in range(20)))
+        self.assertEqual(self.mc.get('gone'), None)
+        stats = self.queue.stats()
+        self.assertEqual((stats['queued'], stats['written'], stats['pending']),
+                         (21, 21, 0))
+
+    def test_last_write_wins(self):
+        self.queue.flush_interval = 0.2
+        self.mc.set_async('key', 1)
+        self.mc.set_async('key', 2)
+        self.mc.delete_async('other')
+        self.mc.set_async('other', 3)
+        self.queue.flush(timeout=5)
+        self.assertEqual(self.mc.get_multi(['key', 'other']),
+                         {'key': 2, 'other': 3})
+
+    def test_overflow_drop(self):
+        queue = WriteBehindQueue(maxsize=1, flush_interval=0.01)
+        mc = Client(['a:11211'], write_behind=queue, metrics=self.metrics)
+        queue._thread = threading.current_thread()  # keep the worker off
+        self.assertTrue(mc.set_async('a', 1))
+        self.assertFalse(mc.set_async('b', 2))
+        self.assertEqual(queue.stats()['dropped'], 1)
+        counters = self.metrics.snapshot()['counters']
+        self.assertEqual(counters['write_behind']['dropped'], 1)
+
+    def test_bad_key_does_not_lose_batch(self):
+        self.queue.flush_interval = 0.2
+        self.mc.set_async('good', 1)
+        self.mc.set_async('bad key', 2)
+        self.queue.flush(timeout=5)
+        self.assertEqual(self.mc.get('good'), 1)
+        self.assertEqual(self.queue.stats()['failed'], 1)
+
+    def test_set_servers(self):
+        queue = WriteBehindQueue(flush_interval=0.01)
+        mc = Client(['a:11211'], write_behind=queue)
+        mc.set_servers(['b:11211'])
+        mc.server_max_value_length = 10
+        mc.set_async('key', 1)
+        mc.set_async('big', 'x' * 100)
+        self.assertTrue(queue.flush(timeout=5))
+        self.assertEqual(mc.get('key'), 1)
+        self.assertEqual(mc.get('big'), None)
+        self.assertEqual(self.servers[0].commands, [])
+        stats = queue.stats()
+        self.assertEqual((stats['written'], stats['failed']), (1, 1))
+
+    def test_without_queue(self):
+        mc = Client(['a:11211'])
+        self.assertTrue(mc.set_async('key', 1))
+        self.assertEqual(mc.get('key'), 1)
+
+
+class TestAutoBatch(ClientTestCase):
+    def setUp(self):
+        self.batcher = AutoBatcher(window=0.05)
+        self.client_args = {'auto_batch': self.batcher}
+        super(TestAutoBatch, self).setUp()
+        self.keys = ['key%d' % i for i in range(20)]
+        self.mc.set_multi(dict((key, key.upper()) for key in self.keys))
+        for server in self.servers:
+            del server.commands[:]
+
+    def test_threads(self):
+        results = {}
+        barrier = threading.Barrier(len(self.keys))
+
+        def get(key):
+            barrier.wait()
+            results[key] = self.mc.get(key)
+        threads = [threading.Thread(target=get, args=(key,))
+                   for key in self.keys]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, dict((key, key.upper()) for key in self.keys))
+        self.assertLessEqual(self.gets_sent(), 4)
+        self.assertEqual(self.batcher.stats()['keys'], len(self.keys))
+
+    def test_max_batch(self):
+        self.batcher.window = 3600
+        self.batcher.max_batch = 2
+        futures = [self.batcher.submit(key) for key in self.keys[:2]]
+        self.assertEqual([f.result(timeout=5) for f in futures], ['KEY0', 'KEY1'])
+
+    def test_bad_key(self):
+        good = self.batcher.submit('key0')
+        bad = self.batcher.submit('bad key')
+        self.assertEqual(good.result(timeout=5), 'KEY0')
+        self.assertRaises(Client.MemcachedKeyCharacterError, bad.result, 5)
+
+    def test_deadline_not_batched(self):
+        self.assertEqual(self.mc.get('key0', timeout=5), 'KEY0')
+        self.assertEqual(self.batcher.stats()['batches'], 0)
+
+    def test_key_encoder(self):
+        mc = Client(['a:11211', 'b:11211'], auto_batch=AutoBatcher(),
+                    key_encoder=lambda key: 'ns_' + key)
+        mc.set('key0', 'encoded')
+        self.assertEqual(mc.get('key0'), 'encoded')
+        self.assertEqual(mc.get('missing', 0), 0)
+
+    def test_set_servers(self):
+        mc = Client(['a:11211'], auto_batch=AutoBatcher())
+        mc.set_servers(['b:11211'])
+        mc.set('x', 1)
+        self.assertEqual(mc.get('x'), 1)
+        self.assertEqual(self.servers[0].commands, [])
+
+
+class TestBatchScope(ClientTestCase):
+    def test_batch(self):
+        self.mc.set_multi({'a': 1, 'b': 2, 'c': 3})
+        with self.mc.batch() as batch:
+            futures = [batch.get(key) for key in ('a', 'b', 'a', 'missing')]
+            default = batch.get('missing', 0)
+            self.assertFalse(futures[0].done())
+        self.assertEqual([f.result() for f in futures], [1, 2, 1, None])
+        self.assertEqual(default.result(), 0)
+        self.assertLessEqual(self.gets_sent(), 2)
+
+    def test_key_encoder(self):
+        mc = Client(['a:11211', 'b:11211'],
+                    key_encoder=lambda key: 'ns_' + key)
+        mc.set('a', 1)
+        with mc.batch() as batch:
+            found = batch.get('a')
+            missing = batch.get('b', 0)
+        self.assertEqual(found.result(), 1)
+        self.assertEqual(missing.result(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -28,3 +28,119 @@ def captured_stderr():
        self.assertEqual(stderr.getvalue(), 'hello\n')
     """
     return captured_output('stderr')
+
+
+class FakeMemcached(object):
+    """In-memory stand-in for a memcached server speaking to FakeSocket."""
+
+    def __init__(self):
+        self.data = {}
+        self.down = False
+        self.commands = []
+
+    def handle(self, buf):
+        """Process the complete commands in buf.
+
+        Returns a tuple of the response and the unprocessed rest.
+        """
+        out = []
+        while b'\r\n' in buf:
+            line, rest = buf.split(b'\r\n', 1)
+            parts = line.split()
+            cmd, args = parts[0], parts[1:]
+            noreply = args[-1:] == [b'noreply']
+            if noreply:
+                args = args[:-1]
+            if cmd in (b'set', b'add', b'replace', b'cas'):
+                length = int(args[3])
+                if len(rest) < length + 2:
+                    break
+                value, rest = rest[:length], rest[length + 2:]
+            buf = rest
+            self.commands.append(cmd)
+            if cmd in (b'get', b'gets'):
+                for key in args:
+                    if key in self.data:
+                        flags, value = self.data[key]
+                        out.append(b'VALUE %s %d %d%s\r\n%s\r\n' % (
+                            key, flags, len(value),
+                            b' 1' if cmd == b'gets' else b'', value))
+                out.append(b'END\r\n')
+                continue
+            key = args[0]
+            if cmd in (b'set', b'cas') or (
+                    cmd == b'add' and key not in self.data) or (
+                    cmd == b'replace' and key in self.data):
+                self.data[key] = (int(args[1]), value)
+                reply = b'STORED'
+            elif cmd in (b'add', b'replace'):
+                reply = b'NOT_STORED'
+            elif cmd == b'delete':
+                reply = b'DELETED' if self.data.pop(key, None) else b'NOT_FOUND'
+            elif cmd == b'touch':
+                reply = b'TOUCHED' if key in self.data else b'NOT_FOUND'
+            elif cmd in (b'incr', b'decr') and key in self.data:
+                flags, value = self.data[key]
+                delta = int(args[1]) if cmd == b'incr' else -int(args[1])
+                value = b'%d' % max(0, int(value) + delta)
+                self.data[key] = (flags, value)
+                reply = value
+            else:
+                reply = b'NOT_FOUND'
+            if not noreply:
+                out.append(reply + b'\r\n')
+        return b''.join(out), buf
+
+
+class FakeSocket(object):
+    """Socket connected to one of the FakeMemcached in `servers`."""
+
+    servers = {}
+
+    def __init__(self, *args):
+        self.server = None
+        self.inbuf = self.outbuf = b''
+
+    def settimeout(self, timeout):
+        pass
+
+    def connect(self, address):
+        server = self.servers.get(address)
+        if server is None or server.down:
+            raise ConnectionRefusedError('connection refused')
+        self.server = server
+
+    def sendall(self, data):
+        if self.server.down:
+            raise ConnectionResetError('connection reset')
+        out, self.inbuf = self.server.handle(self.inbuf + data)
+        self.outbuf += out
+
+    def recv(self, size):
+        data, self.outbuf = self.outbuf[:size], self.outbuf[size:]
+        return data
+
+    def close(self):
+        self.server = None
+
+
+@contextmanager
+def fake_servers(*addresses):
+    """Patch socket.socket so that connections to `addresses` go to
+    FakeMemcached instances, which are yielded as a list.
+    """
+    import socket
+    servers = [FakeMemcached() for address in addresses]
+    FakeSocket.servers = dict(zip(addresses, servers))
+    orig_socket, orig_getaddrinfo = socket.socket, socket.getaddrinfo
+
+    def getaddrinfo(host, port, *args):
+        if (host, port) in FakeSocket.servers:
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (host, port))]
+        return orig_getaddrinfo(host, port, *args)
+    socket.socket = FakeSocket
+    socket.getaddrinfo = getaddrinfo
+    try:
+        yield servers
+    finally:
+        socket.socket, socket.getaddrinfo = orig_socket, orig_getaddrinfo